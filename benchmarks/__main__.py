@@ -0,0 +1,4 @@
+from benchmarks.runner import main
+
+# python -m benchmarks [-k filter] [-n repeats] [--save-baseline]
+main()
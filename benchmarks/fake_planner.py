@@ -0,0 +1,215 @@
+import os
+import time
+import select
+import socket
+import struct
+import argparse
+import threading
+import numpy as np
+
+from client import planner as protocol
+
+
+# a stand-in for the C++ planner server speaking the same protocol, with made up plans:
+# each (task instance, demonstration) attempt succeeds with probability `success_rate`, a
+# demonstration is only attempted if the previous ones failed (like the real planner), and
+# planning takes `latency` seconds per attempt spread over `n_threads` threads
+#
+#   python -m benchmarks.fake_planner -s ./socket_file --latency 0.001 --success-rate 0.7
+
+
+
+
+def decode_plan_request(payload):
+  n_handles, = struct.unpack_from('<I', payload)
+  offset = 4 + 4 * n_handles
+  n_task_instances, n_objects = struct.unpack_from('<II', payload, offset)
+  offset += 8 + 128 * n_task_instances * n_objects
+  n_joints, = struct.unpack_from('<I', payload, offset)
+  offset += 4 + 8 * n_joints
+  plan_selection, = struct.unpack_from('<I', payload, offset)
+  keep_plans = np.full(n_task_instances, plan_selection not in (protocol.PLAN_SELECTIONS['none'], protocol.PLANS_SUBSET))
+  if plan_selection == protocol.PLANS_SUBSET:
+    n_selected, = struct.unpack_from('<I', payload, offset + 4)
+    keep_plans[np.frombuffer(payload, dtype='<u4', count=n_selected, offset=offset + 8)] = True
+  return n_handles, n_task_instances, n_joints, keep_plans, plan_selection == protocol.PLAN_SELECTIONS['successful']
+
+
+class FakePlanner:
+
+  def __init__(self, address, latency=0.0, success_rate=0.8, plan_length=200, n_screw_segments=4, n_threads=8, stream_batch=16, seed=0, counters=None):
+    self.address = address
+    self.latency = latency
+    self.success_rate = success_rate
+    self.plan_length = plan_length
+    self.n_screw_segments = n_screw_segments
+    self.n_threads = n_threads
+    self.stream_batch = stream_batch
+    self.seed = seed
+    # bytes received and sent over all connections, e.g. multiprocessing.Value('Q') to read them from another process
+    self.counters = counters
+    self.plans = {}
+
+  def count(self, index, n_bytes):
+    if self.counters is not None:
+      with self.counters[index].get_lock():
+        self.counters[index].value += n_bytes
+
+  def recv_frame(self, sock):
+    frame_type, flags, payload = protocol.recv_frame(sock)
+    self.count(0, protocol.FRAME_HEADER.size + len(payload))
+    return frame_type, flags, payload
+
+  def send_frame(self, sock, frame_type, payload):
+    protocol.send_frame(sock, frame_type, payload)
+    self.count(1, protocol.FRAME_HEADER.size + len(payload))
+
+  def plan(self, n_joints):
+    if n_joints not in self.plans:
+      steps = np.linspace(0, 1, self.plan_length)[:, np.newaxis]
+      self.plans[n_joints] = np.ascontiguousarray(np.sin(steps * np.arange(1, n_joints + 1)), dtype='<f8')
+    return self.plans[n_joints]
+
+  # outcome of every attempt, in task instance order, and the number of attempts of each task instance
+  def attempts(self, rng, n_task_instances, n_demontrations):
+    successful = rng.random((n_task_instances, n_demontrations)) < self.success_rate
+    n_attempts = np.where(successful.any(axis=1), successful.argmax(axis=1) + 1, n_demontrations).astype('<u4')
+    tried = np.arange(n_demontrations) < n_attempts[:, np.newaxis]
+    attempts = np.zeros(int(n_attempts.sum()), dtype=protocol.ATTEMPT_DTYPE)
+    attempts['n_screw_segments'] = self.n_screw_segments
+    attempts['is_successful'] = successful[tried]
+    failed = attempts['is_successful'] == 0
+    attempts['failed_screw_segment'][failed] = rng.integers(1, self.n_screw_segments + 1, np.count_nonzero(failed))
+    attempts['failed_joint_angle'][failed] = rng.integers(0, 7, np.count_nonzero(failed))
+    return attempts, n_attempts
+
+  # same layout as encode_plan_response in planner.cpp, a failed attempt carries its plan up to the failed segment
+  def encode_response(self, attempts, n_attempts, keep_plans, successful_only, n_joints):
+    plan = self.plan(n_joints)
+    attempts = attempts.copy()
+    is_successful = attempts['is_successful'] == 1
+    shipped = np.repeat(keep_plans, n_attempts) & (is_successful | (not successful_only))
+    n_steps = np.where(is_successful, len(plan), len(plan) * attempts['failed_screw_segment'] // self.n_screw_segments)
+    attempts['n_steps'] = np.where(shipped, n_steps, 0)
+
+    n_steps_total = int(attempts['n_steps'].sum(dtype=np.int64))
+    starts = np.repeat(np.cumsum(attempts['n_steps'], dtype=np.int64) - attempts['n_steps'], attempts['n_steps'])
+    steps = np.arange(n_steps_total) - starts
+    return b''.join((
+      struct.pack('<IIQQ', len(n_attempts), n_joints, len(attempts), n_steps_total),
+      n_attempts.tobytes(),
+      attempts.tobytes(),
+      plan[steps].tobytes()
+    ))
+
+  # a PLAN_STATS frame (see PlanStats in planner.cpp) where all the time went to planning
+  def encode_stats(self, n_attempts, seconds):
+    phases = {'getMotionPlan': seconds * self.n_threads, 'request': seconds}
+    counters = {'motion_plans': n_attempts}
+    payload = bytearray()
+    for values in (phases, counters):
+      payload += struct.pack('<I', len(values))
+      for name, value in values.items():
+        payload += protocol.encode_str(name) + struct.pack('<Q', int(1e9 * value if values is phases else value))
+    return payload + struct.pack('<I', self.n_threads) + np.full(self.n_threads, int(1e9 * seconds), dtype='<u8').tobytes()
+
+  def compute(self, n_attempts):
+    if self.latency > 0:
+      time.sleep(self.latency * n_attempts / self.n_threads)
+
+  def evaluate(self, sock, payload, flags, rng):
+    started_at = time.perf_counter()
+    n_attempts_total = self.respond(sock, payload, flags, rng)
+    if flags & protocol.FLAG_STATS:
+      self.send_frame(sock, protocol.FRAME_PLAN_STATS, self.encode_stats(n_attempts_total, time.perf_counter() - started_at))
+
+  # sends the plans, returns the number of attempts made
+  def respond(self, sock, payload, flags, rng):
+    n_demontrations, n_task_instances, n_joints, keep_plans, successful_only = decode_plan_request(payload)
+    attempts, n_attempts = self.attempts(rng, n_task_instances, n_demontrations)
+
+    if not flags & protocol.FLAG_STREAM:
+      self.compute(len(attempts))
+      self.send_frame(sock, protocol.FRAME_PLAN_RESPONSE, self.encode_response(attempts, n_attempts, keep_plans, successful_only, n_joints))
+      return len(attempts)
+
+    offsets = np.concatenate(([0], np.cumsum(n_attempts, dtype=np.int64)))
+    cancelled = np.zeros(n_task_instances, dtype=bool)
+    for start in range(0, n_task_instances, self.stream_batch):
+      while select.select([sock], [], [], 0)[0]:
+        frame_type, _, cancellation = self.recv_frame(sock)
+        if frame_type != protocol.FRAME_CANCEL:
+          raise ConnectionError(f'unexpected frame type {frame_type} while streaming')
+        n, = struct.unpack_from('<I', cancellation)
+        cancelled[np.frombuffer(cancellation, dtype='<u4', count=n, offset=4)] = True
+
+      indices = np.flatnonzero(~cancelled[start:start + self.stream_batch]) + start
+      if len(indices) == 0:
+        continue
+      batch_attempts = np.concatenate([attempts[offsets[i]:offsets[i + 1]] for i in indices])
+      self.compute(len(batch_attempts))
+      self.send_frame(sock, protocol.FRAME_PLAN_RESULT, b''.join((
+        struct.pack('<I', len(indices)),
+        indices.astype('<u4').tobytes(),
+        self.encode_response(batch_attempts, n_attempts[indices], keep_plans[indices], successful_only, n_joints)
+      )))
+
+    n_cancelled = int(np.count_nonzero(cancelled))
+    self.send_frame(sock, protocol.FRAME_PLAN_END, struct.pack('<II', n_task_instances - n_cancelled, n_cancelled))
+    return int(n_attempts[~cancelled].sum())
+
+  def handle(self, sock, connection_index):
+    n_handles, n_requests = 0, 0
+    try:
+      while True:
+        frame_type, flags, payload = self.recv_frame(sock)
+        if frame_type == protocol.FRAME_REGISTER_DEMOS:
+          n, = struct.unpack_from('<I', payload)
+          self.send_frame(sock, protocol.FRAME_DEMO_HANDLES, struct.pack('<I', n) + np.arange(n_handles, n_handles + n, dtype='<u4').tobytes())
+          n_handles += n
+        elif frame_type == protocol.FRAME_PLAN_REQUEST:
+          self.evaluate(sock, payload, flags, np.random.default_rng([self.seed, connection_index, n_requests]))
+          n_requests += 1
+        elif frame_type == protocol.FRAME_STATS_REQUEST:
+          self.send_frame(sock, protocol.FRAME_STATS, struct.pack('<QQQQ', 0, 0, 0, 0))
+        elif frame_type != protocol.FRAME_CANCEL:
+          raise ConnectionError(f'unexpected frame type {frame_type}')
+    except OSError:
+      pass  # the client is gone
+    finally:
+      sock.close()
+
+  def serve_forever(self):
+    if type(self.address) == type(''):
+      if os.path.exists(self.address):
+        os.unlink(self.address)
+      server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    else:
+      server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(self.address)
+    server.listen(64)
+    connection_index = 0
+    while True:
+      sock, _ = server.accept()
+      threading.Thread(target=self.handle, args=(sock, connection_index), daemon=True).start()
+      connection_index += 1
+
+
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Stand-in planner server with made up plans')
+  parser.add_argument('-s', '--socket', default='./socket_file', help='unix socket path')
+  parser.add_argument('-p', '--port', type=int, help='listen on this TCP port instead')
+  parser.add_argument('--latency', type=float, default=0.0, help='seconds of planning per attempt')
+  parser.add_argument('--success-rate', type=float, default=0.8)
+  parser.add_argument('--plan-length', type=int, default=200, help='joint angles in a successful plan')
+  parser.add_argument('--threads', type=int, default=8)
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args()
+
+  FakePlanner(
+    ('0.0.0.0', args.port) if args.port else args.socket,
+    latency=args.latency, success_rate=args.success_rate, plan_length=args.plan_length, n_threads=args.threads, seed=args.seed
+  ).serve_forever()
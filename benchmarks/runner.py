@@ -0,0 +1,126 @@
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import multiprocessing
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+
+from benchmarks.fake_planner import FakePlanner
+from benchmarks.scenarios import SCENARIOS
+
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+# metric: (whether lower is better, relative tolerance before a change is a regression, or None to use --tolerance)
+METRICS = {
+  'p50_ms': (True, None),
+  'throughput': (False, None),
+  'bytes': (True, 0.01),
+  'peak_rss_mb': (True, None),
+}
+
+
+
+
+def serve(address, options, counters):
+  FakePlanner(address, counters=counters, **options).serve_forever()
+
+
+def peak_rss_mb():
+  peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return peak_rss / 2**20 if sys.platform == 'darwin' else peak_rss / 2**10  # bytes on macOS, KiB on Linux
+
+
+# runs in a fresh process, so that its peak RSS is the scenario's own
+def measure(name, address, directory, repeats):
+  from client import planner
+  scenario, arguments, options, unit = SCENARIOS[name]
+  run = scenario({'address': address, 'directory': directory, 'planner': options}, **arguments)
+  run()  # warm-up: connection, demonstration handles, sidecars
+
+  latencies, n_units = [], 0
+  for _ in range(repeats):
+    start = time.perf_counter()
+    n_units += run()
+    latencies.append(time.perf_counter() - start)
+  planner.close_session(address)
+
+  return {
+    'unit': unit,
+    'p50_ms': 1000 * float(np.percentile(latencies, 50)),
+    'p99_ms': 1000 * float(np.percentile(latencies, 99)),
+    'throughput': n_units / sum(latencies),
+    'peak_rss_mb': peak_rss_mb()
+  }
+
+
+def run_scenario(name, repeats):
+  context = multiprocessing.get_context('spawn')
+  counters = (context.Value('Q', 0), context.Value('Q', 0))
+  with tempfile.TemporaryDirectory() as directory:
+    address = f'{directory}/planner.sock'
+    server = context.Process(target=serve, args=(address, SCENARIOS[name][2], counters), daemon=True)
+    server.start()
+    while not os.path.exists(address):
+      time.sleep(0.01)
+    try:
+      with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        result = executor.submit(measure, name, address, directory, repeats).result()
+    finally:
+      server.terminate()
+  # the warm-up run is included, bytes are per run
+  result['bytes'] = (counters[0].value + counters[1].value) / (repeats + 1)
+  return result
+
+
+def compare(name, result, baseline, tolerance):
+  regressions = []
+  for metric, (lower_is_better, metric_tolerance) in METRICS.items():
+    if metric not in baseline or baseline[metric] == 0:
+      continue
+    change = result[metric] / baseline[metric] - 1
+    if (change if lower_is_better else -change) > (tolerance if metric_tolerance is None else metric_tolerance):
+      regressions.append(f'{name}: {metric} {baseline[metric]:.4g} -> {result[metric]:.4g} ({100 * change:+.0f}%)')
+  return regressions
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Client benchmarks against a stand-in planner server')
+  parser.add_argument('-k', '--filter', default='', help='only the scenarios whose name contains this')
+  parser.add_argument('-n', '--repeats', type=int, default=10, help='timed runs per scenario')
+  parser.add_argument('--tolerance', type=float, default=0.25, help='relative change of a metric considered a regression')
+  parser.add_argument('--baseline', default=BASELINE_FILE)
+  parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+  args = parser.parse_args()
+
+  baseline = {}
+  if os.path.exists(args.baseline):
+    with open(args.baseline, 'r') as f:
+      baseline = json.load(f)
+
+  results, regressions = {}, []
+  print(f'{"scenario":<48} {"p50 ms":>9} {"p99 ms":>9} {"throughput":>22} {"bytes/run":>11} {"RSS MB":>7} {"p50 vs baseline":>16}')
+  for name in SCENARIOS:
+    if args.filter not in name:
+      continue
+    result = results[name] = run_scenario(name, args.repeats)
+    versus = f'{100 * (result["p50_ms"] / baseline[name]["p50_ms"] - 1):+.0f}%' if name in baseline else '-'
+    print(
+      f'{name:<48} {result["p50_ms"]:9.2f} {result["p99_ms"]:9.2f} {result["throughput"]:12.0f} {result["unit"] + "/s":<9} '
+      f'{result["bytes"]:11.0f} {result["peak_rss_mb"]:7.1f} {versus:>16}'
+    )
+    if name in baseline:
+      regressions += compare(name, result, baseline[name], args.tolerance)
+
+  if args.save_baseline:
+    with open(args.baseline, 'w') as f:
+      json.dump({**baseline, **results}, f, indent=2)
+    print(f'Baseline saved to {args.baseline}')
+  elif len(regressions):
+    print('\nRegressions:\n  ' + '\n  '.join(regressions))
+    sys.exit(1)
@@ -0,0 +1,142 @@
+import os
+import io
+import json
+import contextlib
+import numpy as np
+
+from client import bandit, config, planner, sampling, utils
+from benchmarks.fake_planner import FakePlanner
+
+
+# a scenario is set up once in its own process against its own fake planner, then `run()` is timed
+# repeatedly, it returns the number of units (task instances, demonstrations, ...) it processed
+
+DIMENSIONS = [
+  {'name': 'x', 'min': 0.7056, 'max': 1.0796, 'n_segments': 4},
+  {'name': 'y', 'min': -0.2367, 'max': 0.7833, 'n_segments': 4},
+  {'name': 'θ', 'min': 0, 'max': 0, 'n_segments': 1}
+]
+
+INITIAL_JOINT_CONFIG = [1.04349043096, -0.220126243062, -0.7470486437, 1.52439340796, 1.88181093154, -0.96870886755, -0.490873852123]
+
+
+
+
+# writes a demonstration set like demonstrations/Scoop with made up trajectories
+def make_demo_corpus(directory, n_demos, n_rows=1600, n_segments=(4, 4), seed=0):
+  rng = np.random.default_rng(seed)
+  dimensions = [dict(d) for d in DIMENSIONS]
+  dimensions[0]['n_segments'], dimensions[1]['n_segments'] = n_segments
+  os.makedirs(directory, exist_ok=True)
+  with open(f'{directory}/config.json', 'w') as f:
+    json.dump({'dimensions': dimensions, 'initial_joint_config': INITIAL_JOINT_CONFIG, 'n_objects': 1}, f)
+
+  header = 'time,' + ','.join(f'{arm}_{joint}' for arm in ('left', 'right') for joint in ('s0', 's1', 'e0', 'e1', 'w0', 'w1', 'w2', 'gripper'))
+  for i in range(n_demos):
+    demo_directory = f'{directory}/Demo{i + 1}'
+    os.makedirs(demo_directory, exist_ok=True)
+    joint_angles = np.column_stack((np.linspace(0, 20, n_rows), INITIAL_JOINT_CONFIG + rng.normal(0, 0.1, (n_rows, 7)).cumsum(axis=0) * 0.01, rng.random((n_rows, 9))))
+    np.savetxt(f'{demo_directory}/joint_angles.csv', joint_angles, delimiter=',', header=header, comments='', fmt='%.12g')
+    x, y = (rng.uniform(d['min'], d['max']) for d in dimensions[:2])
+    np.savetxt(f'{demo_directory}/object_poses.csv', sampling.to_SE3([x, y, 0.0]), delimiter=',', fmt='%.17g')
+
+
+def remove_sidecars(directory):
+  for root, _, files in os.walk(directory):
+    for file in files:
+      if file.endswith('.npy'):
+        os.remove(os.path.join(root, file))
+
+
+def fake_demonstrations(n_demos):
+  return [
+    {'recorded_demo_file': f'fake/Demo{i + 1}/joint_angles.csv', 'object_poses_file': f'fake/Demo{i + 1}/object_poses.csv', 'region_of_interest': 1.5, 'score': 0.0}
+    for i in range(n_demos)
+  ]
+
+
+def quiet(function):
+  def run():
+    with contextlib.redirect_stdout(io.StringIO()):
+      return function()
+  return run
+
+
+def encode_decode(context, n_task_instances, n_demos):
+  fake = FakePlanner(None, **context['planner'])
+  task_instances = sampling.to_SE3(sampling.uniform_task_instances([(0.7, 1.1), (-0.2, 0.8), (0, 0)], 1, 3, n_task_instances))
+  attempts, n_attempts = fake.attempts(np.random.default_rng(0), n_task_instances, n_demos)
+  response = fake.encode_response(attempts, n_attempts, np.ones(n_task_instances, dtype=bool), False, 7)
+
+  def run():
+    planner.encode_plan_request(list(range(n_demos)), INITIAL_JOINT_CONFIG, task_instances)
+    planner.decode_plan_response(response)
+    return n_task_instances
+  return run
+
+
+def remote_planner(context, n_task_instances, n_demos, plans='all'):
+  demontrations = fake_demonstrations(n_demos)
+  task_instances = sampling.to_SE3(sampling.uniform_task_instances([(0.7, 1.1), (-0.2, 0.8), (0, 0)], 1, 3, n_task_instances))
+
+  def run():
+    planner.remote_planner(context['address'], demontrations, INITIAL_JOINT_CONFIG, task_instances, plans)
+    return n_task_instances
+  return run
+
+
+def bandit_arms(context, n_segments, n_demos):
+  directory = f'{context["directory"]}/corpus'
+  make_demo_corpus(directory, n_demos, n_rows=50, n_segments=n_segments)
+  config.REMOTE_SERVER = context['address']
+  dimensions, initial_joint_config, n_objects, demonstrations, arms, _ = utils.process_demos(directory)
+  return dimensions, initial_joint_config, n_objects, demonstrations, arms
+
+
+def evaluate_arms(context, n_segments, n_task_instances, n_demos):
+  dimensions, initial_joint_config, n_objects, demonstrations, arms = bandit_arms(context, n_segments, n_demos)
+
+  @quiet
+  def run():
+    bandit.evaluate_arms(arms.keys(), arms, demonstrations, n_objects, len(dimensions), initial_joint_config, n_task_instances, False, dimension_names=[d['name'] for d in dimensions])
+    return n_task_instances * len(arms)
+  return run
+
+
+def naive_pac(context, n_segments, n_demos, epsilon, delta):
+  dimensions, initial_joint_config, n_objects, demonstrations, arms = bandit_arms(context, n_segments, n_demos)
+
+  @quiet
+  def run():
+    _, _, _, samples = bandit.naive_pac(arms, demonstrations, n_objects, len(dimensions), initial_joint_config, epsilon=epsilon, delta=delta, dimension_names=[d['name'] for d in dimensions])
+    return sum(len(s['success']) + len(s['failure']) for s in samples.values())
+  return run
+
+
+def process_demos(context, n_demos, n_rows, cold):
+  directory = f'{context["directory"]}/corpus'
+  make_demo_corpus(directory, n_demos, n_rows=n_rows)
+
+  def run():
+    if cold:
+      remove_sidecars(directory)
+    utils.process_demos(directory)
+    return n_demos
+  return run
+
+
+# name: (scenario, its arguments, fake planner options, unit)
+SCENARIOS = {
+  'encode_decode/n=1000,demos=4,steps=200': (encode_decode, {'n_task_instances': 1000, 'n_demos': 4}, {'plan_length': 200}, 'task instances'),
+  'encode_decode/n=200,demos=4,steps=2000': (encode_decode, {'n_task_instances': 200, 'n_demos': 4}, {'plan_length': 2000}, 'task instances'),
+  'remote_planner/all/n=1000,demos=4,steps=200': (remote_planner, {'n_task_instances': 1000, 'n_demos': 4}, {'plan_length': 200}, 'task instances'),
+  'remote_planner/none/n=1000,demos=4,steps=200': (remote_planner, {'n_task_instances': 1000, 'n_demos': 4, 'plans': 'none'}, {'plan_length': 200}, 'task instances'),
+  'remote_planner/all/n=200,demos=4,steps=2000': (remote_planner, {'n_task_instances': 200, 'n_demos': 4}, {'plan_length': 2000}, 'task instances'),
+  'remote_planner/none/n=1000,demos=16,steps=200': (remote_planner, {'n_task_instances': 1000, 'n_demos': 16, 'plans': 'none'}, {'plan_length': 200, 'success_rate': 0.3}, 'task instances'),
+  'evaluate_arms/K=4,n=500': (evaluate_arms, {'n_segments': (2, 2), 'n_task_instances': 500, 'n_demos': 8}, {}, 'task instances'),
+  'evaluate_arms/K=16,n=500': (evaluate_arms, {'n_segments': (4, 4), 'n_task_instances': 500, 'n_demos': 8}, {}, 'task instances'),
+  'naive_pac/K=4,eps=0.1': (naive_pac, {'n_segments': (2, 2), 'n_demos': 8, 'epsilon': 0.1, 'delta': 0.1}, {}, 'task instances'),
+  'naive_pac/K=16,eps=0.1': (naive_pac, {'n_segments': (4, 4), 'n_demos': 8, 'epsilon': 0.1, 'delta': 0.1}, {}, 'task instances'),
+  'process_demos/demos=32,rows=1600/cold': (process_demos, {'n_demos': 32, 'n_rows': 1600, 'cold': True}, {}, 'demonstrations'),
+  'process_demos/demos=32,rows=1600/warm': (process_demos, {'n_demos': 32, 'n_rows': 1600, 'cold': False}, {}, 'demonstrations'),
+}
@@ -1,6 +1,6 @@
 import csv
 import numpy as np
-from client import bandit, plot, utils, config, planner
+from client import bandit, plot, utils, config, metrics, planner, sampling
 
 
 
@@ -8,12 +8,11 @@ from client import bandit, plot, utils, config, planner
 def k_successful_task_instances_in_each_region(k, arms, initial_joint_config, demontrations, n_objects, dimensions, output_directory):
   task_plans = {}
   for id, val in arms.items():
-    low, high = zip(*val['segment'])
     while True:
-      task_instance = np.random.uniform(low=low, high=high, size=(1, len(dimensions))).reshape(1, n_objects, len(dimensions))
-      se3_task_instance = np.apply_along_axis(utils.to_SE3, 2, task_instance)  
+      task_instance = sampling.uniform_task_instances(val['segment'], n_objects, len(dimensions), 1)
+      se3_task_instance = sampling.to_SE3(task_instance, [d['name'] for d in dimensions])
       for j, demo in enumerate(demontrations):
-        [[plan]] = planner.remote_planner(config.REMOTE_SERVER, [demo], initial_joint_config, se3_task_instance)
+        [[plan]] = planner.remote_planner(config.REMOTE_SERVER, [demo], initial_joint_config, se3_task_instance, plans='successful', decimation=config.EXPORTED_PLAN_DECIMATION)
         if plan['is_successful']:
           task_plans.setdefault(id, []).append((task_instance, plan['plan']))
           break
@@ -39,11 +38,11 @@ if __name__ == '__main__':
 
   DEMO_PATH = 'demonstrations/Scoop_Interactive'
 
-  dimensions, initial_joint_config, n_objects, demonstrations, bandit_arms = utils.process_demos(DEMO_PATH)
+  dimensions, initial_joint_config, n_objects, demonstrations, bandit_arms, demo_index = utils.process_demos(DEMO_PATH)
 
 
   # interactive simulation
-  _, _, [next_demo], samples = bandit.naive_pac(bandit_arms, demonstrations, n_objects, len(dimensions), initial_joint_config, epsilon=0.2, delta=0.05)
+  _, _, [next_demo], samples = bandit.naive_pac(bandit_arms, demonstrations, n_objects, len(dimensions), initial_joint_config, epsilon=0.2, delta=0.05, dimension_names=[d['name'] for d in dimensions])
   plot.plot_heatmap_for_video(dimensions, n_objects, bandit_arms, demonstrations, samples, next_demo, draw_next_demo = False, output_directory='images', transparent=True)
   print('----- provide the next demonstration here -----')
   print(next_demo)
@@ -51,11 +50,17 @@ if __name__ == '__main__':
 
   
   # # simulation with at least 1 pre-collected demo in each arm
-  # demontrations = bandit.self_evaluation(dimensions, n_objects, initial_joint_config, bandit_arms, epsilon = 0.2, delta = 0.05, beta = 0.95, plot_data = True, reuse_tasks_instances = False)
+  # demontrations = bandit.self_evaluation(dimensions, n_objects, initial_joint_config, bandit_arms, epsilon = 0.2, delta = 0.05, beta = 0.95, plot_data = True, reuse_tasks_instances = False, demo_index = demo_index)
   # print(demontrations)
 
 
 
   # k_successful_task_instances_in_each_region(2, bandit_arms, initial_joint_config, demonstrations, n_objects, dimensions, 'plans')
   
+  if config.COLLECT_METRICS:
+    metrics.print_summary()
+    metrics.save_json('metrics.json')
+    metrics.save_chrome_trace('metrics.trace.json')
+
+  
   pass
@@ -1,52 +1,49 @@
 import math
-import copy
+import contextlib
 import numpy as np
 
-from client import plot, utils, config, planner
+from client import plot, utils, config, metrics, planner, sampling
 
 
 
 
-def evaluate_arm(arm_id, arms, demontrations, n_objects, n_dimensions, initial_joint_config, n_task_instances, reuse_tasks_instances):
-  arm = arms[arm_id]
+def sample_task_instances(arm, n_objects, n_dimensions, n_task_instances):
+  return sampling.sample_task_instances(arm['segment'], n_objects, n_dimensions, n_task_instances, config.TASK_INSTANCE_SAMPLER)
 
-  metadata = {}
 
+# with `reuse_tasks_instances` the task instances of an arm are sampled once and kept in its sample store,
+# afterwards only the ones that failed so far are returned to be re-planned with the new demonstrations
+def select_task_instances(arm, metadata, n_objects, n_dimensions, n_task_instances, reuse_tasks_instances):
+  if reuse_tasks_instances and 'task_instances' in metadata:
+    return metadata['failure']
+  task_instances = sample_task_instances(arm, n_objects, n_dimensions, n_task_instances)
   if reuse_tasks_instances:
-    if 'task_instances' not in metadata:
-      low, high = zip(*arm['segment'])
-      metadata['success'] = np.empty((0, n_objects, n_dimensions))
-      metadata['task_instances'] = task_instances = np.random.uniform(
-        low=low, high=high,
-        size=(n_task_instances, n_dimensions)
-      ).reshape(n_task_instances, n_objects, n_dimensions)
-    elif len(metadata['failure_score']) == 0:
-      return
-    else:
-      task_instances = metadata['failure']
-  else:
-    low, high = zip(*arm['segment'])
-    task_instances = np.random.uniform(
-      low=low, high=high,
-      size=(n_task_instances, n_dimensions)
-    ).reshape(n_task_instances, n_objects, n_dimensions)
-
-  motion_plans = planner.remote_planner(
-    config.REMOTE_SERVER,
-    [demontrations[-1]] if reuse_tasks_instances else sorted(demontrations, key=lambda d: d['score'], reverse=True),
-    initial_joint_config,
-    np.apply_along_axis(utils.to_SE3, 2, task_instances)
-  )
+    metadata['task_instances'] = task_instances
+    metadata['success'] = np.empty((0, n_objects, n_dimensions))
+  return task_instances
+
 
+# the score of a failed task instance is averaged over all the demonstrations it was planned with,
+# including the ones of previous rounds when the sample store is reused
+def summarize_motion_plans(metadata, task_instances, motion_plans, reuse_tasks_instances):
+  n_previous_demontrations = metadata.get('n_demontrations', 0) if reuse_tasks_instances else 0
   successful_indices, failed_indices, scores = [], [], []
   for i, plans in enumerate(motion_plans):
+    if plans is None:  # cancelled by early stopping
+      continue
     if plans[-1]['is_successful']:
       successful_indices.append(i)
     else:
       failed_indices.append(i)
-      scores.append(np.mean([p['failed_screw_segment'] / p['n_screw_segments'] for p in plans]))
+      score = np.sum([p['failed_screw_segment'] / p['n_screw_segments'] for p in plans])
+      if n_previous_demontrations:
+        score += metadata['failure_score'][i] * n_previous_demontrations
+      scores.append(score / (n_previous_demontrations + len(plans)))
 
-  print(f'Failed samples: {len(failed_indices)}/{n_task_instances}')
+  n_evaluated = len(successful_indices) + len(failed_indices)
+  metrics.count('successes', len(successful_indices))
+  metrics.count('failures', len(failed_indices))
+  print(f'Failed samples: {len(failed_indices)}/{n_evaluated}' + (f' ({len(task_instances) - n_evaluated} cancelled)' if n_evaluated < len(task_instances) else ''))
 
   metadata['success'] = np.vstack(
     (metadata['success'], task_instances[successful_indices])
@@ -57,22 +54,110 @@ def evaluate_arm(arm_id, arms, demontrations, n_objects, n_dimensions, initial_j
   return metadata
 
 
+# early stopping rule: an arm whose failure probability stays below the currently highest one
+# even if all of its remaining task instances fail can never be the worst arm
+def cannot_be_worst_arm(n_failures, n_remaining, n_total):
+  return (n_failures + n_remaining) / n_total < np.max(n_failures / n_total)
+
+
+# streams the plans of a batch of arms, and cancels the remaining task instances of every arm
+# for which `stopping_rule(n_failures, n_remaining, n_total)` (arrays over the arms) holds
+def stream_motion_plans(batch, samples_metadata, stopping_rule, demontrations, initial_joint_config, task_instances):
+  arm_ids = list(batch.keys())
+  bounds = np.cumsum([0] + [len(t) for t in batch.values()])
+  arm_of_task_instance = np.repeat(np.arange(len(arm_ids)), np.diff(bounds))
+
+  n_failures = np.zeros(len(arm_ids))
+  n_remaining = np.diff(bounds).astype(float)
+  n_total = n_remaining + [len(samples_metadata[arm_id].get('success', [])) for arm_id in arm_ids]
+  stopped = np.zeros(len(arm_ids), dtype=bool)
+
+  motion_plans = [None] * len(task_instances)
+  with planner.stream_planner(config.REMOTE_SERVER, demontrations, initial_joint_config, task_instances, plans='none') as stream:
+    for index, plans in stream:
+      motion_plans[index] = plans
+      arm = arm_of_task_instance[index]
+      n_remaining[arm] -= 1
+      n_failures[arm] += not plans[-1]['is_successful']
+      for arm in np.flatnonzero(~stopped & (n_remaining > 0) & stopping_rule(n_failures, n_remaining, n_total)):
+        stopped[arm] = True
+        stream.cancel(range(bounds[arm], bounds[arm + 1]))
+
+  return motion_plans
+
+
+# the sample stores of a run of the bandit that reuses its task instances, one per arm, kept apart
+# from the arms (their segments and demonstrations), which are shared by every round and trial as is
+def new_sample_stores(arms):
+  return {arm_id: {} for arm_id in arms}
 
-# this algorithm gives ε-optimal arm with probability 1 − δ
-# each arm must be sampled at least 1/2ε² * ln(2K/δ) times
-# both ε and δ should be small numbers
-def naive_pac(arms, demontrations, n_objects, n_dimensions, initial_joint_config, epsilon=0.25, delta=0.1, reuse_tasks_instances=False):
-  n_arms = len(arms)
-  n_samples_per_arm = math.floor(math.log(2 * n_arms / delta) / (2 * epsilon**2))
 
-  samples_metadata = {}
-  for arm_id, arm in arms.items():
-    print(f'---- Sampling {n_samples_per_arm} task instances from arm #{arm_id:2d} ----')
-    samples_metadata[arm_id] = evaluate_arm(arm_id, arms, demontrations, n_objects, n_dimensions, initial_joint_config, n_samples_per_arm, reuse_tasks_instances)
+# evaluates the task instances of all the given arms in a single planner request,
+# so that the planner's threads are saturated by the whole batch instead of one arm at a time,
+# with `reuse_tasks_instances` the samples of an arm are kept in its store of `sample_stores`,
+# `dimension_names` are the names of the dimensions of a task instance in order, see sampling.to_SE3
+@metrics.timed('evaluate_arms')
+def evaluate_arms(arm_ids, arms, demontrations, n_objects, n_dimensions, initial_joint_config, n_task_instances, reuse_tasks_instances, stopping_rule=None, sample_stores=None,
+                  dimension_names=sampling.DIMENSION_NAMES):
+  if reuse_tasks_instances and sample_stores is None:
+    raise ValueError('reusing the task instances needs the sample stores of the run, see new_sample_stores')
+  samples_metadata, batch = {}, {}
+  n_demontrations = len(demontrations)
+  for arm_id in arm_ids:
+    metadata = sample_stores[arm_id] if reuse_tasks_instances else {}
+    samples_metadata[arm_id] = metadata
+    if reuse_tasks_instances and metadata.get('n_demontrations') == n_demontrations:
+      continue
+    with metrics.span('sample'):
+      task_instances = select_task_instances(arms[arm_id], metadata, n_objects, n_dimensions, n_task_instances, reuse_tasks_instances)
+    if len(task_instances):
+      batch[arm_id] = task_instances
 
+  if reuse_tasks_instances:
+    # the planner stops at the first successful demonstration, so an instance that succeeded
+    # stays successful and the failures only need the demonstrations added since they were planned
+    n_previous_demontrations = min((samples_metadata[arm_id].get('n_demontrations', 0) for arm_id in batch), default=0)
+    demontrations = demontrations[n_previous_demontrations:]
+  demontrations = sorted(demontrations, key=lambda d: d['score'], reverse=True)
+
+  if len(batch):
+    with metrics.span('to_SE3'):
+      task_instances = sampling.to_SE3(np.concatenate(list(batch.values())), dimension_names)
+
+    if stopping_rule is None:
+      motion_plans = planner.remote_planner(config.REMOTE_SERVER, demontrations, initial_joint_config, task_instances, plans='none')
+    else:
+      with metrics.span('stream_planner', n_task_instances=len(task_instances)):
+        motion_plans = stream_motion_plans(batch, samples_metadata, stopping_rule, demontrations, initial_joint_config, task_instances)
+
+    offset = 0
+    for arm_id, task_instances in batch.items():
+      print(f'Arm #{arm_id:2d}: ', end='')
+      with metrics.labels(arm=arm_id), metrics.span('score'):
+        summarize_motion_plans(samples_metadata[arm_id], task_instances, motion_plans[offset:offset + len(task_instances)], reuse_tasks_instances)
+      offset += len(task_instances)
+
+  if reuse_tasks_instances:
+    for metadata in samples_metadata.values():
+      metadata['n_demontrations'] = n_demontrations
+
+  return samples_metadata
+
+
+def evaluate_arm(arm_id, arms, demontrations, n_objects, n_dimensions, initial_joint_config, n_task_instances, reuse_tasks_instances, stopping_rule=None, sample_stores=None,
+                 dimension_names=sampling.DIMENSION_NAMES):
+  return evaluate_arms(
+    [arm_id], arms, demontrations, n_objects, n_dimensions, initial_joint_config, n_task_instances, reuse_tasks_instances, stopping_rule, sample_stores, dimension_names
+  )[arm_id]
+
+
+
+# picks the arm with the highest empirical failure probability among `arm_ids` (all arms by default),
+# and the failed task instance with the lowest score in it as the next demonstration
+def select_worst_arm(samples_metadata, arm_ids=None):
   arm_probabilities = [
     (arm_id, len(data['failure']) / (len(data['success']) + len(data['failure'])))
-    for arm_id, data in samples_metadata.items()
+    for arm_id, data in samples_metadata.items() if arm_ids is None or arm_id in arm_ids
   ]
   worst_arm_probability = max([probability for _, probability in arm_probabilities])
   worst_arm_index = np.random.choice([
@@ -91,59 +176,175 @@ def naive_pac(arms, demontrations, n_objects, n_dimensions, initial_joint_config
     next_demonstration_index = np.random.choice(range(len(failed_task_instances)))
     next_demonstration = failed_task_instances[next_demonstration_index]
 
+  return worst_arm_index, worst_arm_probability, next_demonstration
+
+
+
+# this algorithm gives ε-optimal arm with probability 1 − δ
+# each arm must be sampled at least 1/2ε² * ln(2K/δ) times
+# both ε and δ should be small numbers
+# with early stopping, arms that can no longer be the worst one are not sampled to the end,
+# the worst arm (and its probability) is unchanged but the other arms' estimates are partial,
+# it is not applied to a reused sample store since a cancelled failure would miss the new demonstration
+# with `reuse_tasks_instances` the task instances are only reused across calls given the same `sample_stores`
+@metrics.timed('naive_pac')
+def naive_pac(arms, demontrations, n_objects, n_dimensions, initial_joint_config, epsilon=0.25, delta=0.1, reuse_tasks_instances=False, early_stopping=False, sample_stores=None,
+              dimension_names=sampling.DIMENSION_NAMES):
+  n_arms = len(arms)
+  n_samples_per_arm = math.floor(math.log(2 * n_arms / delta) / (2 * epsilon**2))
+
+  if sample_stores is None:
+    sample_stores = new_sample_stores(arms)
+  if reuse_tasks_instances and all('task_instances' in store for store in sample_stores.values()):
+    print(f'---- Re-planning the failed task instances of the {n_arms} arms with the new demonstration ----')
+  else:
+    print(f'---- Sampling {n_samples_per_arm} task instances from each of the {n_arms} arms ----')
+  samples_metadata = evaluate_arms(
+    arms.keys(), arms, demontrations, n_objects, n_dimensions, initial_joint_config, n_samples_per_arm, reuse_tasks_instances,
+    stopping_rule=cannot_be_worst_arm if early_stopping and not reuse_tasks_instances else None, sample_stores=sample_stores, dimension_names=dimension_names
+  )
+
+  worst_arm_index, worst_arm_probability, next_demonstration = select_worst_arm(samples_metadata)
   return worst_arm_index, worst_arm_probability, next_demonstration, samples_metadata
 
 
 
+# Hoeffding radius of an arm sampled n times after `n_rounds` rounds, holding for every arm and
+# every round at once with probability 1 − δ (the rounds are union bounded with Σ 1/r² = π²/6)
+def confidence_radius(n, n_rounds, n_arms, delta):
+  return math.sqrt(math.log(math.pi**2 * n_arms * n_rounds**2 / (3 * delta)) / (2 * n))
+
+
+# successive elimination: the active arms are sampled in doubling batches by `sample_arms(arm_ids, n)`,
+# which returns the number of failures among n new task instances of each arm, and an arm is dropped
+# once its upper confidence bound falls below the highest lower bound (spending δ/10 over all rounds),
+# the remaining arms are sampled until their estimates are ε-accurate with probability 1 − 9δ/10,
+# so the worst remaining arm is ε-optimal (as in naive_pac) with probability 1 − δ
+def successive_elimination(arm_ids, sample_arms, epsilon, delta, initial_batch=None):
+  n_arms = len(arm_ids)
+  n_samples_per_arm = math.ceil(math.log(2 * n_arms / (0.9 * delta)) / (2 * epsilon**2))
+  batch = initial_batch or math.ceil(n_samples_per_arm / 64)
+
+  active = list(arm_ids)
+  n_failures = dict.fromkeys(arm_ids, 0)
+  n_samples = dict.fromkeys(arm_ids, 0)
+  n_rounds = 0
+  while n_samples[active[0]] < n_samples_per_arm:
+    n_rounds += 1
+    n = min(batch, n_samples_per_arm - n_samples[active[0]])
+    for arm_id, failures in sample_arms(active, n).items():
+      n_failures[arm_id] += failures
+      n_samples[arm_id] += n
+    batch *= 2
+
+    radius = confidence_radius(n_samples[active[0]], n_rounds, n_arms, 0.1 * delta)
+    probabilities = {arm_id: n_failures[arm_id] / n_samples[arm_id] for arm_id in active}
+    highest_lower_bound = max(probabilities.values()) - radius
+    active = [arm_id for arm_id in active if probabilities[arm_id] + radius >= highest_lower_bound]
+
+  return active, n_failures, n_samples
+
 
-def self_evaluation(dimensions, n_objects, initial_joint_config, arms, epsilon=0.25, delta=0.1, beta=0.9, plot_data=False, reuse_tasks_instances=False):
+def merge_samples_metadata(metadata, new_metadata):
+  if not metadata:
+    return new_metadata
+  metadata['success'] = np.vstack((metadata['success'], new_metadata['success']))
+  metadata['failure'] = np.vstack((metadata['failure'], new_metadata['failure']))
+  metadata['failure_score'] = metadata['failure_score'] + new_metadata['failure_score']
+  return metadata
+
+
+# adaptive counterpart of naive_pac with the same guarantee and return value,
+# arms whose failure probability is provably below that of another arm, so that they cannot be the
+# worst, are dropped after a few batches instead of being sampled
+# 1/2ε² * ln(2K/δ) times, only the arms that cannot be separated are sampled to 1/2ε² * ln(2K/0.9δ)
+@metrics.timed('successive_elimination_pac')
+def successive_elimination_pac(arms, demontrations, n_objects, n_dimensions, initial_joint_config, epsilon=0.25, delta=0.1, dimension_names=sampling.DIMENSION_NAMES):
+  samples_metadata = {arm_id: {} for arm_id in arms.keys()}
+
+  def sample_arms(arm_ids, n_task_instances):
+    print(f'---- Sampling {n_task_instances} task instances from each of the {len(arm_ids)} remaining arms ----')
+    new_samples_metadata = evaluate_arms(
+      arm_ids, arms, demontrations, n_objects, n_dimensions, initial_joint_config, n_task_instances, False, dimension_names=dimension_names
+    )
+    n_failures = {}
+    for arm_id, metadata in new_samples_metadata.items():
+      samples_metadata[arm_id] = merge_samples_metadata(samples_metadata[arm_id], metadata)
+      n_failures[arm_id] = len(metadata['failure'])
+    return n_failures
+
+  remaining_arms, _, _ = successive_elimination(list(arms.keys()), sample_arms, epsilon, delta)
+
+  worst_arm_index, worst_arm_probability, next_demonstration = select_worst_arm(samples_metadata, remaining_arms)
+  return worst_arm_index, worst_arm_probability, next_demonstration, samples_metadata
+
+
+
+
+# the arms are only read, a run keeps its own sample stores (filled in the first round and reused by
+# the following ones with `reuse_tasks_instances`) and its own copy of which demonstrations are left,
+# `adaptive` samples the arms afresh in every round and stops them by elimination instead, so it can
+# be combined with neither `reuse_tasks_instances` nor `early_stopping`
+def self_evaluation(dimensions, n_objects, initial_joint_config, arms, epsilon=0.25, delta=0.1, beta=0.9, plot_data=False, reuse_tasks_instances=False, early_stopping=False, adaptive=False, demo_index=None):
+  if adaptive and (reuse_tasks_instances or early_stopping):
+    raise ValueError('adaptive self-evaluation samples every round afresh, without reuse_tasks_instances or early_stopping')
   demontrations = []
+  sample_stores = new_sample_stores(arms)
+  dimension_names = [d['name'] for d in dimensions]
+  demo_index = utils.DemoIndex.from_arms(arms) if demo_index is None else demo_index.copy()
+  grid = utils.ArmGrid(dimensions, n_objects)
   arm_index = np.random.choice(list(arms.keys()))
   next_demonstration = None
-  while True:
-    print(f'======== Round #{len(demontrations) + 1} ========')
-    arm = arms[arm_index]
-    (x_min, x_max), (y_min, y_max), _ = arm['segment']
-    x, y, _ = ((x_min + x_max) / 2.0, (y_min + y_max) / 2.0,0) if next_demonstration is None else next_demonstration[0]
-    if len(arm['demos']) == 0:
-      print(f'No demonstration found in arm #{arm_index}')
-      nearby_demos = [(ai, *(sorted(
-        [(di, utils.distance_of_demo(x, y, d)) for di, d in enumerate(a['demos'])],
-        key=lambda x: x[-1],
-        reverse=False)[0]
-      )) for ai, a in arms.items() if len(a['demos']) != 0]
-      if len(nearby_demos) == 0:
-        print('No more demonstration available, exiting prematurely.')
-        return []
-      arm_index, demo_index, _ = sorted(nearby_demos, key=lambda x: x[-1], reverse=False)[0]
-      print(f'Obtained the nearest demonstration from arm #{arm_index}')
-      arm = arms[arm_index]
-      demo = arm['demos'][demo_index]
-    else:
-      print(f'Obtained a demonstration from arm #{arm_index}')
-      demo_index, _ = sorted(
-        [(di, utils.distance_of_demo(x, y, d)) for di, d in enumerate(arm['demos'])],
-        key=lambda x: x[-1],
-        reverse=False
-      )[0]
-      demo = arm['demos'][demo_index]
-    del arm['demos'][demo_index]
-    demontrations.append(demo)
-    arms_copy = arms if reuse_tasks_instances else copy.deepcopy(arms)    
-    arm_index, worst_arm_probability, next_demonstration, samples = naive_pac(
-      arms_copy,
-      demontrations,
-      n_objects,
-      len(dimensions),
-      initial_joint_config,
-      epsilon=epsilon,
-      delta=delta,
-      reuse_tasks_instances=reuse_tasks_instances
-    )
+  # the heatmaps are rendered by another process while the next round is planned
+  heatmaps = plot.HeatmapRenderer(dimensions, n_objects, output_directory='images') if plot_data else contextlib.nullcontext()
+  with heatmaps:
+    while True:
+      with metrics.labels(round=len(demontrations) + 1), metrics.span('round'):
+        print(f'======== Round #{len(demontrations) + 1} ========')
+        x, y = grid.xy(grid.center(arm_index) if next_demonstration is None else next_demonstration)
+        demo_id = demo_index.nearest(x, y, arm_index)
+        if demo_id is None:
+          print(f'No demonstration found in arm #{arm_index}')
+          demo_id = demo_index.nearest(x, y)
+          if demo_id is None:
+            print('No more demonstration available, exiting prematurely.')
+            return []
+          arm_index = int(demo_index.arm_ids[demo_id])
+          print(f'Obtained the nearest demonstration from arm #{arm_index}')
+        else:
+          print(f'Obtained a demonstration from arm #{arm_index}')
+        demo = demo_index.demonstrations[demo_id]
+        demo_index.remove(demo_id)
+        demontrations.append(demo)
+        if adaptive:
+          arm_index, worst_arm_probability, next_demonstration, samples = successive_elimination_pac(
+            arms,
+            demontrations,
+            n_objects,
+            len(dimensions),
+            initial_joint_config,
+            epsilon=epsilon,
+            delta=delta,
+            dimension_names=dimension_names
+          )
+        else:
+          arm_index, worst_arm_probability, next_demonstration, samples = naive_pac(
+            arms,
+            demontrations,
+            n_objects,
+            len(dimensions),
+            initial_joint_config,
+            epsilon=epsilon,
+            delta=delta,
+            reuse_tasks_instances=reuse_tasks_instances,
+            early_stopping=early_stopping,
+            sample_stores=sample_stores,
+            dimension_names=dimension_names
+          )
+
 
 
-  
-    if plot_data:
-      plot.plot_heatmap(dimensions, n_objects, arms_copy, demontrations, samples, output_directory='images')
-    if worst_arm_probability < 1 + epsilon - beta:
-      return demontrations
+        if plot_data:
+          heatmaps.submit(arms, demontrations, samples)
+        if worst_arm_probability < 1 + epsilon - beta:
+          return demontrations
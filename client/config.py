@@ -1,6 +1,8 @@
 import numpy as np
 
 USE_LATEX_IMAGE = True
+# render the heatmaps of self_evaluation with mathtext instead of LaTeX, and as PNG only
+FAST_PLOTS = False
 
 JOINT_LIMITS = np.array(
   [[-1.70167993878, 1.70167993878],
@@ -12,5 +14,28 @@ JOINT_LIMITS = np.array(
    [-3.05900000000, 3.05900000000]]
 )
 
+# height of the objects on the table, the z of every sampled pose
+OBJECT_Z = -0.06447185171756116
+
+# how the bandit draws the task instances of an arm: 'uniform' (independently), or more evenly
+# spread with 'halton', 'sobol' (needs scipy), 'lhs' or 'stratified', see client/sampling.py
+TASK_INSTANCE_SAMPLER = 'uniform'
+
+# record the timings and counters of the evaluation pipeline, see client/metrics.py
+COLLECT_METRICS = False
+
 # REMOTE_SERVER = ('127.0.0.1', 8888)
-REMOTE_SERVER = './socket_file'
\ No newline at end of file
+# REMOTE_SERVER = 'in-process'  # plan inside this process with PLANNER_LIBRARY, see client/engine.py
+# REMOTE_SERVER = ['./socket_file_1', './socket_file_2', ('192.168.0.2', 8888)]  # shard across several planners
+REMOTE_SERVER = './socket_file'
+
+# seconds to keep sending a plan request again while the planner turns it away as too busy
+PLANNER_BUSY_TIMEOUT = 600
+
+# thin out the plans saved by k_successful_task_instances_in_each_region to waypoints, e.g. {'cartesian': 0.001},
+# see planner.remote_planner
+EXPORTED_PLAN_DECIMATION = None
+
+# the planner built as a shared library for REMOTE_SERVER = 'in-process', and its threads (0 for all cores)
+PLANNER_LIBRARY = './libplanner.so'
+IN_PROCESS_THREADS = 0
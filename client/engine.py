@@ -0,0 +1,186 @@
+import os
+import time
+import ctypes
+import threading
+import numpy as np
+
+from client import config, metrics, planner
+
+
+# plans inside this process with the planner built as a shared library instead of over a socket,
+# selected with config.REMOTE_SERVER = 'in-process' (planner.IN_PROCESS)
+#
+#   g++ -std=c++11 -O2 -shared -fPIC -DPLANNER_LIBRARY kinlib/*.cpp planner.cpp -o libplanner.so -lpthread
+#
+# the poses go in and the outcomes come out as numpy arrays, ctypes releases the GIL for the duration
+# of a call and the library plans on config.IN_PROCESS_THREADS threads of its own (0 for all cores)
+
+ATTEMPTS = np.ctypeslib.ndpointer(dtype=planner.ATTEMPT_DTYPE, flags='C_CONTIGUOUS')
+F8 = np.ctypeslib.ndpointer(dtype='<f8', flags='C_CONTIGUOUS')
+U4 = np.ctypeslib.ndpointer(dtype='<u4', flags='C_CONTIGUOUS')
+U1 = np.ctypeslib.ndpointer(dtype=np.uint8, flags='C_CONTIGUOUS')
+
+libraries = {}
+
+
+
+
+def load_library(library_file, n_threads):
+  library_file = os.path.abspath(library_file)
+  if library_file not in libraries:
+    library = ctypes.CDLL(library_file)
+    library.planner_init.argtypes = [ctypes.c_int, ctypes.c_int]
+    library.planner_init.restype = None
+    library.planner_engine_new.argtypes = []
+    library.planner_engine_new.restype = ctypes.c_void_p
+    library.planner_engine_free.argtypes = [ctypes.c_void_p]
+    library.planner_engine_free.restype = None
+    library.planner_engine_register.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_double, ctypes.c_double]
+    library.planner_engine_register.restype = ctypes.c_int64
+    library.planner_engine_plan.argtypes = [
+      ctypes.c_void_p, U4, ctypes.c_uint32, F8, ctypes.c_uint32, ctypes.c_uint32, F8, ctypes.c_uint32, U1, ctypes.c_int,
+      ctypes.c_int, ctypes.c_uint32, ctypes.c_double, ctypes.c_uint32, U4, ATTEMPTS, ctypes.POINTER(ctypes.c_uint64)
+    ]
+    library.planner_engine_plan.restype = ctypes.c_int64
+    library.planner_engine_take_plans.argtypes = [ctypes.c_void_p, F8]
+    library.planner_engine_take_plans.restype = ctypes.c_int
+    library.planner_engine_stats.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_uint64]
+    library.planner_engine_stats.restype = ctypes.c_int64
+    library.planner_init(n_threads, 0)
+    libraries[library_file] = library
+  return libraries[library_file]
+
+
+class Engine:
+  # the in-process counterpart of a PlannerSession, demonstrations are preprocessed once
+  # (and cached by content like in the server) and afterwards referred to by their handles
+
+  def __init__(self, library_file=None, n_threads=None):
+    self.library = load_library(library_file or config.PLANNER_LIBRARY, config.IN_PROCESS_THREADS if n_threads is None else n_threads)
+    self.engine = self.library.planner_engine_new()
+    self.demo_handles = {}
+    self.lock = threading.Lock()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def close(self):
+    if self.engine is not None:
+      self.library.planner_engine_free(self.engine)
+      self.engine = None
+
+  def register(self, demontrations):
+    for demo in demontrations:
+      if planner.demo_key(demo) not in self.demo_handles:
+        handle = self.library.planner_engine_register(
+          self.engine, str.encode(demo['recorded_demo_file']), str.encode(demo['object_poses_file']), demo['region_of_interest'], demo['score']
+        )
+        if handle < 0:
+          raise RuntimeError(f'failed to load the demonstration {demo["recorded_demo_file"]}')
+        self.demo_handles[planner.demo_key(demo)] = handle
+    return [self.demo_handles[planner.demo_key(d)] for d in demontrations]
+
+  def plan(self, demontrations, init_joint_config, task_instances, plans='all', decimation=None):
+    task_instances = np.ascontiguousarray(task_instances, dtype='<f8')
+    n_task_instances, n_objects = task_instances.shape[:2]
+    init_joint_config = np.ascontiguousarray(init_joint_config, dtype='<f8')
+    selected = planner.plan_selection_mask(plans, n_task_instances)
+    decimation_mode, tolerance, stride = (0, 0.0, 0) if decimation is None else planner.decimation_parameters(decimation)
+
+    with self.lock:
+      demo_handles = np.asarray(self.register(demontrations), dtype='<u4')
+      n_attempts = np.zeros(n_task_instances, dtype='<u4')
+      attempts = np.zeros(n_task_instances * len(demo_handles), dtype=planner.ATTEMPT_DTYPE)
+      n_steps_total = ctypes.c_uint64(0)
+      with metrics.span('plan', n_task_instances=n_task_instances):
+        started_at = time.perf_counter()
+        n_attempts_total = self.library.planner_engine_plan(
+          self.engine, demo_handles, len(demo_handles), task_instances, n_task_instances, n_objects,
+          init_joint_config, len(init_joint_config), selected.astype(np.uint8), planner.is_successful_only(plans),
+          decimation is not None, decimation_mode, tolerance, stride, n_attempts, attempts, ctypes.byref(n_steps_total)
+        )
+        if n_attempts_total == -1:
+          raise ValueError('unknown demonstration handle')
+        if n_attempts_total < 0:
+          raise ValueError(f'invalid decimation {decimation}')
+        joint_angles = np.empty((n_steps_total.value, len(init_joint_config)), dtype='<f8')
+        self.library.planner_engine_take_plans(self.engine, joint_angles)
+      stats = self.stats()  # also starts the next request's over
+      if metrics.enabled:
+        planner.record_plan_stats(stats, started_at, planner.IN_PROCESS)
+
+    planner.count_planner_calls(n_attempts_total)
+    with metrics.span('decode'):
+      return planner.motion_plans_from_arrays(n_attempts, attempts[:n_attempts_total], joint_angles, None, selected, planner.is_successful_only(plans))
+
+  # the PLAN_STATS payload of the requests since the last call, see planner.decode_plan_stats
+  def stats(self):
+    buffer = ctypes.create_string_buffer(4096)
+    size = self.library.planner_engine_stats(self.engine, buffer, len(buffer))
+    if size > len(buffer):
+      buffer = ctypes.create_string_buffer(size)
+      size = self.library.planner_engine_stats(self.engine, buffer, len(buffer))
+    return buffer.raw[:size]
+
+
+class PlanStream:
+  # planner.PlanStream for the in-process engine: the task instances are planned in batches of a few
+  # per planner thread, so that the ones cancelled while iterating are not planned at all
+
+  def __init__(self, engine, demontrations, init_joint_config, task_instances, plans='all', decimation=None, batch=None):
+    self.engine = engine
+    self.request = (demontrations, init_joint_config, task_instances, plans, decimation)
+    self.n_task_instances = len(task_instances)
+    self.cancelled = np.zeros(self.n_task_instances, dtype=bool)
+    self.received = np.zeros(self.n_task_instances, dtype=bool)
+    self.batch = batch or 4 * (config.IN_PROCESS_THREADS or os.cpu_count())
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def cancel(self, indices=None):
+    indices = np.flatnonzero(~self.received) if indices is None else np.asarray(indices, dtype=int)
+    self.cancelled[indices] = True
+
+  def __iter__(self):
+    demontrations, init_joint_config, task_instances, plans, decimation = self.request
+    selected = planner.plan_selection_mask(plans, self.n_task_instances)
+    for start in range(0, self.n_task_instances, self.batch):
+      pending = np.flatnonzero(~self.cancelled[start:start + self.batch]) + start
+      if len(pending) == 0:
+        continue
+      pending_plans = plans if type(plans) == type('') else np.flatnonzero(selected[pending])
+      motion_plans = self.engine.plan(demontrations, init_joint_config, task_instances[pending], pending_plans, decimation)
+      self.received[pending] = True
+      for index, instance_plans in zip(pending, motion_plans):
+        if not self.cancelled[index]:
+          yield int(index), instance_plans
+
+  def close(self):
+    pass
+
+
+shared_engine = None
+shared_engine_lock = threading.Lock()
+
+
+def get_engine():
+  global shared_engine
+  with shared_engine_lock:
+    if shared_engine is None:
+      shared_engine = Engine()
+    return shared_engine
+
+
+def in_process_planner(demontrations, init_joint_config, task_instances, plans='all', decimation=None):
+  return get_engine().plan(demontrations, init_joint_config, task_instances, plans, decimation)
+
+
+def in_process_stream(demontrations, init_joint_config, task_instances, plans='all', decimation=None):
+  return PlanStream(get_engine(), demontrations, init_joint_config, task_instances, plans, decimation)
@@ -0,0 +1,94 @@
+import os
+import numpy as np
+
+
+# forward kinematics of the Baxter arm on the client, the same product of exponentials as
+# kinlib::KinematicsSolver::getFK with the manipulator the planner builds from baxter_config/*.csv
+#
+#   g_st(θ) = exp(ξ₁ θ₁) · exp(ξ₂ θ₂) ⋯ exp(ξ₇ θ₇) · g_st(0)
+#
+# for revolute joints of axis ω through the point q:  exp(ξ θ) = | R(ω, θ)  (I − R(ω, θ)) q |
+#                                                                |    0              1       |
+# joint angles of any shape (..., 7) are evaluated at once, e.g. (n_plans, n_steps, 7)
+BAXTER_CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'baxter_config')
+
+
+
+
+class ProductOfExponentials:
+
+  def __init__(self, joint_axes, joint_q, gst0):
+    # (n_joints, 3) axes, normalized like in kinlib::Manipulator::addJoint, (n_joints, 3) points and a (4, 4) pose
+    joint_axes = np.asarray(joint_axes, dtype=float)
+    self.joint_axes = joint_axes / np.linalg.norm(joint_axes, axis=1, keepdims=True)
+    self.joint_q = np.asarray(joint_q, dtype=float)
+    self.gst0 = np.asarray(gst0, dtype=float)
+
+  # the joints are the columns of the axes and q points CSVs, as read by init_solver in planner.cpp
+  @classmethod
+  def from_config(cls, directory=BAXTER_CONFIG, name='baxter'):
+    def load(file):
+      return np.loadtxt(os.path.join(directory, f'{name}_{file}.csv'), delimiter=',')
+    return cls(load('joint_axes').T, load('joint_q').T, load('gst0'))
+
+  def __len__(self):
+    return len(self.joint_axes)
+
+  # rotations about the axes of the joints (Rodrigues' formula, as Eigen::AngleAxisd)
+  def rotations(self, joint_angles):
+    cos, sin = np.cos(joint_angles)[..., np.newaxis, np.newaxis], np.sin(joint_angles)[..., np.newaxis, np.newaxis]
+    w = self.joint_axes
+    outer = w[:, :, np.newaxis] * w[:, np.newaxis, :]
+    skew = np.zeros((len(w), 3, 3))
+    skew[:, 0, 1], skew[:, 0, 2], skew[:, 1, 2] = -w[:, 2], w[:, 1], -w[:, 0]
+    skew[:, 1, 0], skew[:, 2, 0], skew[:, 2, 1] = w[:, 2], -w[:, 1], w[:, 0]
+    return cos * np.eye(3) + (1 - cos) * outer + sin * skew
+
+  # end-effector poses of shape (..., 4, 4)
+  def fk(self, joint_angles):
+    joint_angles = np.asarray(joint_angles, dtype=float)
+    if joint_angles.shape[-1] != len(self):
+      raise ValueError(f'joint angles have {joint_angles.shape[-1]} joints, expected {len(self)}')
+
+    rotations = self.rotations(joint_angles)  # (..., n_joints, 3, 3)
+    exponentials = np.zeros(joint_angles.shape + (4, 4))
+    exponentials[..., :3, :3] = rotations
+    exponentials[..., :3, 3] = self.joint_q - np.einsum('...ij,...j->...i', rotations, self.joint_q)
+    exponentials[..., 3, 3] = 1
+
+    poses = exponentials[..., 0, :, :]
+    for i in range(1, len(self)):
+      poses = poses @ exponentials[..., i, :, :]
+    return poses @ self.gst0
+
+  # end-effector positions of shape (..., 3)
+  def positions(self, joint_angles):
+    return self.fk(joint_angles)[..., :3, 3]
+
+
+baxter = None
+
+
+def baxter_kinematics():
+  global baxter
+  if baxter is None:
+    baxter = ProductOfExponentials.from_config()
+  return baxter
+
+
+def forward_kinematics(joint_angles):
+  return baxter_kinematics().fk(joint_angles)
+
+
+# end-effector paths (n_steps, 3) of plans of different lengths, e.g. the 'plan's of remote_planner,
+# in a single pass over all their steps
+def end_effector_paths(plans):
+  plans = [np.asarray(plan, dtype=float).reshape(-1, len(baxter_kinematics())) for plan in plans]
+  if len(plans) == 0:
+    return []
+  positions = baxter_kinematics().positions(np.concatenate(plans))
+  return np.split(positions, np.cumsum([len(plan) for plan in plans])[:-1])
+
+
+def path_lengths(paths):
+  return np.array([np.linalg.norm(np.diff(path, axis=0), axis=1).sum() for path in paths])
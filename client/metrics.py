@@ -0,0 +1,198 @@
+import os
+import json
+import time
+import threading
+import functools
+import contextlib
+
+from client import config
+
+
+# timings and counters of the evaluation pipeline (sampling, SE(3) lifting, encoding, planning,
+# decoding, scoring, plotting), off unless config.COLLECT_METRICS is set or `enable()` is called
+#
+#   with metrics.span('decode', n_task_instances=n):   a timed phase, spans nest per thread
+#   metrics.count('bytes_sent', n)                      a counter
+#   with metrics.labels(round=3):                       labels every span and counter inside it
+#
+# while disabled a span is a shared no-op context manager and a counter returns immediately,
+# afterwards the recording can be written as JSON (`save_json`) or as a Chrome trace (`save_chrome_trace`),
+# which chrome://tracing and https://ui.perfetto.dev open as a timeline
+enabled = config.COLLECT_METRICS
+
+lock = threading.Lock()
+started_at = time.perf_counter()
+events = []    # (name, start, duration, thread id or name, labels) of every finished span
+counters = {}  # (name, labels) -> value
+samples = []   # (name, labels, time, value) after every update of a counter, for the trace
+
+context = threading.local()
+
+NO_SPAN = contextlib.nullcontext()
+
+
+
+
+def enable():
+  global enabled
+  enabled = True
+
+
+def disable():
+  global enabled
+  enabled = False
+
+
+def reset():
+  global started_at
+  with lock:
+    started_at = time.perf_counter()
+    events.clear()
+    counters.clear()
+    samples.clear()
+
+
+def current_labels():
+  return getattr(context, 'labels', {})
+
+
+@contextlib.contextmanager
+def labels(**new_labels):
+  previous = current_labels()
+  context.labels = {**previous, **new_labels}
+  try:
+    yield
+  finally:
+    context.labels = previous
+
+
+class Span:
+
+  def __init__(self, name, span_labels):
+    self.name = name
+    self.labels = span_labels
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc_info):
+    duration = time.perf_counter() - self.start
+    with lock:
+      events.append((self.name, self.start - started_at, duration, threading.get_ident(), self.labels))
+
+
+# a span measured elsewhere, e.g. by the planner server, `start` is a time.perf_counter() and
+# `thread` any name for the timeline it is shown on
+def add_span(name, start, duration, thread, **span_labels):
+  if not enabled:
+    return
+  with lock:
+    events.append((name, start - started_at, duration, thread, {**current_labels(), **span_labels}))
+
+
+def span(name, **span_labels):
+  if not enabled:
+    return NO_SPAN
+  return Span(name, {**current_labels(), **span_labels})
+
+
+# times every call of the decorated function as a span named after it
+def timed(name):
+  def decorator(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+      if not enabled:
+        return function(*args, **kwargs)
+      with span(name):
+        return function(*args, **kwargs)
+    return wrapper
+  return decorator
+
+
+def count(name, n=1, **counter_labels):
+  if not enabled:
+    return
+  key = (name, tuple(sorted({**current_labels(), **counter_labels}.items())))
+  with lock:
+    counters[key] = counters.get(key, 0) + n
+    samples.append((name, key[1], time.perf_counter() - started_at, counters[key]))
+
+
+# value of a counter summed over all its labels, or over the ones matching `counter_labels`
+def counter(name, **counter_labels):
+  return sum(value for (n, key_labels), value in counters.items() if n == name and set(counter_labels.items()) <= set(key_labels))
+
+
+# total, mean and max duration of the spans of every name, in seconds
+def span_summary():
+  summary = {}
+  with lock:
+    for name, _, duration, _, _ in events:
+      entry = summary.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0})
+      entry['count'] += 1
+      entry['total'] += duration
+      entry['max'] = max(entry['max'], duration)
+  for entry in summary.values():
+    entry['mean'] = entry['total'] / entry['count']
+  return summary
+
+
+def to_json():
+  summary = span_summary()
+  with lock:
+    return {
+      'summary': summary,
+      'spans': [
+        {'name': name, 'start': start, 'duration': duration, 'thread': thread, 'labels': span_labels}
+        for name, start, duration, thread, span_labels in events
+      ],
+      'counters': [{'name': name, 'labels': dict(key_labels), 'value': value} for (name, key_labels), value in counters.items()]
+    }
+
+
+def save_json(file_name):
+  with open(file_name, 'w') as f:
+    json.dump(to_json(), f, indent=2, default=str)
+
+
+def label_string(key_labels):
+  return ','.join(f'{k}={v}' for k, v in key_labels) or 'value'
+
+
+# Trace Event Format: a complete event ('X') per span and a counter event ('C') per counter update,
+# timestamps in microseconds since `reset()` (or the import of this module)
+def to_chrome_trace():
+  pid = os.getpid()
+  with lock:
+    # named threads (of the planner server) get made up ids after the ones of this process
+    thread_ids = {thread: thread for _, _, _, thread, _ in events if type(thread) == type(0)}
+    for _, _, _, thread, _ in events:
+      thread_ids.setdefault(thread, max(thread_ids.values(), default=0) + 1)
+    trace_events = [
+      {'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': thread}}
+      for thread, tid in thread_ids.items() if type(thread) == type('')
+    ] + [
+      {'name': name, 'cat': 'span', 'ph': 'X', 'ts': 1e6 * start, 'dur': 1e6 * duration, 'pid': pid, 'tid': thread_ids[thread], 'args': span_labels}
+      for name, start, duration, thread, span_labels in events
+    ] + [
+      {'name': name, 'cat': 'counter', 'ph': 'C', 'ts': 1e6 * at, 'pid': pid, 'args': {label_string(key_labels): value}}
+      for name, key_labels, at, value in samples
+    ]
+  return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+
+
+def save_chrome_trace(file_name):
+  with open(file_name, 'w') as f:
+    json.dump(to_chrome_trace(), f, default=str)
+
+
+def print_summary():
+  summary = span_summary()
+  for name, entry in sorted(summary.items(), key=lambda item: -item[1]['total']):
+    print(f'{name:<36} {entry["count"]:6d} × {1000 * entry["mean"]:9.2f} ms = {entry["total"]:8.2f} s (max {1000 * entry["max"]:.2f} ms)')
+  totals = {}
+  for (name, _), value in counters.items():
+    totals[name] = totals.get(name, 0) + value
+  for name, value in sorted(totals.items()):
+    print(f'{name:<36} {value}')
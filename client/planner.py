@@ -1,99 +1,709 @@
-import sys
+import time
 import struct
 import socket
+import selectors
+import threading
+import numpy as np
 
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-# X.ABCDEFG           '!f'   4 bytes
-# X.ABCDEFGIJKLMNOP   '!d'   8 bytes
-format_str = '!d'
+from client import config, metrics
 
 
-def send_int(sock, value):
-  sock.sendall(socket.htonl(value).to_bytes(4, byteorder=sys.byteorder))
+# every message is a single frame: a fixed header followed by `length` bytes of payload
+# all integers and floats on the wire are little-endian
+#
+#   magic    4 bytes   b'SEPL'
+#   version  uint8     PROTOCOL_VERSION
+#   type     uint8     FRAME_*
+#   flags    uint16    FLAG_* bits of a PLAN_REQUEST, 0 otherwise
+#   length   uint64    payload size in bytes
+#
+# the flags of a PLAN_REQUEST change the request and its response:
+#   FLAG_STREAM    answered by PLAN_RESULT frames as task instances complete, ended by PLAN_END, instead
+#                  of a single PLAN_RESPONSE, and the client may send CANCEL frames meanwhile
+#   FLAG_STATS     the response (or PLAN_END) is followed by a PLAN_STATS frame
+#   FLAG_DECIMATE  the request ends with u32 mode, f64 tolerance, u32 stride after its plan selection,
+#                  and the joint trajectories of the response are thinned out to waypoints
+# a request turned away by the server's admission control is answered by a BUSY frame instead
+PROTOCOL_MAGIC = b'SEPL'
+PROTOCOL_VERSION = 1
 
+FRAME_HEADER = struct.Struct('<4sBBHQ')
 
-def recv_int(sock):
-  bytes = sock.recv(4)
-  return socket.ntohl(int.from_bytes(bytes, byteorder='big')) if bytes else None
+FRAME_PLAN_REQUEST = 1
+FRAME_PLAN_RESPONSE = 2
+FRAME_REGISTER_DEMOS = 3
+FRAME_DEMO_HANDLES = 4
+FRAME_STATS_REQUEST = 5
+FRAME_STATS = 6
+FRAME_PLAN_RESULT = 7
+FRAME_PLAN_END = 8
+FRAME_CANCEL = 9
+FRAME_PLAN_STATS = 10
+FRAME_BUSY = 11
 
+# a plan request with this flag is answered incrementally, see `stream_planner`
+FLAG_STREAM = 1
+# a plan request with this flag is followed by a PLAN_STATS frame with the server's timings,
+# it is set while client.metrics is enabled, see `record_plan_stats`
+FLAG_STATS = 2
+# a plan request with this flag ends with how its joint trajectories are thinned out, see `encode_decimation`
+FLAG_DECIMATE = 4
 
-def send_float(sock, value):
-  sock.sendall(struct.pack(format_str, value))
+# which joint trajectories a plan request asks for, see `remote_planner`
+PLAN_SELECTIONS = {'all': 0, 'none': 1, 'successful': 2}
+PLANS_SUBSET = 3
 
+# how the joint trajectories of a plan request are thinned out, see `remote_planner`
+DECIMATIONS = {'stride': 0, 'joint': 1, 'cartesian': 2}
 
-def recv_float(sock):
-  bytes = sock.recv(struct.calcsize(format_str))
-  return struct.unpack(format_str, bytes)[0] if bytes else None
+# the planner address of the in-process engine (client/engine.py) instead of a server
+IN_PROCESS = 'in-process'
 
+# number of (task instance, demonstration) plans the planner made for this process, over every
+# backend and session, e.g. the cost of a trial in `client.trials`
+planner_calls = 0
+planner_calls_lock = threading.Lock()
 
-def send_str(sock, string):
-  send_int(sock, len(string))
-  sock.sendall(str.encode(string))
+# per-attempt outcome record of a plan response
+ATTEMPT_DTYPE = np.dtype([
+  ('n_screw_segments', '<i4'),
+  ('is_successful', '<i4'),
+  ('failed_screw_segment', '<i4'),
+  ('failed_joint_angle', '<i4'),
+  ('n_steps', '<u4')
+])
 
 
-def recv_bool(sock):
-  bytes = sock.recv(1)
-  return struct.unpack('?', bytes)[0] if bytes else None
+def recv_exact(sock, n_bytes):
+  buffer = bytearray(n_bytes)
+  view, received = memoryview(buffer), 0
+  while received < n_bytes:
+    n = sock.recv_into(view[received:], n_bytes - received)
+    if n == 0:
+      raise ConnectionError(f'connection closed after {received} of {n_bytes} bytes')
+    received += n
+  return buffer
 
 
-def remote_planner(remote_address, demontrations, init_joint_config, task_instances):
+def send_frame(sock, frame_type, payload, flags=0):
+  sock.sendall(FRAME_HEADER.pack(PROTOCOL_MAGIC, PROTOCOL_VERSION, frame_type, flags, len(payload)))
+  sock.sendall(payload)
+  metrics.count('bytes_sent', FRAME_HEADER.size + len(payload))
 
-  if type(remote_address) == type(''):
-    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-  else:
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-  
-  sock.connect(remote_address)
-  
-  send_int(sock, len(demontrations))
+
+def recv_frame(sock):
+  magic, version, frame_type, flags, length = FRAME_HEADER.unpack(recv_exact(sock, FRAME_HEADER.size))
+  if magic != PROTOCOL_MAGIC or version != PROTOCOL_VERSION:
+    raise ConnectionError(f'unsupported planner protocol {magic!r} v{version}')
+  metrics.count('bytes_received', FRAME_HEADER.size + length)
+  return frame_type, flags, recv_exact(sock, length)
+
+
+def encode_str(string):
+  data = str.encode(string)
+  return struct.pack('<I', len(data)) + data
+
+
+def encode_register_demos(demontrations):
+  payload = bytearray(struct.pack('<I', len(demontrations)))
   for demo in demontrations:
-    send_str(sock, demo['recorded_demo_file'])
-    send_str(sock, demo['object_poses_file'])
-    send_float(sock, demo['region_of_interest'])
-    send_float(sock, demo['score'])
-  
-  send_int(sock, len(task_instances))
-  for task_instance in task_instances:
-    send_int(sock, len(task_instance))
-    for pose in task_instance:
-      pose = pose.flatten().tolist()
-      send_int(sock, len(pose))
-      for val in pose:
-        send_float(sock, val)
-  
-  send_int(sock, len(init_joint_config))
-  for val in init_joint_config:
-    send_float(sock, val)
-  
-  motion_plans = []
-  for _ in task_instances:
-    plans = []
-    for _ in demontrations:
-      n_screw_segments = recv_int(sock)
-      n_joints, plan = recv_int(sock), []
-      for _ in range(n_joints):
-        joint_vector_length, joint_vector = recv_int(sock), []
-        for _ in range(joint_vector_length):
-          joint_vector.append(recv_float(sock))
-        plan.append(joint_vector)
-  
-      is_successful = recv_bool(sock)
-  
-      failed_screw_segment, failed_joint_angle = None, None
-      if not is_successful:
-        failed_screw_segment = recv_int(sock)
-        failed_joint_angle = recv_int(sock)
-  
-      plans.append({
+    payload += encode_str(demo['recorded_demo_file'])
+    payload += encode_str(demo['object_poses_file'])
+    payload += struct.pack('<dd', demo['region_of_interest'], demo['score'])
+  return payload
+
+
+def encode_plan_selection(plans):
+  if type(plans) == type(''):
+    return struct.pack('<I', PLAN_SELECTIONS[plans])
+  indices = np.asarray(plans, dtype='<u4')
+  return struct.pack('<II', PLANS_SUBSET, len(indices)) + indices.tobytes()
+
+
+def plan_selection_mask(plans, n_task_instances):
+  if type(plans) == type(''):
+    return np.full(n_task_instances, plans != 'none')
+  mask = np.zeros(n_task_instances, dtype=bool)
+  mask[np.asarray(plans, dtype=int)] = True
+  return mask
+
+
+# (mode, tolerance, stride) of a `decimation`, see `remote_planner`
+def decimation_parameters(decimation):
+  tolerances = [mode for mode in DECIMATIONS if mode != 'stride' and mode in decimation]
+  stride = decimation.get('stride', 0)
+  if len(tolerances) > 1 or len(set(decimation) - set(DECIMATIONS)) or stride < 0 or (len(tolerances) == 0 and stride < 1):
+    raise ValueError(f'invalid decimation {decimation}')
+  if len(tolerances) == 0:
+    return DECIMATIONS['stride'], 0.0, int(stride)
+  return DECIMATIONS[tolerances[0]], float(decimation[tolerances[0]]), int(stride)
+
+
+def encode_decimation(decimation):
+  return struct.pack('<IdI', *decimation_parameters(decimation))
+
+
+def plan_request_flags(decimation):
+  return (FLAG_STATS if metrics.enabled else 0) | (FLAG_DECIMATE if decimation is not None else 0)
+
+
+def encode_plan_request(demo_handles, init_joint_config, task_instances, plans='all', decimation=None):
+  task_instances = np.ascontiguousarray(task_instances, dtype='<f8')
+  n_task_instances, n_objects = task_instances.shape[:2]
+  init_joint_config = np.ascontiguousarray(init_joint_config, dtype='<f8')
+
+  payload = bytearray(struct.pack('<I', len(demo_handles)))
+  payload += np.asarray(demo_handles, dtype='<u4').data
+  payload += struct.pack('<II', n_task_instances, n_objects)
+  payload += task_instances.reshape(n_task_instances, n_objects, 16).data  # row-major 4x4 poses
+  payload += struct.pack('<I', len(init_joint_config))
+  payload += init_joint_config.data
+  payload += encode_plan_selection(plans)
+  if decimation is not None:
+    payload += encode_decimation(decimation)
+  return payload
+
+
+def is_successful_only(plans):
+  return type(plans) == type('') and plans == 'successful'
+
+
+def count_planner_calls(n):
+  global planner_calls
+  with planner_calls_lock:
+    planner_calls += n
+  metrics.count('planner_calls', n)
+
+
+# decodes the plans of the task instances in a response starting at `offset`, `indices` are
+# their positions in the request (all of them, in order, for a non-streamed response)
+def decode_motion_plans(payload, offset, indices, selected, successful_only):
+  n_task_instances, n_joints, n_attempts_total, n_steps_total = struct.unpack_from('<IIQQ', payload, offset)
+  offset += struct.calcsize('<IIQQ')
+  count_planner_calls(n_attempts_total)
+
+  n_attempts = np.frombuffer(payload, dtype='<u4', count=n_task_instances, offset=offset)
+  offset += n_attempts.nbytes
+  attempts = np.frombuffer(payload, dtype=ATTEMPT_DTYPE, count=n_attempts_total, offset=offset)
+  offset += attempts.nbytes
+  joint_angles = np.frombuffer(payload, dtype='<f8', count=n_steps_total * n_joints, offset=offset).reshape(-1, n_joints)
+  return motion_plans_from_arrays(n_attempts, attempts, joint_angles, indices, selected, successful_only)
+
+
+# the plans of every task instance from the attempts (ATTEMPT_DTYPE) of all of them after each other,
+# `n_attempts` of each task instance, and the joint angles of all the attempts' plans after each other
+def motion_plans_from_arrays(n_attempts, attempts, joint_angles, indices, selected, successful_only):
+  step_offsets = np.concatenate(([0], np.cumsum(attempts['n_steps'], dtype=np.int64)))
+  if indices is None:
+    indices = range(len(n_attempts))
+
+  motion_plans, k = [], 0
+  for index, n in zip(indices, n_attempts):
+    instance_plans = []
+    for attempt in attempts[k:k + n]:
+      is_successful = bool(attempt['is_successful'])
+      has_plan = selected[index] and (is_successful or not successful_only)
+      instance_plans.append({
         'is_successful': is_successful,
-        'n_screw_segments': n_screw_segments,
-        'plan': plan,
-        'failed_screw_segment': failed_screw_segment,
-        'failed_joint_angle': failed_joint_angle
+        'n_screw_segments': int(attempt['n_screw_segments']),
+        'plan': joint_angles[step_offsets[k]:step_offsets[k + 1]] if has_plan else None,
+        'failed_screw_segment': None if is_successful else int(attempt['failed_screw_segment']),
+        'failed_joint_angle': None if is_successful else int(attempt['failed_joint_angle'])
       })
-  
-      if is_successful: break
-  
-    motion_plans.append(plans)
-  
+      k += 1
+    motion_plans.append(instance_plans)
+
   return motion_plans
+
+
+def decode_plan_response(payload, plans='all'):
+  n_task_instances, = struct.unpack_from('<I', payload)
+  return decode_motion_plans(payload, 0, None, plan_selection_mask(plans, n_task_instances), is_successful_only(plans))
+
+
+def decode_str(payload, offset):
+  length, = struct.unpack_from('<I', payload, offset)
+  return bytes(payload[offset + 4:offset + 4 + length]).decode(), offset + 4 + length
+
+
+# time spent in each phase by the server (in seconds, the planning phases summed over its threads),
+# its counters (motion plans, RMRC iterations) and the busy time of each of its planner threads
+def decode_plan_stats(payload):
+  offset, stats = 0, {}
+  for section in ('phases', 'counters'):
+    n, = struct.unpack_from('<I', payload, offset)
+    offset += 4
+    stats[section] = {}
+    for _ in range(n):
+      name, offset = decode_str(payload, offset)
+      stats[section][name], = struct.unpack_from('<Q', payload, offset)
+      offset += 8
+  n_threads, = struct.unpack_from('<I', payload, offset)
+  stats['phases'] = {name: 1e-9 * ns for name, ns in stats['phases'].items()}
+  stats['thread_busy'] = (1e-9 * np.frombuffer(payload, dtype='<u8', count=n_threads, offset=offset + 4)).tolist()
+  return stats
+
+
+# the server side of a request sent at `started_at` (time.perf_counter) as spans on the threads of the server
+def record_plan_stats(payload, started_at, remote_address):
+  stats = decode_plan_stats(payload)
+  server = f'planner {remote_address}'
+  for name, seconds in stats['phases'].items():
+    metrics.add_span(f'server.{name}', started_at, seconds, server)
+  for t, seconds in enumerate(stats['thread_busy']):
+    metrics.add_span('server.thread_busy', started_at, seconds, f'{server} thread #{t}', server_thread=t)
+  for name, value in stats['counters'].items():
+    if name.startswith('max_'):
+      continue
+    metrics.count(name, value)
+  return stats
+
+
+class PlannerBusy(Exception):
+  # a plan request turned away by the admission control of the planner server, which is
+  # planning too many task instances for others already, to be sent again after `retry_after` seconds
+
+  def __init__(self, remote_address, payload):
+    retry_after_ms, self.n_in_flight, self.n_waiting = struct.unpack('<III', payload)
+    self.remote_address = remote_address
+    self.retry_after = retry_after_ms / 1000
+    super().__init__(f'planner {remote_address} is busy with {self.n_in_flight} task instances and {self.n_waiting} waiting requests')
+
+
+# sleeps until a plan request turned away can be sent again, unless that is past `deadline` (time.monotonic)
+def wait_while_busy(busy, deadline):
+  if time.monotonic() + busy.retry_after > deadline:
+    raise busy
+  print(f'{busy}, retrying in {busy.retry_after:.2f} s')
+  metrics.count('planner_busy')
+  with metrics.span('busy_wait'):
+    time.sleep(busy.retry_after)
+
+
+def demo_key(demo):
+  return (demo['recorded_demo_file'], demo['object_poses_file'], demo['region_of_interest'])
+
+
+class PlannerSession:
+  # a long-lived connection to the planner server, demonstrations are preprocessed
+  # by the server once per session and afterwards referred to by their handles
+
+  def __init__(self, remote_address):
+    self.remote_address = remote_address
+    self.demo_handles = {}
+    self.lock = threading.Lock()
+    self.sock = socket.socket(socket.AF_UNIX if type(remote_address) == type('') else socket.AF_INET, socket.SOCK_STREAM)
+    try:
+      self.sock.connect(remote_address)
+    except OSError:
+      self.sock.close()
+      raise
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def close(self):
+    self.sock.close()
+
+  def request(self, frame_type, payload, response_type, flags=0):
+    send_frame(self.sock, frame_type, payload, flags)
+    frame_type, _, payload = recv_frame(self.sock)
+    if frame_type == FRAME_BUSY:
+      raise PlannerBusy(self.remote_address, payload)
+    if frame_type != response_type:
+      raise ConnectionError(f'unexpected frame type {frame_type} from planner')
+    return payload
+
+  def register(self, demontrations):
+    new_demos = list({demo_key(d): d for d in demontrations if demo_key(d) not in self.demo_handles}.values())
+    if len(new_demos):
+      payload = self.request(FRAME_REGISTER_DEMOS, encode_register_demos(new_demos), FRAME_DEMO_HANDLES)
+      n_handles, = struct.unpack_from('<I', payload)
+      handles = np.frombuffer(payload, dtype='<u4', count=n_handles, offset=4)
+      for demo, handle in zip(new_demos, handles):
+        self.demo_handles[demo_key(demo)] = int(handle)
+    return [self.demo_handles[demo_key(d)] for d in demontrations]
+
+  def plan(self, demontrations, init_joint_config, task_instances, plans='all', decimation=None):
+    with self.lock:
+      demo_handles = self.register(demontrations)
+      with metrics.span('encode'):
+        request = encode_plan_request(demo_handles, init_joint_config, task_instances, plans, decimation)
+      with metrics.span('plan', n_task_instances=len(task_instances)):
+        started_at = time.perf_counter()
+        payload = self.request(FRAME_PLAN_REQUEST, request, FRAME_PLAN_RESPONSE, plan_request_flags(decimation))
+      if metrics.enabled:
+        record_plan_stats(self.recv_plan_stats(), started_at, self.remote_address)
+    with metrics.span('decode'):
+      return decode_plan_response(payload, plans)
+
+  # the session stays locked by the returned stream until it is exhausted or closed
+  def stream(self, demontrations, init_joint_config, task_instances, plans='all', decimation=None):
+    self.lock.acquire()
+    try:
+      demo_handles = self.register(demontrations)
+      with metrics.span('encode'):
+        request = encode_plan_request(demo_handles, init_joint_config, task_instances, plans, decimation)
+      started_at = time.perf_counter()
+      flags = FLAG_STREAM | plan_request_flags(decimation)
+      send_frame(self.sock, FRAME_PLAN_REQUEST, request, flags)
+    except BaseException:
+      self.lock.release()
+      raise
+    return PlanStream(self, len(task_instances), plans, started_at if metrics.enabled else None, (request, flags))
+
+  def recv_plan_stats(self):
+    frame_type, _, payload = recv_frame(self.sock)
+    if frame_type != FRAME_PLAN_STATS:
+      raise ConnectionError(f'unexpected frame type {frame_type} from planner')
+    return payload
+
+  def stats(self):
+    with self.lock:
+      payload = self.request(FRAME_STATS_REQUEST, b'', FRAME_STATS)
+    hits, misses, entries, capacity = struct.unpack('<QQQQ', payload)
+    return {'demo_cache': {'hits': hits, 'misses': misses, 'entries': entries, 'capacity': capacity}}
+
+
+class PlanStream:
+  # iterates over (task instance index, plans) in the order the planner completes them,
+  # task instances that are no longer needed can be cancelled while iterating
+
+  # `stats_started_at` is the time the request was sent at if it asked for a PLAN_STATS frame,
+  # `request` the payload and flags of the request, sent again if the planner turns it away
+  def __init__(self, session, n_task_instances, plans='all', stats_started_at=None, request=None):
+    self.session = session
+    self.request = request
+    self.busy_deadline = time.monotonic() + config.PLANNER_BUSY_TIMEOUT
+    self.stats_started_at = stats_started_at
+    self.n_task_instances = n_task_instances
+    self.selected = plan_selection_mask(plans, n_task_instances)
+    self.successful_only = is_successful_only(plans)
+    self.received = np.zeros(n_task_instances, dtype=bool)
+    self.cancelled = np.zeros(n_task_instances, dtype=bool)
+    self.finished = self.closed = False
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def fileno(self):
+    return self.session.sock.fileno()
+
+  def cancel(self, indices=None):
+    indices = np.flatnonzero(~self.received) if indices is None else np.asarray(indices, dtype=int)
+    indices = indices[~self.cancelled[indices]]
+    self.cancelled[indices] = True
+    if len(indices) and not self.finished:
+      send_frame(self.session.sock, FRAME_CANCEL, struct.pack('<I', len(indices)) + indices.astype('<u4').tobytes())
+
+  # reads the next frame of the stream, returns the plans it carries that were not cancelled
+  def read(self):
+    frame_type, _, payload = recv_frame(self.session.sock)
+    if frame_type == FRAME_BUSY:
+      if np.all(self.received | self.cancelled):
+        self.finished = True  # turned away, but nothing of it is wanted anymore
+        return []
+      return self.resend(PlannerBusy(self.session.remote_address, payload))
+    if frame_type == FRAME_PLAN_END:
+      if self.stats_started_at is not None:
+        record_plan_stats(self.session.recv_plan_stats(), self.stats_started_at, self.session.remote_address)
+      self.finished = True
+      return []
+    if frame_type != FRAME_PLAN_RESULT:
+      raise ConnectionError(f'unexpected frame type {frame_type} from planner')
+    n, = struct.unpack_from('<I', payload)
+    indices = np.frombuffer(payload, dtype='<u4', count=n, offset=4)
+    self.received[indices] = True
+    with metrics.span('decode'):
+      motion_plans = decode_motion_plans(payload, 4 + indices.nbytes, indices, self.selected, self.successful_only)
+    return [(int(i), plans) for i, plans in zip(indices, motion_plans) if not self.cancelled[i]]
+
+  # sends the request again once the planner has room for it, with the cancellations so far,
+  # which the planner has ignored without a stream going on
+  def resend(self, busy):
+    try:
+      wait_while_busy(busy, self.busy_deadline)
+    except PlannerBusy:
+      self.finished = True  # nothing left to drain
+      raise
+    send_frame(self.session.sock, FRAME_PLAN_REQUEST, *self.request)
+    cancelled = np.flatnonzero(self.cancelled)
+    if len(cancelled):
+      send_frame(self.session.sock, FRAME_CANCEL, struct.pack('<I', len(cancelled)) + cancelled.astype('<u4').tobytes())
+    return []
+
+  def __iter__(self):
+    try:
+      while not self.finished:
+        yield from self.read()
+    finally:
+      self.close()
+
+  # cancels whatever is still pending and drains the stream, so the session can be reused
+  def close(self):
+    if self.closed:
+      return
+    try:
+      if not self.finished:
+        self.cancel()
+        while not self.finished:
+          self.read()
+    except (OSError, PlannerBusy):
+      self.abort()
+    else:
+      self.closed = True
+      self.session.lock.release()
+
+  # gives up on a broken stream together with its session
+  def abort(self):
+    if not self.closed:
+      self.closed = True
+      discard_session(self.session)
+      self.session.lock.release()
+
+
+# the open session of every planner address, shared by the shard threads of `sharded_planner`
+sessions = {}
+sessions_lock = threading.Lock()
+
+
+def get_session(remote_address):
+  with sessions_lock:
+    session = sessions.get(remote_address)
+  if session is None:
+    new_session = PlannerSession(remote_address)  # connects outside of the lock
+    with sessions_lock:
+      session = sessions.setdefault(remote_address, new_session)
+    if session is not new_session:
+      new_session.close()  # another thread connected first
+  return session
+
+
+def close_session(remote_address):
+  with sessions_lock:
+    session = sessions.pop(remote_address, None)
+  if session is not None:
+    session.close()
+
+
+def discard_session(session):
+  with sessions_lock:
+    if sessions.get(session.remote_address) is session:
+      del sessions[session.remote_address]
+  session.close()
+
+
+def session_planner(remote_address, demontrations, init_joint_config, task_instances, plans='all', decimation=None):
+  if remote_address == IN_PROCESS:
+    from client import engine  # loads the planner library on first use only
+    return engine.in_process_planner(demontrations, init_joint_config, task_instances, plans, decimation)
+  busy_deadline, reconnected = time.monotonic() + config.PLANNER_BUSY_TIMEOUT, False
+  while True:
+    try:
+      return get_session(remote_address).plan(demontrations, init_joint_config, task_instances, plans, decimation)
+    except ConnectionError:
+      # the server may have been restarted since the session was opened, retry once on a fresh one
+      if reconnected:
+        raise
+      close_session(remote_address)
+      reconnected = True
+    except PlannerBusy as busy:
+      wait_while_busy(busy, busy_deadline)
+
+
+# recently observed throughput (task instances per second) of each planner backend
+backend_throughput = {}
+backend_throughput_lock = threading.Lock()
+
+
+def partition_task_instances(n_task_instances, remote_addresses):
+  with backend_throughput_lock:
+    throughput = {address: backend_throughput[address] for address in remote_addresses if address in backend_throughput}
+  default = np.mean(list(throughput.values())) if len(throughput) else 1.0
+  weights = np.array([throughput.get(address, default) for address in remote_addresses])
+  bounds = np.round(np.cumsum(weights) / np.sum(weights) * n_task_instances).astype(int).tolist()
+  return list(zip([0] + bounds[:-1], bounds))
+
+
+def shard_plan_selection(plans, start, end):
+  if type(plans) == type(''):
+    return plans
+  indices = np.asarray(plans, dtype=int)
+  return indices[(indices >= start) & (indices < end)] - start
+
+
+def sharded_planner(remote_addresses, demontrations, init_joint_config, task_instances, plans='all', decimation=None):
+
+  def plan_shard(remote_address, start, end):
+    shard_plans = shard_plan_selection(plans, start, end)
+    started_at = time.perf_counter()
+    motion_plans = session_planner(remote_address, demontrations, init_joint_config, task_instances[start:end], shard_plans, decimation)
+    throughput = (end - start) / max(time.perf_counter() - started_at, 1e-6)
+    with backend_throughput_lock:
+      backend_throughput[remote_address] = 0.5 * (backend_throughput.get(remote_address, throughput) + throughput)
+    return motion_plans
+
+  alive, results = list(remote_addresses), {}
+  with ThreadPoolExecutor(max_workers=len(remote_addresses)) as executor:
+    pending = {
+      executor.submit(plan_shard, remote_address, start, end): (remote_address, start, end)
+      for remote_address, (start, end) in zip(remote_addresses, partition_task_instances(len(task_instances), remote_addresses))
+      if end > start
+    }
+    while len(pending):
+      done, _ = wait(pending, return_when=FIRST_COMPLETED)
+      for future in done:
+        remote_address, start, end = pending.pop(future)
+        try:
+          results[start] = future.result()
+        except OSError as error:
+          close_session(remote_address)
+          with backend_throughput_lock:
+            backend_throughput.pop(remote_address, None)
+            throughput = dict(backend_throughput)
+          if remote_address in alive:
+            alive.remove(remote_address)
+          if len(alive) == 0:
+            raise
+          fallback = max(alive, key=lambda address: throughput.get(address, 0))
+          print(f'Planner backend {remote_address} failed ({error}), retrying task instances [{start}, {end}) on {fallback}')
+          pending[executor.submit(plan_shard, fallback, start, end)] = (fallback, start, end)
+
+  return [plans for start in sorted(results) for plans in results[start]]
+
+
+# `remote_address` is either a single planner endpoint (a unix socket path, a (host, port) tuple or
+# IN_PROCESS) or a list of endpoints, in which case the task instances are sharded across them
+#
+# `plans` selects the joint trajectories shipped back, the outcome of every attempt is always returned:
+#   'all'         every attempted plan
+#   'none'        outcomes only, each 'plan' is None
+#   'successful'  only the successful plans
+#   [i, j, ...]   all attempted plans of the given task instances only
+#
+# `decimation` thins the shipped joint trajectories out to waypoints on the planner, the first and last
+# step of every screw segment are kept and in between only the steps needed for the joint angles
+# interpolated linearly between the waypoints to stay within a tolerance of the dropped ones:
+#   None                            every step
+#   {'joint': 0.005}                every joint within 0.005 rad
+#   {'cartesian': 0.001}            the end-effector position within 1 mm
+#   {'joint': 0.005, 'stride': 50}  ... and the waypoints at most 50 steps apart
+#   {'stride': 10}                  every 10th step
+def remote_planner(remote_address, demontrations, init_joint_config, task_instances, plans='all', decimation=None):
+  with metrics.span('remote_planner', n_task_instances=len(task_instances)):
+    if type(remote_address) == type([]):
+      return sharded_planner(remote_address, demontrations, init_joint_config, task_instances, plans, decimation)
+    return session_planner(remote_address, demontrations, init_joint_config, task_instances, plans, decimation)
+
+
+class ShardedPlanStream:
+  # merges the plan streams of the shards of a request sent to several planner backends,
+  # a shard whose backend fails is planned again on another one
+
+  def __init__(self, remote_addresses, demontrations, init_joint_config, task_instances, plans='all', decimation=None):
+    self.remote_addresses = list(remote_addresses)
+    self.request = (demontrations, init_joint_config, task_instances, plans, decimation)
+    self.received = np.zeros(len(task_instances), dtype=bool)
+    self.cancelled = np.zeros(len(task_instances), dtype=bool)
+    self.streams = {}
+    try:
+      for remote_address, (start, end) in zip(self.remote_addresses, partition_task_instances(len(task_instances), self.remote_addresses)):
+        if end > start:
+          shard_plans = shard_plan_selection(plans, start, end)
+          self.streams[get_session(remote_address).stream(demontrations, init_joint_config, task_instances[start:end], shard_plans, decimation)] = (remote_address, start)
+    except BaseException:
+      self.close()
+      raise
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def cancel(self, indices=None):
+    indices = np.flatnonzero(~self.received) if indices is None else np.asarray(indices, dtype=int)
+    self.cancelled[indices] = True
+    for stream, (_, start) in self.streams.items():
+      local = indices[(indices >= start) & (indices < start + stream.n_task_instances)] - start
+      if len(local) and not stream.closed:
+        stream.cancel(local)
+
+  # plans the pending task instances of a failed shard on a fresh connection to another backend,
+  # the sessions of the other backends are busy with their own shards
+  def replan(self, stream, remote_address, start, error):
+    stream.abort()
+    pending = np.flatnonzero(~stream.received & ~self.cancelled[start:start + stream.n_task_instances])
+    if len(pending) == 0:
+      return []
+    demontrations, init_joint_config, task_instances, plans, decimation = self.request
+    end = start + stream.n_task_instances
+    selected = plan_selection_mask(shard_plan_selection(plans, start, end), stream.n_task_instances)[pending]
+    pending_plans = plans if type(plans) == type('') else np.flatnonzero(selected)
+    for fallback in self.remote_addresses:
+      if fallback == remote_address:
+        continue
+      print(f'Planner backend {remote_address} failed ({error}), retrying {len(pending)} task instances on {fallback}')
+      try:
+        session = PlannerSession(fallback)
+      except OSError as fallback_error:
+        error = fallback_error
+        continue
+      with session:
+        motion_plans = session.plan(demontrations, init_joint_config, task_instances[start + pending], pending_plans, decimation)
+      return [(start + int(i), plans) for i, plans in zip(pending, motion_plans)]
+    raise error
+
+  def __iter__(self):
+    try:
+      with selectors.DefaultSelector() as selector:
+        for stream in self.streams:
+          selector.register(stream, selectors.EVENT_READ)
+        while len(selector.get_map()):
+          for key, _ in selector.select():
+            stream = key.fileobj
+            remote_address, start = self.streams[stream]
+            try:
+              results = [(start + i, plans) for i, plans in stream.read()]
+            except OSError as error:
+              results = self.replan(stream, remote_address, start, error)
+              stream.finished = True
+            if stream.finished:
+              selector.unregister(stream)
+            for index, plans in results:
+              self.received[index] = True
+              if not self.cancelled[index]:
+                yield index, plans
+    finally:
+      self.close()
+
+  def close(self):
+    for stream in self.streams:
+      stream.close()
+
+
+# like `remote_planner` but returns an iterable over (task instance index, plans) as they complete,
+# use it as a context manager, or exhaust it, to release the planner session(s) afterwards
+def stream_planner(remote_address, demontrations, init_joint_config, task_instances, plans='all', decimation=None):
+  if type(remote_address) == type([]):
+    return ShardedPlanStream(remote_address, demontrations, init_joint_config, task_instances, plans, decimation)
+  if remote_address == IN_PROCESS:
+    from client import engine
+    return engine.in_process_stream(demontrations, init_joint_config, task_instances, plans, decimation)
+  try:
+    return get_session(remote_address).stream(demontrations, init_joint_config, task_instances, plans, decimation)
+  except ConnectionError:
+    close_session(remote_address)
+    return get_session(remote_address).stream(demontrations, init_joint_config, task_instances, plans, decimation)
+
+
+def server_stats(remote_address):
+  return get_session(remote_address).stats()
@@ -1,8 +1,9 @@
-import csv
+import traceback
 import matplotlib
+import multiprocessing
 import numpy as np
 
-from client import config
+from client import config, metrics, utils
 
 matplotlib.use('agg')
 # if config.USE_LATEX_IMAGE: matplotlib.use('pgf')
@@ -11,102 +12,170 @@ import matplotlib.pyplot as plt
 from mpl_toolkits.axes_grid1.axes_divider import make_axes_locatable
 
 
-def plot_heatmap(dimensions, n_objects, arms, demontrations, samples, output_directory):
+# failure probability of every sampled arm, indexed by arm id
+def failure_probabilities(samples):
+  probabilities = np.zeros(max(samples.keys()) + 1)
+  for arm_id, data in samples.items():
+    probabilities[arm_id] = len(data['failure']) / (len(data['success']) + len(data['failure']))
+  return probabilities
 
-  margin = 0  # inch
-  scale = 4
 
-  plt.xlim(left=margin)
-  plt.ylim(bottom=margin)
+# what a heatmap shows: the failure probability of every arm, the (x, y) of the successful and
+# failed task instances, and the (x, y) of the demonstrations
+def heatmap_data(arms, demontrations, samples):
+  success = np.concatenate([samples[arm_id]['success'] for arm_id in arms])[:, :, :2].reshape(-1, 2)
+  failure = np.concatenate([samples[arm_id]['failure'] for arm_id in arms])[:, :, :2].reshape(-1, 2)
+  demo_positions = np.array([utils.object_position(demo) for demo in demontrations]).reshape(-1, 2)
+  return failure_probabilities(samples), success, failure, demo_positions
 
-  plt.rcParams.update({
-    'text.usetex': config.USE_LATEX_IMAGE,
-    'font.size': 10 * scale,  # Use 10pt font in plots, to match 10pt font in document
-    # 'legend.fontsize': 8 * scale,
-    'axes.titlesize': 10 * scale,
-    'axes.labelsize': 25,  #10 * scale,
-    'xtick.labelsize': 25,  #10 * scale,
-    'ytick.labelsize': 25  #10 * scale
-  })
 
-  x = list(filter(lambda d: d['name'] == 'x', dimensions))[0]
-  y = list(filter(lambda d: d['name'] == 'y', dimensions))[0]
-  zz = np.empty((y['n_segments'], x['n_segments']))
-  x, y = (
-    np.linspace(x['min'], x['max'], x['n_segments'] + 1),
-    np.linspace(y['min'], y['max'], y['n_segments'] + 1)
-  )
+class HeatmapFigure:
+  # the figure of plot_heatmap built once, every round `update` only replaces the mesh colors,
+  # the scatter offsets, the demonstration labels and the colorbar;
+  # without `usetex` the labels are rendered by mathtext and only the PNG is written
 
-  epsilon = 1e-10
-  for j in range(len(y) - 1):
-    for i in range(len(x) - 1):
-      segment = ((x[i], x[i + 1]), (y[j], y[j + 1]), (0, 0))
-      for arm_id, arm in arms.items():
-        if all(abs(s1[0] - s2[0]) < epsilon for s1, s2 in zip(arm['segment'], segment)):
-          zz[j, i] = len(samples[arm_id]['failure']) / (len(samples[arm_id]['success']) + len(samples[arm_id]['failure']))
-          break
+  margin = 0  # inch
+  scale = 4
 
-  xx, yy = np.meshgrid(x, y)
+  def __init__(self, dimensions, n_objects, usetex=None):
+    usetex = self.usetex = config.USE_LATEX_IMAGE if usetex is None else usetex
+    scale = self.scale
+    plt.rcParams.update({
+      'text.usetex': usetex,
+      'font.size': 10 * scale,  # Use 10pt font in plots, to match 10pt font in document
+      # 'legend.fontsize': 8 * scale,
+      'axes.titlesize': 10 * scale,
+      'axes.labelsize': 25,  #10 * scale,
+      'xtick.labelsize': 25,  #10 * scale,
+      'ytick.labelsize': 25  #10 * scale
+    })
+
+    grid = utils.ArmGrid(dimensions, n_objects)
+    x, y = grid.edges[grid.dimension_index('x')], grid.edges[grid.dimension_index('y')]
+    self.arm_ids = grid.xy_arm_ids()
+
+    xx, yy = np.meshgrid(x, y)
+
+    self.fig, self.ax = plt.subplots()
+    ax = self.ax
+
+    self.fig.set_facecolor((1, 1, 1, 0))
+    ax.set_facecolor((1, 1, 1, 0))
+
+    self.heatmap_cmap = plt.get_cmap('binary')
+
+    self.mesh = ax.pcolormesh(xx, yy, np.zeros(self.arm_ids.shape), cmap=self.heatmap_cmap, vmin=0, vmax=1)
+
+    ax.axis([xx.min(), xx.max(), yy.min(), yy.max()])
+
+    ax.set_xticks(x, [rf'${n:.2f}$' for n in x], rotation=30)
+    ax.set_yticks(y, [rf'${n:.2f}$' for n in y])
+
+    ax.set_xlabel(r'$x$', labelpad=0)
+    ax.set_ylabel(r'$y$', labelpad=0)
+
+    self.subplotspec = ax.get_subplotspec()
+    self.cbar = None
+
+    self.success = ax.scatter(np.empty(0), np.empty(0), s=0.4 * scale, c='green')
+    self.failure = ax.scatter(np.empty(0), np.empty(0), s=0.4 * scale, c='red')
+    self.demos = ax.scatter(np.empty(0), np.empty(0), s=100 * scale, c='black')
+    self.annotations = []
+
+  def update(self, probabilities, success, failure, demo_positions):
+    zz = probabilities[self.arm_ids]
+    self.mesh.set_array(zz.ravel())
 
-  fig, ax = plt.subplots()
+    # the colorbar is truncated at the highest probability, removing it gives its space back to the axes
+    if self.cbar is not None:
+      self.cbar.remove()
+      self.ax.set_subplotspec(self.subplotspec)
+    heatmap_cmap, vmax = self.heatmap_cmap, np.abs(zz).max()
+    self.cbar = self.fig.colorbar(
+      mappable=matplotlib.cm.ScalarMappable(
+        norm=matplotlib.colors.Normalize(vmin=0, vmax=vmax),
+        cmap=matplotlib.colors.LinearSegmentedColormap.from_list(
+          f'trunc({heatmap_cmap.name}, 0, {vmax:.2f})',
+          heatmap_cmap(np.linspace(0, vmax, heatmap_cmap.N))
+        )
+      ),
+      ax=self.ax,
+      extend='max' if vmax < 1.0 else 'neither'
+    )
+    self.cbar.ax.set_facecolor((1, 1, 1, 0))
+    self.cbar.ax.tick_params(labelsize=25)
 
-  fig.set_facecolor((1, 1, 1, 0))
-  ax.set_facecolor((1, 1, 1, 0))
+    self.success.set_offsets(success)
+    self.failure.set_offsets(failure)
 
-  heatmap_cmap = plt.get_cmap('binary')
+    for annotation in self.annotations:
+      annotation.remove()
+    self.annotations = [
+      self.ax.annotate(rf'${str(i+1)}$', (x, y), xytext=(x, y), textcoords='offset points', ha='center', va='center', color='white', fontsize=10 * self.scale)
+      for i, (x, y) in enumerate(demo_positions)
+    ]
+    self.demos.set_offsets(demo_positions)
 
-  ax.pcolormesh(xx, yy, zz, cmap=heatmap_cmap, vmin=0, vmax=1)
+  def save(self, output_directory, n_arms, n_demontrations):
+    self.fig.savefig(f'{output_directory}/heatmap_{n_arms}_{n_demontrations}.png', bbox_inches='tight', pad_inches=self.margin)
+    if self.usetex:
+      self.fig.savefig(f'{output_directory}/heatmap_{n_arms}_{n_demontrations}.pgf', bbox_inches='tight', pad_inches=self.margin)
 
-  ax.axis([xx.min(), xx.max(), yy.min(), yy.max()])
+  def close(self):
+    plt.close(self.fig)
 
-  ax.set_xticks(x, [rf'${n:.2f}$' for n in x], rotation=30)
-  ax.set_yticks(y, [rf'${n:.2f}$' for n in y])
 
-  ax.set_xlabel(r'$x$', labelpad=0)
-  ax.set_ylabel(r'$y$', labelpad=0)
+@metrics.timed('plot_heatmap')
+def plot_heatmap(dimensions, n_objects, arms, demontrations, samples, output_directory, usetex=None):
+  figure = HeatmapFigure(dimensions, n_objects, usetex)
+  figure.update(*heatmap_data(arms, demontrations, samples))
+  figure.save(output_directory, len(arms), len(demontrations))
+  figure.close()
 
-  cbar = plt.colorbar(
-    mappable=matplotlib.cm.ScalarMappable(
-      norm=matplotlib.colors.Normalize(vmin=0, vmax=np.abs(zz).max()),
-      cmap=matplotlib.colors.LinearSegmentedColormap.from_list(
-        f'trunc({heatmap_cmap.name}, 0, {np.abs(zz).max():.2f})',
-        heatmap_cmap(np.linspace(0, np.abs(zz).max(), heatmap_cmap.N))
-      )
-    ),
-    ax=ax,
-    extend='max' if np.abs(zz).max() < 1.0 else 'neither'
-  )
-  cbar.ax.tick_params()
-  cbar.ax.set_facecolor((1, 1, 1, 0))
-  cbar.ax.tick_params(labelsize=25)
 
-  success, failure = np.empty((0, n_objects, len(dimensions))), np.empty((0, n_objects, len(dimensions)))
-  for arm_id, arm in arms.items():
-    success = np.vstack((success, samples[arm_id]['success']))
-    failure = np.vstack((failure, samples[arm_id]['failure']))
-  success, failure = success[:, :, :2], failure[:, :, :2]
+def render_heatmaps(jobs, dimensions, n_objects, usetex):
+  figure = HeatmapFigure(dimensions, n_objects, usetex)
+  while True:
+    job = jobs.get()
+    if job is None:
+      break
+    data, (output_directory, n_arms, n_demontrations) = job
+    try:
+      figure.update(*data)
+      figure.save(output_directory, n_arms, n_demontrations)
+    except Exception:
+      traceback.print_exc()
+  figure.close()
 
-  plt.scatter(success[:, :, 0], success[:, :, 1], s=0.4 * scale, c='green')
-  plt.scatter(failure[:, :, 0], failure[:, :, 1], s=0.4 * scale, c='red')
 
-  demo_x, demo_y = [], []
-  for i, demo in enumerate(demontrations):
-    f = open(demo['object_poses_file'], newline='')
-    x, y = [float(row[-1]) for row in csv.reader(f, delimiter=',')][:2]
-    f.close()
-    demo_x.append(x)
-    demo_y.append(y)
-    plt.annotate(rf'${str(i+1)}$', (x, y), xytext=(x, y), textcoords='offset points', ha='center', va='center', color='white', fontsize=10 * scale)
+class HeatmapRenderer:
+  # renders the heatmap of every round in a background process that keeps one HeatmapFigure alive,
+  # `submit` only hands over the data so that the caller never waits on matplotlib,
+  # `close` (or leaving the with block) waits for the submitted heatmaps to be written
 
-    # if demo['score'] != -1:
-    #   plt.annotate(rf'${demo["score"]:.4f}$', (x, y), xytext=(x, y-10), textcoords='offset points', ha='center', va='top', color='black', fontsize=9 * scale)
+  def __init__(self, dimensions, n_objects, output_directory, usetex=None):
+    usetex = config.USE_LATEX_IMAGE and not config.FAST_PLOTS if usetex is None else usetex
+    self.output_directory = output_directory
+    context = multiprocessing.get_context('spawn')
+    self.jobs = context.Queue()
+    self.process = context.Process(target=render_heatmaps, args=(self.jobs, dimensions, n_objects, usetex), daemon=True)
+    self.process.start()
 
-  plt.scatter(demo_x, demo_y, s=100 * scale, c='black')
+  def __enter__(self):
+    return self
 
-  plt.savefig(f'{output_directory}/heatmap_{len(arms)}_{len(demontrations)}.png', bbox_inches='tight', pad_inches=margin)
-  if config.USE_LATEX_IMAGE:
-    plt.savefig(f'{output_directory}/heatmap_{len(arms)}_{len(demontrations)}.pgf', bbox_inches='tight', pad_inches=margin)
-  plt.close()
+  def __exit__(self, *exc_info):
+    self.close()
+
+  @metrics.timed('submit_heatmap')
+  def submit(self, arms, demontrations, samples):
+    self.jobs.put((heatmap_data(arms, demontrations, samples), (self.output_directory, len(arms), len(demontrations))))
+
+  def close(self):
+    if self.process is not None:
+      self.jobs.put(None)
+      self.process.join()
+      self.process = None
 
 
 
@@ -132,23 +201,9 @@ def plot_heatmap_for_video(dimensions, n_objects, arms, demontrations, samples,
     'ytick.labelsize': 25  #10 * scale
   })
 
-  x = list(filter(lambda d: d['name'] == 'x', dimensions))[0]
-  y = list(filter(lambda d: d['name'] == 'y', dimensions))[0]
-  zz = np.empty((y['n_segments'], x['n_segments']))
-  x, y = (
-    np.linspace(x['min'], x['max'], x['n_segments'] + 1),
-    np.linspace(y['min'], y['max'], y['n_segments'] + 1)
-  )
-
-
-  epsilon = 1e-10
-  for j in range(len(y) - 1):
-    for i in range(len(x) - 1):
-      segment = ((x[i], x[i + 1]), (y[j], y[j + 1]), (0, 0))
-      for arm_id, arm in arms.items():
-        if all(abs(s1[0] - s2[0]) < epsilon for s1, s2 in zip(arm['segment'], segment)):
-          zz[j, i] = len(samples[arm_id]['failure']) / (len(samples[arm_id]['success']) + len(samples[arm_id]['failure']))
-          break
+  grid = utils.ArmGrid(dimensions, n_objects)
+  x, y = grid.edges[grid.dimension_index('x')], grid.edges[grid.dimension_index('y')]
+  zz = failure_probabilities(samples)[grid.xy_arm_ids()]
 
   xx, yy = np.meshgrid(x, y)
 
@@ -209,9 +264,7 @@ def plot_heatmap_for_video(dimensions, n_objects, arms, demontrations, samples,
 
   demo_x, demo_y = [], []
   for i, demo in enumerate(demontrations):
-    f = open(demo['object_poses_file'], newline='')
-    x, y = [float(row[-1]) for row in csv.reader(f, delimiter=',')][:2]
-    f.close()
+    x, y = utils.object_position(demo)
     demo_x.append(x)
     demo_y.append(y)
     ax.annotate(rf'${str(i+1)}$', (x, y), xytext=(x, y), textcoords='offset points', ha='center', va='center', color='white', fontsize=16 * scale, rotation=-90)
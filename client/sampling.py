@@ -0,0 +1,138 @@
+import warnings
+import numpy as np
+
+from client import config
+
+
+# the dimensions of a task instance, in the order of the demonstrations' config.json
+DIMENSION_NAMES = ('x', 'y', 'θ')
+
+POSE_DIMENSIONS = {'x', 'y', 'z', 'θ', 'theta'}
+
+
+
+
+def uniform_task_instances(segment, n_objects, n_dimensions, n_task_instances):
+  low, high = zip(*segment)
+  return np.random.uniform(
+    low=low, high=high,
+    size=(n_task_instances, len(low))
+  ).reshape(n_task_instances, n_objects, n_dimensions)
+
+
+def primes(n):
+  found = []
+  candidate = 2
+  while len(found) < n:
+    if all(candidate % p for p in found):
+      found.append(candidate)
+    candidate += 1
+  return found
+
+
+# the points below are in the unit cube [0, 1)^n_dimensions, every point on its own is uniformly
+# distributed (so the failure rate of an arm stays an unbiased estimate) but together they cover the
+# cube more evenly than independent ones, drawing all their randomness from `rng`
+
+# Halton sequence with an independent random permutation of the digits at every position (and a
+# uniform offset below the last one), in base of the k-th prime for the k-th dimension
+def scrambled_halton_points(n_points, n_dimensions, rng):
+  points = np.empty((n_points, n_dimensions))
+  for k, base in enumerate(primes(n_dimensions)):
+    digits, value, scale = np.arange(n_points), np.zeros(n_points), 1.0
+    for _ in range(int(np.ceil(np.log(n_points + 1) / np.log(base))) + 1):
+      scale /= base
+      value += rng.permutation(base)[digits % base] * scale
+      digits //= base
+    points[:, k] = value + rng.uniform(0, scale, n_points)
+  return points
+
+
+# scrambled Sobol sequence, needs scipy
+def sobol_points(n_points, n_dimensions, rng):
+  try:
+    from scipy.stats import qmc
+  except ImportError:
+    raise ImportError('the sobol sampler needs scipy, use the halton sampler instead') from None
+  with warnings.catch_warnings():
+    warnings.simplefilter('ignore', UserWarning)  # about n_points not being a power of 2
+    return qmc.Sobol(n_dimensions, scramble=True, seed=rng).random(n_points)
+
+
+# Latin hypercube: in every dimension each of the n_points equal slices holds exactly one point
+def latin_hypercube_points(n_points, n_dimensions, rng):
+  slices = np.stack([rng.permutation(n_points) for _ in range(n_dimensions)], axis=1)
+  return (slices + rng.uniform(size=(n_points, n_dimensions))) / n_points
+
+
+# a point uniformly within each cell of a grid of n_cells^n_dimensions ≤ n_points equal cells,
+# the points left over go to distinct cells picked at random
+def stratified_points(n_points, n_dimensions, rng):
+  n_cells = max(int(np.floor(n_points ** (1 / n_dimensions) + 1e-9)), 1)
+  cells = np.stack(np.unravel_index(np.arange(n_cells ** n_dimensions), (n_cells,) * n_dimensions), axis=1)
+  cells = np.concatenate((
+    np.tile(cells, (n_points // len(cells), 1)),
+    cells[rng.choice(len(cells), n_points % len(cells), replace=False)]
+  ))
+  return rng.permutation((cells + rng.uniform(size=cells.shape)) / n_cells)
+
+
+SAMPLERS = {
+  'halton': scrambled_halton_points,
+  'sobol': sobol_points,
+  'lhs': latin_hypercube_points,
+  'stratified': stratified_points,
+}
+
+
+# task instances of an arm's segment drawn by one of SAMPLERS, or independently with 'uniform',
+# deterministic given np.random.seed (the other samplers are seeded from it as well), the points
+# are only spread over the dimensions of the segment that are not a single value
+def sample_task_instances(segment, n_objects, n_dimensions, n_task_instances, sampler='uniform'):
+  if sampler == 'uniform':
+    return uniform_task_instances(segment, n_objects, n_dimensions, n_task_instances)
+  if sampler not in SAMPLERS:
+    raise ValueError(f'unknown task instance sampler {sampler}, expected uniform or one of {", ".join(SAMPLERS)}')
+  low, high = (np.asarray(bounds, dtype=float) for bounds in zip(*segment))
+  varying = high > low
+  rng = np.random.default_rng(np.random.randint(2**31))
+  task_instances = np.tile(low, (n_task_instances, 1))
+  if np.any(varying):
+    points = SAMPLERS[sampler](n_task_instances, int(np.sum(varying)), rng)
+    task_instances[:, varying] += points * (high - low)[varying]
+  return task_instances.reshape(n_task_instances, n_objects, n_dimensions)
+
+
+# lifts task instances of shape (..., n_dimensions) to poses of shape (..., 4, 4) in one pass,
+# the coordinates are looked up by the name of their dimension
+#
+#   (x, y, θ) -> | cos(θ)  -sin(θ)  0  x |
+#                | sin(θ)   cos(θ)  0  y |
+#                |      0        0  1  z |
+#                |      0        0  0  1 |
+#
+# a missing x, y or θ is 0 and a missing z is the height of the objects in config.OBJECT_Z,
+# the poses are a contiguous little-endian buffer which the planner request is encoded from as is
+def to_SE3(task_instances, dimension_names=DIMENSION_NAMES):
+  task_instances = np.asarray(task_instances, dtype=float)
+  if task_instances.shape[-1] != len(dimension_names):
+    raise ValueError(f'task instances have {task_instances.shape[-1]} dimensions, expected {len(dimension_names)}')
+  unknown_names = set(dimension_names) - POSE_DIMENSIONS
+  if unknown_names:
+    raise ValueError(f'unknown pose dimensions: {", ".join(sorted(unknown_names))}')
+
+  coordinates = {'θ' if name == 'theta' else name: task_instances[..., i] for i, name in enumerate(dimension_names)}
+  theta = coordinates.get('θ', 0.0)
+  cos, sin = np.cos(theta), np.sin(theta)
+
+  poses = np.zeros(task_instances.shape[:-1] + (4, 4), dtype='<f8')
+  poses[..., 0, 0] = cos
+  poses[..., 0, 1] = -sin
+  poses[..., 1, 0] = sin
+  poses[..., 1, 1] = cos
+  poses[..., 2, 2] = 1
+  poses[..., 3, 3] = 1
+  poses[..., 0, 3] = coordinates.get('x', 0.0)
+  poses[..., 1, 3] = coordinates.get('y', 0.0)
+  poses[..., 2, 3] = coordinates.get('z', config.OBJECT_Z)
+  return poses
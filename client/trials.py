@@ -0,0 +1,129 @@
+import os
+import json
+import time
+import zlib
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from client import planner
+
+
+# runs independent trials (e.g. one self-evaluation each) across a pool of processes,
+# every finished trial is appended as one JSON line to a log, which is also how a sweep resumes
+#
+#   {"key": "16", "trial": 3, "seed": 1234, "result": {...}, "planner_calls": 5120, "seconds": 12.5}
+#
+# a trial gets its own seed derived from (seed, key, trial), so it gives the same result whichever
+# worker runs it and whenever, and a trial returning None (e.g. out of demonstrations) is logged
+# but does not count towards the number of trials of its key
+
+
+
+
+def trial_seed(seed, key, trial):
+  return int(np.random.SeedSequence([seed, zlib.crc32(str(key).encode()), trial]).generate_state(1)[0])
+
+
+def read_log(log_file):
+  records = []
+  if not os.path.exists(log_file):
+    return records
+  with open(log_file, 'r') as f:
+    for line in f:
+      try:
+        records.append(json.loads(line))
+      except json.JSONDecodeError:
+        pass  # the last line of an interrupted sweep
+  return records
+
+
+# results of the completed trials of every key
+def load_results(log_file):
+  results = {}
+  for record in read_log(log_file):
+    if record['result'] is not None:
+      results.setdefault(record['key'], []).append(record['result'])
+  return results
+
+
+class TrialLog:
+  # append-only, each record is a single write to a file opened with O_APPEND
+
+  def __init__(self, log_file):
+    self.fd = os.open(log_file, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+    size = os.lseek(self.fd, 0, os.SEEK_END)
+    if size > 0 and os.pread(self.fd, 1, size - 1) != b'\n':
+      os.write(self.fd, b'\n')  # terminate a line cut short by an interrupted sweep
+
+  def append(self, record):
+    os.write(self.fd, (json.dumps(record) + '\n').encode())
+
+  def close(self):
+    os.close(self.fd)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+
+def run_trial(trial, key, index, seed):
+  np.random.seed(seed)
+  planner_calls, start = planner.planner_calls, time.time()
+  result = trial(key, seed)
+  return {
+    'key': key,
+    'trial': index,
+    'seed': seed,
+    'result': result,
+    'planner_calls': planner.planner_calls - planner_calls,
+    'seconds': time.time() - start
+  }
+
+
+# runs `trial(key, seed)` until each key has `n_trials` results in `log_file`, `trial` must be
+# picklable (a module level function) and returns a JSON serializable result or None
+def run_trials(log_file, keys, n_trials, trial, seed=0, n_workers=None):
+  records = read_log(log_file)
+  logged = {key: {r['trial'] for r in records if r['key'] == key} for key in keys}
+  n_remaining = {key: n_trials - sum(r['result'] is not None for r in records if r['key'] == key) for key in keys}
+  next_index = {key: 0 for key in keys}
+
+  def next_trial(key):
+    while next_index[key] in logged[key]:
+      next_index[key] += 1
+    next_index[key] += 1
+    return next_index[key] - 1
+
+  n_workers = n_workers or os.cpu_count()
+  n_done, n_planner_calls, start = 0, 0, time.time()
+  with TrialLog(log_file) as log, ProcessPoolExecutor(max_workers=n_workers) as pool:
+    pending = {}
+    def submit():
+      for key in keys:
+        n_running = sum(k == key for k in pending.values())
+        while n_remaining[key] - n_running > 0 and len(pending) < 2 * n_workers:
+          index = next_trial(key)
+          pending[pool.submit(run_trial, trial, key, index, trial_seed(seed, key, index))] = key
+          n_running += 1
+
+    submit()
+    while pending:
+      finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+      for future in finished:
+        key = pending.pop(future)
+        record = future.result()
+        log.append(record)
+        n_remaining[key] -= record['result'] is not None
+        n_done += 1
+        n_planner_calls += record['planner_calls']
+        minutes = (time.time() - start) / 60
+        print(
+          f'[{key}] trial #{record["trial"]} in {record["seconds"]:.1f}s, {max(n_remaining[key], 0)} left | '
+          f'{n_done / minutes:.1f} trials/min, {n_planner_calls / n_done:.0f} planner calls/trial'
+        )
+      submit()
+
+  return load_results(log_file)
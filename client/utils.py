@@ -1,18 +1,13 @@
 import os
-import csv
+import copy
 import math
 import json
-import itertools
 import numpy as np
 
-from client import config
+from client import config, sampling
 
 def to_SE3(pose):
-  x, y, theta = pose
-  return np.array([[math.cos(theta), -math.sin(theta), 0,                    x],
-                   [math.sin(theta),  math.cos(theta), 0,                    y],
-                   [              0,                0, 1, -0.06447185171756116],
-                   [              0,                0, 0,                    1]])
+  return sampling.to_SE3(pose)
 
 
 def calculate_plan_score(limits, plan):
@@ -23,18 +18,170 @@ def calculate_plan_score(limits, plan):
   return plan_score
 
 
+# parses a CSV of numbers once and keeps it as a .npy sidecar next to it (e.g. joint_angles.csv.npy),
+# which is memory-mapped by the following loads (and by the planner) until the CSV is modified
+def load_csv(csv_file, skip_header=False):
+  sidecar_file = f'{csv_file}.npy'
+  try:
+    if os.stat(sidecar_file).st_mtime_ns >= os.stat(csv_file).st_mtime_ns:
+      return np.load(sidecar_file, mmap_mode='r')
+  except (OSError, ValueError):
+    pass  # no sidecar yet, or a truncated one
+
+  values = np.loadtxt(csv_file, delimiter=',', skiprows=1 if skip_header else 0, ndmin=2, dtype='<f8')
+  temporary_file = f'{sidecar_file}.{os.getpid()}'
+  try:
+    with open(temporary_file, 'wb') as f:
+      np.save(f, values)
+    os.replace(temporary_file, sidecar_file)
+  except OSError:
+    if os.path.exists(temporary_file):
+      os.remove(temporary_file)
+  return values
+
+
+def read_object_position(object_poses_file):
+  return np.array(load_csv(object_poses_file)[:2, -1])
+
+
+# the (x, y) position of the object of a demonstration, parsed once by process_demos
+def object_position(demo):
+  if 'position' not in demo:
+    demo['position'] = read_object_position(demo['object_poses_file'])
+  return demo['position']
+
+
 def distance_of_demo(x, y, demo):
-  demo['object_poses_file']
-  f = open(demo['object_poses_file'], newline='')
-  demo_x, demo_y = [float(row[-1]) for row in csv.reader(f, delimiter=',')][:2]
-  f.close()
+  demo_x, demo_y = object_position(demo)
   return math.sqrt((x - demo_x)**2 + (y - demo_y)**2)
 
 
+# the positions of the demonstrations and the arms they belong to, in arrays,
+# so that finding the nearest available demonstration (within an arm or globally) is a single
+# vectorized query, a handful of demonstrations does not need anything like a KD-tree
+class DemoIndex:
+  def __init__(self, demonstrations, arm_ids):
+    self.demonstrations = list(demonstrations)
+    self.positions = np.array([object_position(demo) for demo in self.demonstrations]).reshape(-1, 2)
+    self.arm_ids = np.asarray(arm_ids, dtype=int)
+    self.available = np.ones(len(self.demonstrations), dtype=bool)
+
+  @classmethod
+  def from_arms(cls, arms):
+    demonstrations, arm_ids = [], []
+    for arm_id, arm in arms.items():
+      demonstrations += arm['demos']
+      arm_ids += [arm_id] * len(arm['demos'])
+    return cls(demonstrations, arm_ids)
+
+  def copy(self):
+    demo_index = copy.copy(self)
+    demo_index.available = self.available.copy()
+    return demo_index
+
+  def __len__(self):
+    return int(np.count_nonzero(self.available))
+
+  def count(self, arm_id=None):
+    return int(np.count_nonzero(self.available if arm_id is None else self.available & (self.arm_ids == arm_id)))
+
+  # index of the available demonstration nearest to (x, y), within `arm_id` if given, or None
+  def nearest(self, x, y, arm_id=None):
+    candidates = self.available if arm_id is None else self.available & (self.arm_ids == arm_id)
+    if not candidates.any():
+      return None
+    distances = np.hypot(self.positions[:, 0] - x, self.positions[:, 1] - y)
+    return int(np.argmin(np.where(candidates, distances, np.inf)))
+
+  def remove(self, index):
+    self.available[index] = False
+
+
+# the bandit arms are the cells of a grid over the dimensions of every object, numbered from 1 in
+# the order of itertools.product over the segments of each dimension (the last one varies fastest),
+# so a point is mapped to its arm by integer arithmetic on the linspace edges instead of a scan
+class ArmGrid:
+  def __init__(self, dimensions, n_objects):
+    self.names = [d['name'] for d in dimensions]
+    self.n_objects = n_objects
+    self.edges = [np.linspace(d['min'], d['max'], d['n_segments'] + 1) for d in dimensions]
+    self.shape = tuple(d['n_segments'] for d in dimensions) * n_objects
+
+  def __len__(self):
+    return math.prod(self.shape)
+
+  def dimension_index(self, name):
+    return self.names.index(name)
+
+  # arm ids of points of shape (..., n_objects, n_dimensions), a point lying on an edge belongs
+  # to the lower segment and a point outside of the grid to no arm (0)
+  def arm_ids(self, points):
+    points = np.asarray(points, dtype=float)
+    indices, inside = [], np.ones(points.shape[:-2], dtype=bool)
+    for i in range(self.n_objects):
+      for edges, values in zip(self.edges, np.moveaxis(points[..., i, :], -1, 0)):
+        n_segments = len(edges) - 1
+        width = edges[-1] - edges[0]
+        index = np.zeros(values.shape, dtype=int) if width == 0 else np.clip(
+          np.floor((values - edges[0]) / width * n_segments).astype(int), 0, n_segments - 1
+        )
+        index -= (index > 0) & (values <= edges[index])  # round-off at the edges
+        index += (index < n_segments - 1) & (values > edges[index + 1])
+        inside &= (edges[0] <= values) & (values <= edges[-1])
+        indices.append(index)
+    return np.where(inside, 1 + np.ravel_multi_index(indices, self.shape), 0)
+
+  def cell(self, arm_id):
+    return np.unravel_index(arm_id - 1, self.shape)
+
+  def segment(self, arm_id):
+    n_dimensions = len(self.edges)
+    return tuple(
+      (self.edges[d % n_dimensions][i], self.edges[d % n_dimensions][i + 1]) for d, i in enumerate(self.cell(arm_id))
+    )
+
+  def center(self, arm_id):
+    return np.array([sum(bounds) / 2.0 for bounds in self.segment(arm_id)]).reshape(self.n_objects, len(self.edges))
+
+  # the (x, y) position of the first object of points of shape (..., n_objects, n_dimensions)
+  def xy(self, points):
+    points = np.asarray(points)
+    return points[..., 0, self.dimension_index('x')], points[..., 0, self.dimension_index('y')]
+
+  # arm ids of the x/y cells of the first object with every other dimension in its first segment,
+  # laid out as a (y segments, x segments) heatmap
+  def xy_arm_ids(self):
+    x, y = self.dimension_index('x'), self.dimension_index('y')
+    yy, xx = np.meshgrid(np.arange(self.shape[y]), np.arange(self.shape[x]), indexing='ij')
+    indices = [np.zeros_like(xx)] * len(self.shape)
+    indices[x], indices[y] = xx, yy
+    return 1 + np.ravel_multi_index(indices, self.shape)
+
+
+# assigns every demonstration to the arm of its object's (x, y) position
+def make_bandit_arms(grid, demonstrations):
+  bandit_arms = {arm_id: {'segment': grid.segment(arm_id), 'demos': []} for arm_id in range(1, len(grid) + 1)}
+
+  points = np.array([[edges[0] for edges in grid.edges]] * grid.n_objects)[np.newaxis].repeat(len(demonstrations), axis=0)
+  points[:, 0, [grid.dimension_index('x'), grid.dimension_index('y')]] = [object_position(demo) for demo in demonstrations]
+  for demo, arm_id in zip(demonstrations, grid.arm_ids(points)):
+    if arm_id:
+      bandit_arms[arm_id]['demos'].append(demo)
+
+  return bandit_arms
+
+
+# radius of the sphere around the object, in multiples of the minimum distance between object and guiding pose
+def read_region_of_interest(region_of_interest_file, default=1.5):
+  if not os.path.isfile(region_of_interest_file):
+    return default
+  with open(region_of_interest_file, 'r') as f:
+    return float(f.read())
+
+
 def process_demos(demo_path):
-  config_file = open(f'{demo_path}/config.json', 'r')
-  config_dict = json.loads(config_file.read())
-  config_file.close()
+  with open(f'{demo_path}/config.json', 'r') as config_file:
+    config_dict = json.loads(config_file.read())
 
   dimensions = config_dict['dimensions']
   '''
@@ -62,38 +209,20 @@ def process_demos(demo_path):
       'object_poses_file': f'{f}/object_poses.csv',
       'score': calculate_plan_score(
         config.JOINT_LIMITS,
-        np.array([row[1:8] for row in csv.reader(open(f'{f}/joint_angles.csv', newline=''), delimiter=',')][1:], dtype=float)
+        load_csv(f'{f}/joint_angles.csv', skip_header=True)[:, 1:8]
       ) if os.path.isfile(f'{f}/joint_angles.csv') else -1,
-      'region_of_interest': float(open(f'{f}/region_of_interest.txt', 'r').read())
-                            if os.path.isfile(f'{f}/region_of_interest.txt')
-                            else 1.5  # sphere of radius equals to 1.5 times the minimum distance between object and guiding pose
+      'region_of_interest': read_region_of_interest(f'{f}/region_of_interest.txt')
     } for f in sorted([
       os.path.join(demo_path, f) for f in os.listdir(demo_path)
       if not os.path.isfile(os.path.join(demo_path, f))
     ])
   ]
 
-  intervals = (
-    [(interval[i], interval[i + 1]) for i in range(dimension['n_segments'])]
-    for interval, dimension in zip(
-      (np.linspace(d['min'], d['max'], d['n_segments'] + 1) for d in dimensions), dimensions
-    )
-  )
-
-  segments = itertools.product(*intervals, repeat=n_objects)
+  for demo in demonstrations:
+    demo['position'] = read_object_position(demo['object_poses_file'])
 
-  bandit_arms = {(i + 1): {'segment': segment, 'demos': []} for i, segment in enumerate(segments)}
+  bandit_arms = make_bandit_arms(ArmGrid(dimensions, n_objects), demonstrations)
 
   # arm ∈ [1, (d1 * d2 * d3)**n_objects]
 
-  for demo in demonstrations:
-    f = open(demo['object_poses_file'], newline='')
-    x, y = [float(row[-1]) for row in csv.reader(f, delimiter=',')][:2]
-    f.close()
-    for arm in bandit_arms.values():
-      (x_min, x_max), (y_min, y_max), _ = arm['segment']
-      if (x_min <= x <= x_max) and (y_min <= y <= y_max):
-        arm['demos'].append(demo)
-        break
-
-  return dimensions, initial_joint_config, n_objects, demonstrations, bandit_arms
\ No newline at end of file
+  return dimensions, initial_joint_config, n_objects, demonstrations, bandit_arms, DemoIndex.from_arms(bandit_arms)
\ No newline at end of file
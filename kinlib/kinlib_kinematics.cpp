@@ -602,7 +602,8 @@ ErrorCodes KinematicsSolver::getResolvedMotionRateControlStep(
 
 MotionPlanResult::MotionPlanResult() :
   result(MotionPlanReturnCodes::UNKNOWN),
-  joint_id(0)
+  joint_id(0),
+  n_iterations(0)
 {
 
 }
@@ -737,6 +738,7 @@ ErrorCodes KinematicsSolver::getMotionPlan(
     */
 
     itr_cnt++;
+    plan_result.n_iterations = itr_cnt;
 
     step_size = beta;
 
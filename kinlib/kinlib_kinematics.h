@@ -206,6 +206,7 @@ struct MotionPlanResult
 
   MotionPlanReturnCodes result;
   unsigned int joint_id;
+  unsigned long int n_iterations;
 };
 
 class KinematicsSolver
@@ -2,20 +2,46 @@
 
 #ifdef __APPLE__
   #include <libkern/OSByteOrder.h>
-  #define htobe64(x) OSSwapHostToBigInt64(x)
-  #define be64toh(x) OSSwapBigToHostInt64(x)
+  #define htole16(x) OSSwapHostToLittleInt16(x)
+  #define le16toh(x) OSSwapLittleToHostInt16(x)
+  #define htole32(x) OSSwapHostToLittleInt32(x)
+  #define le32toh(x) OSSwapLittleToHostInt32(x)
+  #define htole64(x) OSSwapHostToLittleInt64(x)
+  #define le64toh(x) OSSwapLittleToHostInt64(x)
+  #define MSG_NOSIGNAL 0
+  #define st_mtim st_mtimespec
+#else
+  #include <endian.h>
 #endif
 
+#include <list>
+#include <deque>
+#include <algorithm>
+#include <atomic>
+#include <chrono>
 #include <array>
+#include <mutex>
+#include <memory>
+#include <condition_variable>
+#include <string>
 #include <thread>
+#include <vector>
+#include <unordered_map>
+#include <sstream>
+#include <cstdint>
+#include <stdexcept>
 #include <cstdio>
 #include <cstdlib>
 #include <cstring>
 #include <fstream>
 #include <cstdbool>
 #include <iostream>
+#include <poll.h>
 #include <unistd.h>
+#include <fcntl.h>
 #include <sys/un.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
 #include <pthread.h>
 #include <netinet/in.h>
 #include <sys/socket.h>
@@ -25,11 +51,71 @@
 
 
 int N_THREADS;
+size_t DEMO_CACHE_CAPACITY = 64;
+size_t MAX_IN_FLIGHT = 8192;    // task instances planned at once over all connections
+size_t MAX_WAITING = 16;        // plan requests waiting for their turn
 kinlib::KinematicsSolver kin_solver;
 
 
+// memory-maps the .npy sidecar which the client writes next to a CSV (client/utils.py load_csv),
+// there is none to use when it is missing, older than the CSV, or not a 2-D row-major '<f8' array
+bool load_npy_sidecar(const std::string &file, Eigen::MatrixXd &matrix) {
+#if __BYTE_ORDER__ != __ORDER_LITTLE_ENDIAN__
+  return false;
+#endif
+  std::string sidecar = file + ".npy";
+  struct stat csv_stat, npy_stat;
+  if (stat(file.c_str(), &csv_stat) != 0 || stat(sidecar.c_str(), &npy_stat) != 0)
+    return false;
+  if (npy_stat.st_mtim.tv_sec < csv_stat.st_mtim.tv_sec ||
+      (npy_stat.st_mtim.tv_sec == csv_stat.st_mtim.tv_sec && npy_stat.st_mtim.tv_nsec < csv_stat.st_mtim.tv_nsec))
+    return false;
+
+  int fd = open(sidecar.c_str(), O_RDONLY);
+  if (fd < 0)
+    return false;
+  size_t size = npy_stat.st_size;
+  void *mapping = size > 12 ? mmap(NULL, size, PROT_READ, MAP_PRIVATE, fd, 0) : MAP_FAILED;
+  close(fd);
+  if (mapping == MAP_FAILED)
+    return false;
+
+  // magic, version, header length (u16 in version 1, u32 afterwards), then a python dict literal
+  const char *data = (const char *) mapping;
+  bool loaded = false;
+  if (std::memcmp(data, "\x93NUMPY", 6) == 0) {
+    uint16_t header_length_16;
+    uint32_t header_length_32;
+    std::memcpy(&header_length_16, data + 8, sizeof(header_length_16));
+    std::memcpy(&header_length_32, data + 8, sizeof(header_length_32));
+    size_t header_offset = data[6] == 1 ? 10 : 12;
+    size_t data_offset = header_offset + (data[6] == 1 ? le16toh(header_length_16) : le32toh(header_length_32));
+    std::string header(data + header_offset, std::min(data_offset, size) - header_offset);
+
+    size_t rows, cols;
+    size_t shape = header.find("'shape': (");
+    if (header.find("'descr': '<f8'") != std::string::npos &&
+        header.find("'fortran_order': False") != std::string::npos &&
+        shape != std::string::npos &&
+        std::sscanf(header.c_str() + shape, "'shape': (%zu, %zu)", &rows, &cols) == 2 &&
+        data_offset + rows * cols * sizeof(double) == size) {
+      matrix = Eigen::Map<const Eigen::Matrix<double, Eigen::Dynamic, Eigen::Dynamic, Eigen::RowMajor>>(
+        (const double *) (data + data_offset), rows, cols
+      );
+      loaded = true;
+    }
+  }
+  munmap(mapping, size);
+  return loaded;
+}
+
+
 template<typename M>
 M loadCSV (const std::string &file, bool ignore_header=false) {
+  Eigen::MatrixXd sidecar;
+  if (load_npy_sidecar(file, sidecar))
+    return sidecar;
+
   std::ifstream indata;
   indata.open(file);
   std::string line;
@@ -78,58 +164,220 @@ void init_solver() {
 }
 
 
-union {
-  double f;                                                   // float
-  uint64_t i;                                                 // uint32_t for float;
-} float_buffer;
+// Wire protocol (see client/planner.py): every message is one frame, a 16 byte
+// header followed by `length` bytes of little-endian payload.
+const char PROTOCOL_MAGIC[4] = {'S', 'E', 'P', 'L'};
+const uint8_t PROTOCOL_VERSION = 1;
+// a longer frame from a client closes its connection instead of being allocated
+const uint64_t MAX_FRAME_LENGTH = 1ULL << 30;
+
+enum FrameType : uint8_t {
+  FRAME_PLAN_REQUEST = 1,
+  FRAME_PLAN_RESPONSE = 2,
+  FRAME_REGISTER_DEMOS = 3,
+  FRAME_DEMO_HANDLES = 4,
+  FRAME_STATS_REQUEST = 5,
+  FRAME_STATS = 6,
+  FRAME_PLAN_RESULT = 7,
+  FRAME_PLAN_END = 8,
+  FRAME_CANCEL = 9,
+  FRAME_PLAN_STATS = 10,
+  FRAME_BUSY = 11     // a PLAN_REQUEST turned away: u32 retry after milliseconds, u32 in flight, u32 waiting
+};
+
+// a PLAN_REQUEST with this flag is answered by PLAN_RESULT frames as task instances
+// complete, terminated by a PLAN_END frame; meanwhile the client may send CANCEL frames
+const uint16_t FLAG_STREAM = 1;
+// a PLAN_REQUEST with this flag gets a PLAN_STATS frame after its response (or PLAN_END)
+const uint16_t FLAG_STATS = 2;
+// a PLAN_REQUEST with this flag ends with u32 mode, f64 tolerance, u32 stride, see decimate
+const uint16_t FLAG_DECIMATE = 4;
+
+// which joint trajectories a plan request wants back, outcomes are always sent
+enum PlanSelection : uint32_t {
+  PLANS_ALL = 0,
+  PLANS_NONE = 1,
+  PLANS_SUCCESSFUL = 2,
+  PLANS_SUBSET = 3    // followed by the indices of the selected task instances
+};
+
+// how the joint angles of the returned plans are thinned out to waypoints
+enum DecimationMode : uint32_t {
+  DECIMATE_STRIDE = 0,      // every `stride`-th step
+  DECIMATE_JOINT = 1,       // `tolerance` in radians of every joint
+  DECIMATE_CARTESIAN = 2    // `tolerance` in meters of the end-effector position
+};
 
-void send_float(int socket_fd, double data) {                 // float      
-  float_buffer.f = data;
-  float_buffer.i = htobe64(float_buffer.i);                   // htonl for float
-  send(socket_fd, &float_buffer.i, sizeof(double), 0);        // float
-}
+typedef struct {
+  uint32_t mode;
+  double tolerance;
+  uint32_t stride;    // the most steps between two waypoints, 0 for no limit unless DECIMATE_STRIDE
+} Decimation;
 
-double recv_float(int socket_fd) {                            // float
-  recv(socket_fd, &float_buffer.i, sizeof(double), 0);        // float
-  float_buffer.i = be64toh(float_buffer.i);                   // ntohl for float
-  return float_buffer.f;
+#pragma pack(push, 1)
+typedef struct {
+  char magic[4];
+  uint8_t version;
+  uint8_t type;
+  uint16_t flags;
+  uint64_t length;
+} FrameHeader;
+#pragma pack(pop)
+
+
+bool send_all(int socket_fd, const void *data, size_t length) {
+  const char *bytes = (const char *) data;
+  while (length > 0) {
+    ssize_t n = send(socket_fd, bytes, length, MSG_NOSIGNAL);
+    if (n <= 0) return false;
+    bytes += n;
+    length -= n;
+  }
+  return true;
 }
 
-void send_int(int socket_fd, int data) {
-  send(socket_fd, &data, sizeof(int), 0);
+bool recv_all(int socket_fd, void *data, size_t length) {
+  char *bytes = (char *) data;
+  while (length > 0) {
+    ssize_t n = recv(socket_fd, bytes, length, 0);
+    if (n <= 0) return false;
+    bytes += n;
+    length -= n;
+  }
+  return true;
 }
 
-int recv_int(int socket_fd) {
-  int data;
-  recv(socket_fd, &data, 4, 0);
-  return ntohl(data);
+bool send_frame(int socket_fd, uint8_t type, const std::vector<char> &payload, uint16_t flags=0) {
+  FrameHeader header;
+  memcpy(header.magic, PROTOCOL_MAGIC, sizeof(header.magic));
+  header.version = PROTOCOL_VERSION;
+  header.type = type;
+  header.flags = htole16(flags);
+  header.length = htole64(payload.size());
+  return send_all(socket_fd, &header, sizeof(header)) && send_all(socket_fd, payload.data(), payload.size());
 }
 
-void send_bool(int socket_fd, bool data) {
-  send(socket_fd, &data, sizeof(bool), 0);
+bool recv_frame(int socket_fd, uint8_t &type, uint16_t &flags, std::vector<char> &payload) {
+  FrameHeader header;
+  if (!recv_all(socket_fd, &header, sizeof(header))) return false;
+  if (memcmp(header.magic, PROTOCOL_MAGIC, sizeof(header.magic)) != 0 || header.version != PROTOCOL_VERSION) {
+    std::cerr << "Rejecting frame with unsupported protocol version " << (int) header.version << "\n";
+    return false;
+  }
+  type = header.type;
+  flags = le16toh(header.flags);
+  uint64_t length = le64toh(header.length);
+  if (length > MAX_FRAME_LENGTH) {
+    std::cerr << "Rejecting frame of " << length << " bytes\n";
+    return false;
+  }
+  payload.resize(length);
+  return recv_all(socket_fd, payload.data(), payload.size());
 }
 
-char *recv_str(int socket_fd) {
-  int length = recv_int(socket_fd);
-  char *data = (char *) calloc(length + 1, sizeof(char));
-  recv(socket_fd, data, length, 0);
-  return data;
-}
 
-void send_plan(int socket_fd, std::vector<Eigen::VectorXd> path) {
-  send_int(socket_fd, path.size());
-  for(auto joint_angles : path) {
-    send_int(socket_fd, joint_angles.size());
-    for (int i = 0; i < joint_angles.size(); i++)
-      send_float(socket_fd, joint_angles(i));
-  }
+class PayloadWriter {
+  public:
+    std::vector<char> data;
+
+    void put_u32(uint32_t value) { value = htole32(value); append(&value, sizeof(value)); }
+    void put_i32(int32_t value) { put_u32((uint32_t) value); }
+    void put_u64(uint64_t value) { value = htole64(value); append(&value, sizeof(value)); }
+    void put_str(const std::string &value) { put_u32(value.size()); append(value.data(), value.size()); }
+    void put_f64(double value) {
+      uint64_t bits;
+      memcpy(&bits, &value, sizeof(bits));
+      put_u64(bits);
+    }
+
+  private:
+    void append(const void *bytes, size_t length) {
+      data.insert(data.end(), (const char *) bytes, (const char *) bytes + length);
+    }
+};
+
+class PayloadReader {
+  public:
+    PayloadReader(const std::vector<char> &payload) : data(payload), offset(0) {}
+
+    uint32_t get_u32() { uint32_t value; take(&value, sizeof(value)); return le32toh(value); }
+    uint64_t get_u64() { uint64_t value; take(&value, sizeof(value)); return le64toh(value); }
+    double get_f64() {
+      uint64_t bits = get_u64();
+      double value;
+      memcpy(&value, &bits, sizeof(value));
+      return value;
+    }
+    std::string get_str() {
+      uint32_t length = get_u32();
+      expect(length);
+      std::string value(length, '\0');
+      take(&value[0], length);
+      return value;
+    }
+    // a count of items of at least `item_size` bytes each, which the rest of the payload must hold
+    // before anything is allocated for them
+    uint32_t get_count(uint64_t item_size) {
+      uint32_t count = get_u32();
+      expect_items(count, item_size);
+      return count;
+    }
+    void expect_items(uint64_t count, uint64_t item_size) {
+      if (count > 0 && item_size > 0 && count > (data.size() - offset) / item_size) throw std::out_of_range("truncated payload");
+    }
+    void expect(uint64_t length) { expect_items(length, 1); }
+
+  private:
+    const std::vector<char> &data;
+    size_t offset;
+
+    void take(void *bytes, size_t length) {
+      expect(length);
+      memcpy(bytes, data.data() + offset, length);
+      offset += length;
+    }
+};
+
+
+typedef std::chrono::steady_clock Clock;
+
+uint64_t elapsed_ns(Clock::time_point since) {
+  return std::chrono::duration_cast<std::chrono::nanoseconds>(Clock::now() - since).count();
 }
 
+// Time spent in each phase of a session's requests since its last PLAN_STATS frame, the
+// planning phases are summed over the planner threads, whose own busy time is kept apart
+// to show load imbalance. Sent as
+//   u32 n_phases, (str name, u64 nanoseconds) * n_phases
+//   u32 n_counters, (str name, u64 value) * n_counters
+//   u32 n_threads, u64 busy nanoseconds * n_threads
+struct PlanStats {
+  uint64_t load_demo_ns = 0, save_demo_ns = 0, decode_ns = 0, admission_ns = 0, guiding_poses_ns = 0, motion_plan_ns = 0, encode_ns = 0, send_ns = 0, wall_ns = 0;
+  uint64_t n_motion_plans = 0, rmrc_iterations = 0, max_rmrc_iterations = 0;
+  std::vector<uint64_t> thread_busy_ns;
+
+  void write(PayloadWriter &writer) {
+    const std::pair<const char *, uint64_t> phases[] = {
+      {"load_demonstration", load_demo_ns}, {"saveDemonstration", save_demo_ns}, {"decode", decode_ns}, {"admission", admission_ns},
+      {"planMotionForNewTaskInstance", guiding_poses_ns}, {"getMotionPlan", motion_plan_ns},
+      {"encode", encode_ns}, {"send", send_ns}, {"request", wall_ns}
+    };
+    const std::pair<const char *, uint64_t> counters[] = {
+      {"motion_plans", n_motion_plans}, {"rmrc_iterations", rmrc_iterations}, {"max_rmrc_iterations", max_rmrc_iterations}
+    };
+    writer.put_u32(sizeof(phases) / sizeof(phases[0]));
+    for (auto &phase : phases) { writer.put_str(phase.first); writer.put_u64(phase.second); }
+    writer.put_u32(sizeof(counters) / sizeof(counters[0]));
+    for (auto &counter : counters) { writer.put_str(counter.first); writer.put_u64(counter.second); }
+    writer.put_u32(thread_busy_ns.size());
+    for (uint64_t busy_ns : thread_busy_ns) writer.put_u64(busy_ns);
+  }
+};
 
 typedef struct {
-  char *recorded_demo_file, *object_poses_file;
+  std::string recorded_demo_file, object_poses_file;
   double roi, score;
-  kinlib::Demonstration demo;
+  std::shared_ptr<kinlib::Demonstration> demo;
 } Demontration;
 
 typedef struct {
@@ -139,214 +387,1091 @@ typedef struct {
   int failed_screw_segment, failed_joint_id;
 } PlanInfo;
 
+// Completion and cancellation of the task instances of a streamed plan request
+struct PlanProgress {
+  std::mutex mutex;
+  std::condition_variable completed;
+  std::vector<int> completed_indices;   // completed since the last PLAN_RESULT frame
+  std::vector<char> cancelled;
+  int n_finished = 0, n_cancelled = 0;
+};
+
+// Time a planner thread spent on the attempts of one request
+typedef struct {
+  uint64_t busy_ns, guiding_poses_ns, motion_plan_ns, n_motion_plans, rmrc_iterations, max_rmrc_iterations;
+} WorkerStats;
+
+// The attempts of a request: every task instance is planned with the demonstrations in order
+// until one succeeds. Each attempt is a unit of work of the worker pool, so the attempts of one
+// task instance can run side by side; an attempt with a later demonstration than the first
+// successful one is skipped, or abandoned between two screw segments, which leaves the same
+// outcome as planning them one after another. The inputs must outlive the job.
 typedef struct {
-  Demontration *demontrations;
+  struct PlanningJob *job;
+  int task_instance, demontration;
+} WorkItem;
+
+struct PlanningJob {
+  Demontration **demontrations;
   kinlib::TaskInstance *task_instances;
   Eigen::VectorXd *init_jnt_val;
-  int n_demontrations, n_task_instances;
-  int start_index, end_index;
-  PlanInfo **plans;
-} ThreadArg;
-
-
-void *planner_thread(void *args) {
-  ThreadArg *arg = (ThreadArg *) args;
-  Demontration *demontrations = arg->demontrations;
-  kinlib::TaskInstance *task_instances = arg->task_instances;
-  Eigen::VectorXd init_jnt_val = *(arg->init_jnt_val);
-  PlanInfo **plans = arg->plans;
-  int n_demontrations = arg->n_demontrations,
-      n_task_instances = arg->n_task_instances;
-  int start_index = arg->start_index,
-      end_index = arg->end_index;
-
-  for (int i = start_index; i <= end_index; i++) {
-    for (int j = 0; j < n_demontrations; j++) {
-      Eigen::VectorXd jnt_val = init_jnt_val;
-      std::vector<Eigen::Matrix4d> guiding_poses;
-      kinlib::UserGuidedMotionPlanner::planMotionForNewTaskInstance(demontrations[j].demo, task_instances[i], guiding_poses);
-
-      int screw_segment = 0;
-      bool plan_successful = true;
-      std::vector<Eigen::VectorXd> joint_angles;
-      for (auto guiding_pose : guiding_poses) {
-        Eigen::Matrix4d init_ee_g;
-        kin_solver.getFK(jnt_val, init_ee_g);
-
-        // Get motion plan using ScLERP Planner
-        kinlib::MotionPlanResult plan_info;
-        std::vector<Eigen::VectorXd> plan_result;
-        kinlib::ErrorCodes code = kin_solver.getMotionPlan(jnt_val, init_ee_g, guiding_pose, plan_result, plan_info);
-
-        joint_angles.reserve(joint_angles.size() + distance(plan_result.begin(), plan_result.end()));
-        joint_angles.insert(joint_angles.end(), plan_result.begin(), plan_result.end());
-        
-        if (code == kinlib::ErrorCodes::OPERATION_SUCCESS) {
-          jnt_val = plan_result.back();
-          screw_segment += 1;
+  const char *keep_plans;
+  bool successful_plans_only;
+  struct PlanProgress *progress;
+  const Decimation *decimation;    // NULL to keep every step
+  int n_demontrations = 0, n_task_instances = 0;
+  PlanInfo **plans = NULL;
+
+  std::vector<std::atomic<int>> first_success;   // per task instance, n_demontrations while none succeeded
+  std::mutex mutex;
+  std::condition_variable finished;
+  std::vector<char> attempt_finished;            // n_task_instances x n_demontrations
+  std::vector<char> resolved;                    // the outcome of the task instance is known
+  int n_pending_attempts = 0;
+  std::vector<WorkerStats> worker_stats;         // per worker of the pool
+
+  std::vector<std::deque<WorkItem>> queues;      // per worker of the pool, guarded by the pool
+  size_t n_queued = 0;
+};
+
+
+bool is_valid(const Decimation &decimation) {
+  return decimation.mode <= DECIMATE_CARTESIAN && (decimation.mode != DECIMATE_STRIDE || decimation.stride > 0);
+}
+
+// Thins out the joint angles of a screw segment to waypoints, keeping its first and last step
+// (Ramer-Douglas-Peucker): the steps between two waypoints are split at the one farthest from
+// the joint angles interpolated linearly, by step index, between the waypoints, until every
+// step is within the tolerance, of its joint angles or of its end-effector position, and the
+// waypoints are at most `stride` steps apart
+// every split scans the steps between its two waypoints, so a screw segment of n steps costs
+// O(n log n) deviations when the splits fall near the middle, but O(n²) in the worst case, when
+// every split peels a single step off the end of its range
+void decimate(std::vector<Eigen::VectorXd> &steps, const Decimation &decimation) {
+  size_t n_steps = steps.size();
+  if (n_steps < 3) return;
+
+  std::vector<char> keep(n_steps, 0);
+  keep[0] = keep[n_steps - 1] = 1;
+  if (decimation.mode == DECIMATE_STRIDE) {
+    for (size_t k = 0; k < n_steps; k += decimation.stride) keep[k] = 1;
+  } else {
+    std::vector<Eigen::Vector3d> positions;
+    if (decimation.mode == DECIMATE_CARTESIAN) {
+      positions.resize(n_steps);
+      for (size_t k = 0; k < n_steps; k++) {
+        Eigen::Matrix4d pose;
+        kin_solver.getFK(steps[k], pose);
+        positions[k] = pose.block<3, 1>(0, 3);
+      }
+    }
+
+    std::vector<std::pair<size_t, size_t>> pending = {{0, n_steps - 1}};
+    while (!pending.empty()) {
+      size_t first = pending.back().first, last = pending.back().second;
+      pending.pop_back();
+      if (last - first < 2) continue;
+
+      size_t farthest_step = (first + last) / 2;
+      double farthest = 0;
+      for (size_t k = first + 1; k < last; k++) {
+        double t = double(k - first) / (last - first);
+        Eigen::VectorXd interpolated = (1 - t) * steps[first] + t * steps[last];
+        double deviation;
+        if (decimation.mode == DECIMATE_JOINT) {
+          deviation = (interpolated - steps[k]).cwiseAbs().maxCoeff();
         } else {
-          int joint_id = plan_info.result == kinlib::MotionPlanReturnCodes::JOINT_LIMITS_VIOLATED ? plan_info.joint_id : -1;
-          plan_successful = false;
-          plans[i][j].plan_length = guiding_poses.size();
-          plans[i][j].is_successful = false;
-          plans[i][j].joint_angles = joint_angles;
-          plans[i][j].failed_screw_segment = screw_segment + 1;
-          plans[i][j].failed_joint_id = joint_id;
-          break;
+          Eigen::Matrix4d pose;
+          kin_solver.getFK(interpolated, pose);
+          deviation = (pose.block<3, 1>(0, 3) - positions[k]).norm();
+        }
+        if (deviation > farthest) {
+          farthest = deviation;
+          farthest_step = k;
         }
       }
 
-      if (plan_successful) {
-        plans[i][j].plan_length = guiding_poses.size();
-        plans[i][j].is_successful = true;
-        plans[i][j].joint_angles = joint_angles;
+      if (farthest > decimation.tolerance || (decimation.stride > 0 && last - first > decimation.stride)) {
+        keep[farthest_step] = 1;
+        pending.push_back({first, farthest_step});
+        pending.push_back({farthest_step, last});
+      }
+    }
+  }
+
+  size_t n_kept = 0;
+  for (size_t k = 0; k < n_steps; k++)
+    if (keep[k]) steps[n_kept++] = std::move(steps[k]);
+  steps.resize(n_kept);
+}
+
+// Plans the task instance `i` with the demonstration `j`, returns false if it was abandoned
+// because an earlier demonstration has succeeded meanwhile
+bool plan_attempt(PlanningJob &job, int i, int j, WorkerStats &stats) {
+  PlanInfo &plan = job.plans[i][j];
+  bool keep_plan = job.keep_plans[i];
+  Eigen::VectorXd jnt_val = *(job.init_jnt_val);
+  std::vector<Eigen::Matrix4d> guiding_poses;
+  Clock::time_point phase_start = Clock::now();
+  kinlib::UserGuidedMotionPlanner::planMotionForNewTaskInstance(*job.demontrations[j]->demo, job.task_instances[i], guiding_poses);
+  stats.guiding_poses_ns += elapsed_ns(phase_start);
+  phase_start = Clock::now();
+
+  int screw_segment = 0;
+  bool plan_successful = true, abandoned = false;
+  std::vector<Eigen::VectorXd> joint_angles;
+  for (auto guiding_pose : guiding_poses) {
+    if (job.first_success[i] < j) {
+      abandoned = true;
+      break;
+    }
+
+    Eigen::Matrix4d init_ee_g;
+    kin_solver.getFK(jnt_val, init_ee_g);
+
+    // Get motion plan using ScLERP Planner
+    kinlib::MotionPlanResult plan_info;
+    std::vector<Eigen::VectorXd> plan_result;
+    kinlib::ErrorCodes code = kin_solver.getMotionPlan(jnt_val, init_ee_g, guiding_pose, plan_result, plan_info);
+    stats.n_motion_plans++;
+    stats.rmrc_iterations += plan_info.n_iterations;
+    stats.max_rmrc_iterations = std::max<uint64_t>(stats.max_rmrc_iterations, plan_info.n_iterations);
+
+    if (keep_plan) {
+      if (job.decimation) decimate(plan_result, *job.decimation);
+      joint_angles.reserve(joint_angles.size() + distance(plan_result.begin(), plan_result.end()));
+      joint_angles.insert(joint_angles.end(), plan_result.begin(), plan_result.end());
+    }
+
+    if (code == kinlib::ErrorCodes::OPERATION_SUCCESS) {
+      jnt_val = plan_result.back();
+      screw_segment += 1;
+    } else {
+      int joint_id = plan_info.result == kinlib::MotionPlanReturnCodes::JOINT_LIMITS_VIOLATED ? plan_info.joint_id : -1;
+      plan_successful = false;
+      plan.plan_length = guiding_poses.size();
+      plan.is_successful = false;
+      if (!job.successful_plans_only) plan.joint_angles = std::move(joint_angles);
+      plan.failed_screw_segment = screw_segment + 1;
+      plan.failed_joint_id = joint_id;
+      break;
+    }
+  }
+
+  stats.motion_plan_ns += elapsed_ns(phase_start);
+  if (plan_successful && !abandoned) {
+    plan.plan_length = guiding_poses.size();
+    plan.is_successful = true;
+    plan.joint_angles = std::move(joint_angles);
+  }
+  return !abandoned;
+}
+
+// Whether the attempts of the task instance `i` have all been made up to its first success
+bool is_resolved(PlanningJob &job, int i) {
+  for (int j = 0; j < job.n_demontrations; j++) {
+    if (!job.attempt_finished[i * job.n_demontrations + j]) return false;
+    if (job.plans[i][j].is_successful) return true;
+  }
+  return true;
+}
+
+// Records that an attempt has been made (`planned`) or not, and reports its task instance to
+// the stream once its outcome is known, or once it has been cancelled
+void finish_attempt(PlanningJob &job, int i, int j, bool planned, bool cancelled) {
+  std::lock_guard<std::mutex> lock(job.mutex);
+  if (planned) {
+    job.attempt_finished[i * job.n_demontrations + j] = 1;
+    if (job.plans[i][j].is_successful && j < job.first_success[i]) job.first_success[i] = j;
+  }
+
+  if (!job.resolved[i] && (cancelled || is_resolved(job, i))) {
+    job.resolved[i] = 1;
+    if (job.progress) {
+      std::lock_guard<std::mutex> progress_lock(job.progress->mutex);
+      if (cancelled) job.progress->n_cancelled++;
+      else job.progress->completed_indices.push_back(i);
+      job.progress->n_finished++;
+      job.progress->completed.notify_one();
+    }
+  }
+
+  // the job may be gone as soon as the lock is released
+  if (--job.n_pending_attempts == 0) job.finished.notify_all();
+}
+
+void run_attempt(const WorkItem &item, int worker) {
+  Clock::time_point start = Clock::now();
+  PlanningJob &job = *item.job;
+  int i = item.task_instance, j = item.demontration;
+  WorkerStats &stats = job.worker_stats[worker];
+
+  bool cancelled = false;
+  if (job.progress) {
+    std::lock_guard<std::mutex> lock(job.progress->mutex);
+    cancelled = job.progress->cancelled[i];
+  }
+  bool planned = !cancelled && job.first_success[i] > j && plan_attempt(job, i, j, stats);
+
+  stats.busy_ns += elapsed_ns(start);
+  finish_attempt(job, i, j, planned, cancelled);
+}
+
+
+// The planner threads, started once and shared by all connections. The jobs with queued
+// attempts take turns attempt by attempt, so that every connection gets an even share of the
+// threads however large the requests of the others. Within a job, every worker has a queue of
+// its own to which the attempts are dealt by task instance, and once it is empty the worker
+// steals the oldest attempt of the longest queue, so that no thread idles while a straggler
+// still has work queued up. The attempts are queued demonstration by demonstration, an attempt
+// with a later demonstration is only started once the earlier ones of the task instance have
+// been, and is skipped by then if one of these succeeded.
+class WorkerPool {
+  public:
+    void start(int n_workers) {
+      std::lock_guard<std::mutex> lock(mutex);
+      if (n_started > 0) return;
+      n_started = n_workers;
+      for (int w = 0; w < n_workers; w++)
+        std::thread(&WorkerPool::run, this, w).detach();
+    }
+
+    int size() {
+      return n_started;
+    }
+
+    void submit(PlanningJob &job, const std::vector<WorkItem> &items) {
+      std::lock_guard<std::mutex> lock(mutex);
+      job.queues.assign(n_started, std::deque<WorkItem>());
+      for (const WorkItem &item : items)
+        job.queues[(next_queue + item.task_instance) % n_started].push_back(item);
+      job.n_queued = items.size();
+      next_queue = (next_queue + items.size()) % n_started;
+      if (job.n_queued > 0) {
+        jobs.push_back(&job);
+        work_available.notify_all();
+      }
+    }
+
+  private:
+    std::mutex mutex;
+    std::condition_variable work_available;
+    std::list<PlanningJob *> jobs;   // with queued attempts, in the order of their turns
+    int n_started = 0, next_queue = 0;
+
+    // with the mutex held
+    bool take(int w, WorkItem &item) {
+      if (jobs.empty()) return false;
+      PlanningJob &job = *jobs.front();
+      jobs.pop_front();
+
+      std::deque<WorkItem> *queue = &job.queues[w];
+      if (queue->empty()) {
+        for (auto &victim : job.queues)
+          if (victim.size() > queue->size()) queue = &victim;
+      }
+      item = queue->front();
+      queue->pop_front();
+      if (--job.n_queued > 0) jobs.push_back(&job);
+      return true;
+    }
+
+    void run(int w) {
+      while (true) {
+        WorkItem item;
+        {
+          std::unique_lock<std::mutex> lock(mutex);
+          while (!take(w, item)) work_available.wait(lock);
+        }
+        run_attempt(item, w);
+      }
+    }
+};
+
+// never destroyed, its threads are still waiting for work at exit
+WorkerPool &worker_pool = *new WorkerPool();
+
+
+kinlib::Demonstration load_demonstration(const std::string &recorded_demo_file, const std::string &object_poses_file, double roi, PlanStats &stats) {
+  Clock::time_point start = Clock::now();
+  Eigen::MatrixXd recorded_demo = loadCSV<Eigen::MatrixXd>(recorded_demo_file, true),
+                  object_poses = loadCSV<Eigen::MatrixXd>(object_poses_file);
+
+  std::vector<Eigen::Matrix4d> recorded_ee_traj, obj_poses;
+
+  for(int j = 0; j < recorded_demo.rows(); j++) {
+    Eigen::VectorXd jnt_cfg = recorded_demo.block<1,7>(j,1).transpose();
+    Eigen::Matrix4d ee_pose;
+    kin_solver.getFK(jnt_cfg, ee_pose);
+    if (j != 0 && kinlib::positionDistance(recorded_ee_traj.back(), ee_pose) < 0.005)
+      continue;
+    recorded_ee_traj.push_back(ee_pose);
+  }
+
+  for(int j = 0; j < object_poses.rows() / 4; j++) {
+    Eigen::Matrix4d g = object_poses.block<4,4>((j*4),0);
+    obj_poses.push_back(g);
+  }
+  stats.load_demo_ns += elapsed_ns(start);
+
+  start = Clock::now();
+  kinlib::Demonstration demo = kinlib::saveDemonstration(recorded_ee_traj, obj_poses, roi);
+  stats.save_demo_ns += elapsed_ns(start);
+  return demo;
+}
+
+
+// 64-bit FNV-1a hash of a file's content, so that a changed file yields a new cache key
+uint64_t hash_file(const std::string &file) {
+  std::ifstream indata(file, std::ios::binary);
+  uint64_t hash = 14695981039346656037ULL;
+  char buffer[1 << 16];
+  while (indata.read(buffer, sizeof(buffer)) || indata.gcount() > 0) {
+    for (std::streamsize i = 0; i < indata.gcount(); i++) {
+      hash ^= (unsigned char) buffer[i];
+      hash *= 1099511628211ULL;
+    }
+  }
+  return hash;
+}
+
+
+// Bounded, thread-safe LRU of preprocessed demonstrations keyed by the content
+// hash of both demonstration files and the region of interest. Entries are
+// shared, an evicted demonstration stays alive for the sessions still using it.
+class DemonstrationCache {
+  public:
+    std::atomic<uint64_t> hits{0}, misses{0};
+
+    std::shared_ptr<kinlib::Demonstration> get(const std::string &recorded_demo_file, const std::string &object_poses_file, double roi, PlanStats &stats) {
+      std::ostringstream key;
+      key << std::hex << hash_file(recorded_demo_file) << ":" << hash_file(object_poses_file) << ":" << std::hexfloat << roi;
+
+      {
+        std::lock_guard<std::mutex> lock(mutex);
+        auto entry = entries.find(key.str());
+        if (entry != entries.end()) {
+          hits++;
+          order.splice(order.begin(), order, entry->second);
+          return entry->second->second;
+        }
+        misses++;
+      }
+
+      // preprocess outside the lock so that other connections are not blocked
+      auto demo = std::make_shared<kinlib::Demonstration>(load_demonstration(recorded_demo_file, object_poses_file, roi, stats));
+
+      std::lock_guard<std::mutex> lock(mutex);
+      if (entries.find(key.str()) == entries.end()) {
+        order.emplace_front(key.str(), demo);
+        entries[key.str()] = order.begin();
+        while (order.size() > DEMO_CACHE_CAPACITY) {
+          entries.erase(order.back().first);
+          order.pop_back();
+        }
+      }
+      return demo;
+    }
+
+    void write_stats(PayloadWriter &writer) {
+      std::lock_guard<std::mutex> lock(mutex);
+      writer.put_u64(hits);
+      writer.put_u64(misses);
+      writer.put_u64(order.size());
+      writer.put_u64(DEMO_CACHE_CAPACITY);
+    }
+
+  private:
+    typedef std::pair<std::string, std::shared_ptr<kinlib::Demonstration>> Entry;
+    std::mutex mutex;
+    std::list<Entry> order;
+    std::unordered_map<std::string, std::list<Entry>::iterator> entries;
+};
+
+DemonstrationCache demo_cache;
+
+
+void encode_plan_response(PayloadWriter &writer, PlanInfo **plans, const std::vector<int> &indices, int n_demontrations, int n_joints) {
+  int n_task_instances = indices.size();
+  std::vector<int> n_attempts(n_task_instances, n_demontrations);
+  uint64_t n_attempts_total = 0, n_steps_total = 0;
+  for (int i = 0; i < n_task_instances; i++) {
+    for (int j = 0; j < n_demontrations; j++) {
+      n_steps_total += plans[indices[i]][j].joint_angles.size();
+      if (plans[indices[i]][j].is_successful) {
+        n_attempts[i] = j + 1;
         break;
       }
     }
+    n_attempts_total += n_attempts[i];
   }
 
-  return NULL;
+  writer.data.reserve(writer.data.size() + 24 + 4 * n_task_instances + 20 * n_attempts_total + 8 * n_joints * n_steps_total);
+  writer.put_u32(n_task_instances);
+  writer.put_u32(n_joints);
+  writer.put_u64(n_attempts_total);
+  writer.put_u64(n_steps_total);
+
+  for (int i = 0; i < n_task_instances; i++)
+    writer.put_u32(n_attempts[i]);
+
+  for (int i = 0; i < n_task_instances; i++) {
+    for (int j = 0; j < n_attempts[i]; j++) {
+      PlanInfo &plan = plans[indices[i]][j];
+      writer.put_i32(plan.plan_length);
+      writer.put_i32(plan.is_successful);
+      writer.put_i32(plan.is_successful ? 0 : plan.failed_screw_segment);
+      writer.put_i32(plan.is_successful ? 0 : plan.failed_joint_id);
+      writer.put_u32(plan.joint_angles.size());
+    }
+  }
+
+  for (int i = 0; i < n_task_instances; i++)
+    for (int j = 0; j < n_attempts[i]; j++)
+      for (auto &joint_angles : plans[indices[i]][j].joint_angles)
+        for (int k = 0; k < n_joints; k++)
+          writer.put_f64(joint_angles(k));
 }
 
 
-void *handle_request(void *arg) {
-  
-  int client_socket_fd = ((int *)arg)[0];
-  int thread_index = ((int *)arg)[1];
-  
-  int n_demontrations = recv_int(client_socket_fd);
-  Demontration *demontrations = (Demontration *) calloc(n_demontrations, sizeof(Demontration));
+// Demonstrations registered over a connection, addressed by their index (handle)
+typedef struct {
+  std::vector<Demontration> demontrations;
+  int n_requests;
+  PlanStats stats;
+} Session;
+
+
+bool register_demonstrations(int client_socket_fd, const std::vector<char> &payload, Session &session) {
+  PayloadReader reader(payload);
+  PayloadWriter response;
+
+  int n_demontrations = reader.get_count(4 + 4 + 8 + 8);
+  response.put_u32(n_demontrations);
   for (int i = 0; i < n_demontrations; i++) {
-    demontrations[i].recorded_demo_file = recv_str(client_socket_fd);
-    demontrations[i].object_poses_file = recv_str(client_socket_fd);
-    demontrations[i].roi = recv_float(client_socket_fd);
-    demontrations[i].score = recv_float(client_socket_fd);
+    Demontration demontration;
+    demontration.recorded_demo_file = reader.get_str();
+    demontration.object_poses_file = reader.get_str();
+    demontration.roi = reader.get_f64();
+    demontration.score = reader.get_f64();
+    demontration.demo = demo_cache.get(demontration.recorded_demo_file, demontration.object_poses_file, demontration.roi, session.stats);
+
+    std::cout << "Demontration handle #" << session.demontrations.size() << ": {\n\tdemo: " << demontration.recorded_demo_file << ",\n\tobject pose: " << demontration.object_poses_file << ",\n\troi: " << demontration.roi << ",\n\tscore: " << demontration.score << "\n}\n";
+
+    response.put_u32(session.demontrations.size());
+    session.demontrations.push_back(demontration);
   }
 
-  int n_task_instances = recv_int(client_socket_fd);
-  kinlib::TaskInstance *task_instances = (kinlib::TaskInstance *) calloc(n_task_instances, sizeof(kinlib::TaskInstance));
-  for (int i = 0; i < n_task_instances; i++) {
-    int n_poses_in_task_instance = recv_int(client_socket_fd);
+  std::cout << "Demontration cache: " << demo_cache.hits << " hits, " << demo_cache.misses << " misses\n";
+
+  return send_frame(client_socket_fd, FRAME_DEMO_HANDLES, response.data);
+}
+
+
+bool send_stats(int client_socket_fd) {
+  PayloadWriter response;
+  demo_cache.write_stats(response);
+  return send_frame(client_socket_fd, FRAME_STATS, response.data);
+}
+
+
+bool read_cancellations(int client_socket_fd, PlanProgress &progress) {
+  uint8_t frame_type;
+  uint16_t frame_flags;
+  std::vector<char> payload;
+  if (!recv_frame(client_socket_fd, frame_type, frame_flags, payload) || frame_type != FRAME_CANCEL) return false;
+
+  PayloadReader reader(payload);
+  int n_cancelled = reader.get_count(4);
+  std::lock_guard<std::mutex> lock(progress.mutex);
+  for (int i = 0; i < n_cancelled; i++) {
+    uint32_t index = reader.get_u32();
+    if (index < progress.cancelled.size()) progress.cancelled[index] = 1;
+  }
+  return true;
+}
+
+
+// Sends a PLAN_RESULT frame for every batch of task instances completed by the planner
+// threads, and applies the client's CANCEL frames in between. Returns false once the
+// client is gone, in which case all remaining task instances are cancelled.
+bool stream_plan_results(int client_socket_fd, PlanProgress &progress, PlanInfo **plans, int n_task_instances, int n_demontrations, int n_joints, PlanStats &stats) {
+  bool client_alive = true;
+  int n_cancelled = 0;
+  while (true) {
+    std::vector<int> indices;
+    bool finished;
+    {
+      std::unique_lock<std::mutex> lock(progress.mutex);
+      progress.completed.wait_for(lock, std::chrono::milliseconds(10), [&] {
+        return !progress.completed_indices.empty() || progress.n_finished == n_task_instances;
+      });
+      indices.swap(progress.completed_indices);
+      finished = progress.n_finished == n_task_instances;
+      n_cancelled = progress.n_cancelled;
+    }
+
+    if (client_alive && !indices.empty()) {
+      Clock::time_point start = Clock::now();
+      PayloadWriter result;
+      result.put_u32(indices.size());
+      for (int index : indices) result.put_u32(index);
+      encode_plan_response(result, plans, indices, n_demontrations, n_joints);
+      stats.encode_ns += elapsed_ns(start);
+      start = Clock::now();
+      client_alive = send_frame(client_socket_fd, FRAME_PLAN_RESULT, result.data);
+      stats.send_ns += elapsed_ns(start);
+      // the attempts after the first success may still be written by a planner thread
+      for (int index : indices) {
+        for (int j = 0; j < n_demontrations; j++) {
+          std::vector<Eigen::VectorXd>().swap(plans[index][j].joint_angles);
+          if (plans[index][j].is_successful) break;
+        }
+      }
+    }
+
+    if (finished) break;
+
+    struct pollfd client = { client_socket_fd, POLLIN, 0 };
+    while (client_alive && poll(&client, 1, 0) > 0)
+      client_alive = read_cancellations(client_socket_fd, progress);
+
+    if (!client_alive) {
+      std::lock_guard<std::mutex> lock(progress.mutex);
+      std::fill(progress.cancelled.begin(), progress.cancelled.end(), 1);
+    }
+  }
+
+  if (!client_alive) return false;
+
+  PayloadWriter end;
+  end.put_u32(n_task_instances - n_cancelled);
+  end.put_u32(n_cancelled);
+  return send_frame(client_socket_fd, FRAME_PLAN_END, end.data);
+}
+
+
+// Queues the attempts of a request on the worker pool, demonstration by demonstration
+void start_planning(PlanningJob &job, std::vector<Demontration *> &demontrations, std::vector<kinlib::TaskInstance> &task_instances,
+                    Eigen::VectorXd &init_jnt_val, const std::vector<char> &keep_plans, bool successful_plans_only, const Decimation *decimation,
+                    PlanProgress *progress) {
+  int n_demontrations = demontrations.size(),
+      n_task_instances = task_instances.size();
+
+  job.demontrations = demontrations.data();
+  job.task_instances = task_instances.data();
+  job.init_jnt_val = &(init_jnt_val);
+  job.keep_plans = keep_plans.data();
+  job.successful_plans_only = successful_plans_only;
+  job.decimation = decimation;
+  job.progress = progress;
+  job.n_demontrations = n_demontrations;
+  job.n_task_instances = n_task_instances;
+  job.plans = (PlanInfo **) calloc(n_task_instances, sizeof(PlanInfo *));
+  for (int i = 0; i < n_task_instances; i++)
+    job.plans[i] = new PlanInfo[n_demontrations]();
+
+  job.first_success = std::vector<std::atomic<int>>(n_task_instances);
+  for (auto &first_success : job.first_success) first_success = n_demontrations;
+  job.attempt_finished.assign(n_task_instances * n_demontrations, 0);
+  job.resolved.assign(n_task_instances, 0);
+  job.worker_stats.assign(worker_pool.size(), WorkerStats());
+  job.n_pending_attempts = n_task_instances * n_demontrations;
+
+  if (n_demontrations == 0) {
+    for (int i = 0; i < n_task_instances; i++) {
+      job.resolved[i] = 1;
+      if (progress) {
+        std::lock_guard<std::mutex> lock(progress->mutex);
+        progress->completed_indices.push_back(i);
+        progress->n_finished++;
+      }
+    }
+  }
+
+  std::vector<WorkItem> items;
+  items.reserve(job.n_pending_attempts);
+  for (int j = 0; j < n_demontrations; j++)
+    for (int i = 0; i < n_task_instances; i++)
+      items.push_back({&job, i, j});
+  worker_pool.submit(job, items);
+}
+
+void finish_planning(PlanningJob &job, PlanStats &stats) {
+  {
+    std::unique_lock<std::mutex> lock(job.mutex);
+    job.finished.wait(lock, [&] { return job.n_pending_attempts == 0; });
+  }
+
+  stats.thread_busy_ns.resize(job.worker_stats.size(), 0);
+  for (size_t w = 0; w < job.worker_stats.size(); w++) {
+    WorkerStats &worker_stats = job.worker_stats[w];
+    stats.thread_busy_ns[w] += worker_stats.busy_ns;
+    stats.guiding_poses_ns += worker_stats.guiding_poses_ns;
+    stats.motion_plan_ns += worker_stats.motion_plan_ns;
+    stats.n_motion_plans += worker_stats.n_motion_plans;
+    stats.rmrc_iterations += worker_stats.rmrc_iterations;
+    stats.max_rmrc_iterations = std::max(stats.max_rmrc_iterations, worker_stats.max_rmrc_iterations);
+  }
+}
+
+void free_plans(PlanningJob &job) {
+  for (int i = 0; i < job.n_task_instances; i++)
+    delete[] job.plans[i];
+  free(job.plans);
+  job.plans = NULL;
+}
+
+
+// Server-wide limit on the task instances in flight, i.e. planned or holding their plans
+// in memory. Plan requests are admitted in the order they arrive, once their task instances
+// fit (a request on its own always does); a request arriving while MAX_WAITING others are
+// waiting is turned away with the time after which the waiting ones should have been admitted,
+// estimated from the task instances completed per second of the time the server was busy.
+class AdmissionControl {
+  public:
+    // waits for the turn of the request, false if it is turned away
+    bool admit(size_t n_task_instances, uint32_t &retry_after_ms, uint32_t &n_in_flight_now, uint32_t &n_waiting_now) {
+      std::unique_lock<std::mutex> lock(mutex);
+      n_in_flight_now = n_in_flight;
+      n_waiting_now = next_ticket - now_serving;
+      bool admissible = next_ticket == now_serving && (n_in_flight == 0 || n_in_flight + n_task_instances <= MAX_IN_FLIGHT);
+      if (!admissible && next_ticket - now_serving >= MAX_WAITING) {
+        double backlog = std::max<double>(n_in_flight + n_waiting_instances, MAX_IN_FLIGHT) - MAX_IN_FLIGHT;
+        double busy_s = (busy_ns + (n_in_flight > 0 ? elapsed_ns(busy_start) : 0)) / 1e9;
+        retry_after_ms = std::min(60000.0, std::max(10.0, n_completed > 0 ? 1000 * backlog * busy_s / n_completed : 1000));
+        return false;
+      }
+
+      uint64_t ticket = next_ticket++;
+      n_waiting_instances += n_task_instances;
+      turn.wait(lock, [&] {
+        return ticket == now_serving && (n_in_flight == 0 || n_in_flight + n_task_instances <= MAX_IN_FLIGHT);
+      });
+      now_serving++;
+      n_waiting_instances -= n_task_instances;
+      if (n_in_flight == 0) busy_start = Clock::now();
+      n_in_flight += n_task_instances;
+      turn.notify_all();
+      return true;
+    }
+
+    void release(size_t n_task_instances) {
+      std::lock_guard<std::mutex> lock(mutex);
+      n_in_flight -= n_task_instances;
+      n_completed += n_task_instances;
+      if (n_in_flight == 0) busy_ns += elapsed_ns(busy_start);
+
+      // forgets the past gradually, the cost of a task instance changes with the requests
+      if (busy_ns > 60e9) {
+        busy_ns /= 2;
+        n_completed /= 2;
+      }
+      turn.notify_all();
+    }
+
+  private:
+    std::mutex mutex;
+    std::condition_variable turn;
+    uint64_t next_ticket = 0, now_serving = 0;
+    size_t n_in_flight = 0, n_waiting_instances = 0;
+    uint64_t n_completed = 0, busy_ns = 0;   // task instances completed in the time the server was busy
+    Clock::time_point busy_start;
+};
+
+AdmissionControl admission;
+
+
+bool evaluate_task_instances(int client_socket_fd, const std::vector<char> &payload, uint16_t flags, Session &session, int thread_index) {
+  Clock::time_point request_start = Clock::now();
+  PlanStats &stats = session.stats;
+  PayloadReader reader(payload);
+
+  std::vector<Demontration *> demontrations(reader.get_count(4));
+  for (auto &demontration : demontrations) {
+    uint32_t handle = reader.get_u32();
+    if (handle >= session.demontrations.size()) throw std::out_of_range("unknown demonstration handle");
+    demontration = &session.demontrations[handle];
+  }
+
+  uint32_t n_requested_task_instances = reader.get_u32();
+  int n_poses_in_task_instance = reader.get_count(16 * 8);
+  reader.expect_items(n_requested_task_instances, std::max(n_poses_in_task_instance, 1) * 16 * 8);
+  std::vector<kinlib::TaskInstance> task_instances(n_requested_task_instances);
+  for (auto &task_instance : task_instances) {
     for (int j = 0; j < n_poses_in_task_instance; j++) {
-      int length = recv_int(client_socket_fd);
       Eigen::Matrix4d object_pose;
-      for (int k = 0; k < length; k++) object_pose(k) = recv_float(client_socket_fd);
-      task_instances[i].object_poses.push_back(object_pose.transpose());
+      for (int k = 0; k < 16; k++) object_pose(k) = reader.get_f64();
+      task_instance.object_poses.push_back(object_pose.transpose());
     }
   }
 
-  int joint_config_length = recv_int(client_socket_fd);
-  Eigen::VectorXd init_jnt_val(joint_config_length);
-  for (int i = 0; i < joint_config_length; i++)
-    init_jnt_val(i) = recv_float(client_socket_fd);
+  Eigen::VectorXd init_jnt_val(reader.get_count(8));
+  for (int i = 0; i < init_jnt_val.size(); i++)
+    init_jnt_val(i) = reader.get_f64();
+
+  uint32_t plan_selection = reader.get_u32();
+  std::vector<char> keep_plans(task_instances.size(), plan_selection != PLANS_NONE && plan_selection != PLANS_SUBSET);
+  if (plan_selection == PLANS_SUBSET) {
+    int n_selected = reader.get_count(4);
+    for (int i = 0; i < n_selected; i++) {
+      uint32_t index = reader.get_u32();
+      if (index >= keep_plans.size()) throw std::out_of_range("task instance index out of range");
+      keep_plans[index] = 1;
+    }
+  }
+
+  Decimation decimation;
+  if (flags & FLAG_DECIMATE) {
+    decimation.mode = reader.get_u32();
+    decimation.tolerance = reader.get_f64();
+    decimation.stride = reader.get_u32();
+    if (!is_valid(decimation))
+      throw std::out_of_range("invalid decimation");
+  }
+  stats.decode_ns += elapsed_ns(request_start);
 
-  int n_threads = N_THREADS > n_task_instances ? n_task_instances : N_THREADS;
+  int n_demontrations = demontrations.size(),
+      n_task_instances = task_instances.size();
+  int n_threads = worker_pool.size();
 
-  std::cout << "===================== Invocation # " << thread_index << " =====================\n";
+  std::cout << "===================== Invocation # " << thread_index << "." << session.n_requests++ << " =====================\n";
   std::cout << "Task instances to evaluate : " << n_task_instances << "\n";
   std::cout << "Threads used for evaluation: " << n_threads << "\n";
-  for (int i = 0; i < n_demontrations; i++)
-    std::cout << "Demontration #" << i+1 << ": {\n\tdemo: " << demontrations[i].recorded_demo_file << ",\n\tobject pose: " << demontrations[i].object_poses_file << ",\n\troi: " << demontrations[i].roi << ",\n\tscore: " << demontrations[i].score << "\n}\n";
-  std::cout << "Task instance #1:\n";
-  for(auto pose : task_instances[0].object_poses)
-    std::cout << pose << "\n\n";
+  std::cout << "Streaming results          : " << (flags & FLAG_STREAM ? "yes" : "no") << "\n";
+  std::cout << "Demontration handles       :";
+  for (auto demontration : demontrations)
+    std::cout << " " << demontration - session.demontrations.data();
+  std::cout << "\n";
+  if (n_task_instances > 0) {
+    std::cout << "Task instance #1:\n";
+    for(auto pose : task_instances[0].object_poses)
+      std::cout << pose << "\n\n";
+  }
   std::cout << "Initial joint config:\n";
   std::cout << init_jnt_val << "\n";
   std::cout << "==========================================================\n";
-  
-  for (int i = 0; i < n_demontrations; i++) {
-    Eigen::MatrixXd recorded_demo = loadCSV<Eigen::MatrixXd>(demontrations[i].recorded_demo_file, true),
-                    object_poses = loadCSV<Eigen::MatrixXd>(demontrations[i].object_poses_file);
-    
-    std::vector<Eigen::Matrix4d> recorded_ee_traj, obj_poses;
-    
-    for(int j = 0; j < recorded_demo.rows(); j++) {
-      Eigen::VectorXd jnt_cfg = recorded_demo.block<1,7>(j,1).transpose();
-      Eigen::Matrix4d ee_pose;
-      kin_solver.getFK(jnt_cfg, ee_pose);
-      if (j != 0 && kinlib::positionDistance(recorded_ee_traj.back(), ee_pose) < 0.005)
-        continue;
-      recorded_ee_traj.push_back(ee_pose);
-    }
-    
-    for(int j = 0; j < object_poses.rows() / 4; j++) {
-      Eigen::Matrix4d g = object_poses.block<4,4>((j*4),0);
-      obj_poses.push_back(g);
+
+  Clock::time_point admission_start = Clock::now();
+  uint32_t retry_after_ms, n_in_flight, n_waiting;
+  if (!admission.admit(n_task_instances, retry_after_ms, n_in_flight, n_waiting)) {
+    std::cout << "Invocation # " << thread_index << "." << session.n_requests - 1 << " turned away, " << n_in_flight << " task instances in flight and "
+              << n_waiting << " requests waiting, retry after " << retry_after_ms << " ms\n";
+    PayloadWriter busy;
+    busy.put_u32(retry_after_ms);
+    busy.put_u32(n_in_flight);
+    busy.put_u32(n_waiting);
+    return send_frame(client_socket_fd, FRAME_BUSY, busy.data);
+  }
+  stats.admission_ns += elapsed_ns(admission_start);
+
+  PlanProgress progress;
+  progress.cancelled.resize(n_task_instances, 0);
+
+  PlanningJob job;
+  start_planning(job, demontrations, task_instances, init_jnt_val, keep_plans, plan_selection == PLANS_SUCCESSFUL,
+                 flags & FLAG_DECIMATE ? &decimation : NULL, flags & FLAG_STREAM ? &progress : NULL);
+  PlanInfo **plans = job.plans;
+
+  bool client_alive = true;
+  if (flags & FLAG_STREAM)
+    client_alive = stream_plan_results(client_socket_fd, progress, plans, n_task_instances, n_demontrations, init_jnt_val.size(), stats);
+
+  finish_planning(job, stats);
+
+  if (!(flags & FLAG_STREAM)) {
+    Clock::time_point start = Clock::now();
+    std::vector<int> indices(n_task_instances);
+    for (int i = 0; i < n_task_instances; i++) indices[i] = i;
+    PayloadWriter response;
+    encode_plan_response(response, plans, indices, n_demontrations, init_jnt_val.size());
+    stats.encode_ns += elapsed_ns(start);
+    start = Clock::now();
+    client_alive = send_frame(client_socket_fd, FRAME_PLAN_RESPONSE, response.data);
+    stats.send_ns += elapsed_ns(start);
+  }
+  stats.wall_ns += elapsed_ns(request_start);
+
+  std::cout << "Invocation # " << thread_index << "." << session.n_requests - 1 << " took " << stats.wall_ns / 1e6 << " ms: "
+            << stats.guiding_poses_ns / 1e6 << " ms planMotionForNewTaskInstance and " << stats.motion_plan_ns / 1e6 << " ms getMotionPlan over "
+            << n_threads << " threads, " << stats.n_motion_plans << " motion plans in " << stats.rmrc_iterations << " RMRC iterations\n";
+
+  if (client_alive && flags & FLAG_STATS) {
+    PayloadWriter trailer;
+    stats.write(trailer);
+    client_alive = send_frame(client_socket_fd, FRAME_PLAN_STATS, trailer.data);
+  }
+  stats = PlanStats();
+
+  free_plans(job);
+  admission.release(n_task_instances);
+  return client_alive;
+}
+
+
+// A connection is a long-lived session: the client registers demonstrations
+// once and then sends any number of plan requests referring to their handles.
+void *handle_request(void *arg) {
+
+  int client_socket_fd = ((int *)arg)[0];
+  int thread_index = ((int *)arg)[1];
+  free(arg);
+
+  Session session;
+  session.n_requests = 0;
+
+  uint8_t frame_type;
+  uint16_t frame_flags;
+  std::vector<char> payload;
+  bool keep_alive = true;
+  while (keep_alive && recv_frame(client_socket_fd, frame_type, frame_flags, payload)) {
+    try {
+      switch (frame_type) {
+        case FRAME_REGISTER_DEMOS:
+          keep_alive = register_demonstrations(client_socket_fd, payload, session);
+          break;
+        case FRAME_PLAN_REQUEST:
+          keep_alive = evaluate_task_instances(client_socket_fd, payload, frame_flags, session, thread_index);
+          break;
+        case FRAME_CANCEL:
+          // a late cancellation for a stream that has already ended
+          break;
+        case FRAME_STATS_REQUEST:
+          keep_alive = send_stats(client_socket_fd);
+          break;
+        default:
+          std::cerr << "Invocation # " << thread_index << ": unexpected frame type " << (int) frame_type << "\n";
+          keep_alive = false;
+      }
+    } catch (const std::exception &error) {
+      // a malformed request (std::out_of_range) or one too large to hold, only its connection is closed
+      std::cerr << "Invocation # " << thread_index << ": " << error.what() << "\n";
+      keep_alive = false;
     }
+  }
 
-    demontrations[i].demo = kinlib::saveDemonstration(recorded_ee_traj, obj_poses, demontrations[i].roi);  
+  close(client_socket_fd);
+  return NULL;
+}
+
+
+int open_listening_socket(const char *socket_path, int port) {
+  int socket_fd;
+  if (port > 0) {
+    socket_fd = socket(AF_INET, SOCK_STREAM, 0);
+    int reuse = 1;
+    setsockopt(socket_fd, SOL_SOCKET, SO_REUSEADDR, &reuse, sizeof(reuse));
+    struct sockaddr_in socket_info;
+    memset(&socket_info, 0, sizeof(socket_info));
+    socket_info.sin_family = AF_INET;
+    socket_info.sin_port = htons(port);
+    socket_info.sin_addr.s_addr = INADDR_ANY;
+    if (bind(socket_fd, (struct sockaddr *) &socket_info, sizeof(socket_info)) != 0) return -1;
+  } else {
+    remove(socket_path);
+    socket_fd = socket(AF_UNIX, SOCK_STREAM, 0);
+    struct sockaddr_un socket_info;
+    memset(&socket_info, 0, sizeof(socket_info));
+    socket_info.sun_family = AF_UNIX;
+    strncpy(socket_info.sun_path, socket_path, sizeof(socket_info.sun_path) - 1);
+    if (bind(socket_fd, (struct sockaddr *) &socket_info, sizeof(socket_info)) != 0) return -1;
   }
+  return listen(socket_fd, 10) == 0 ? socket_fd : -1;
+}
 
 
-  pthread_t *threads = (pthread_t *) calloc(n_threads, sizeof(pthread_t));
-  ThreadArg *args = (ThreadArg *) calloc(n_threads, sizeof(ThreadArg));
-  PlanInfo **plans = (PlanInfo **) calloc(n_task_instances, sizeof(PlanInfo *));
-  for (int i = 0; i < n_task_instances; i++)
-    plans[i] = (PlanInfo *) calloc(n_demontrations, sizeof(PlanInfo));
+#ifdef PLANNER_LIBRARY
+
+// C interface for planning inside another process (client/engine.py) instead of over a socket:
+//   g++ -std=c++11 -O2 -shared -fPIC -DPLANNER_LIBRARY kinlib/*.cpp planner.cpp -o libplanner.so -lpthread
+// An engine is a session without a connection, its functions return a negative value on error
+// and are not meant to be called concurrently on the same engine.
+
+#pragma pack(push, 1)
+typedef struct {
+  int32_t n_screw_segments, is_successful, failed_screw_segment, failed_joint_angle;
+  uint32_t n_steps;
+} AttemptRecord;    // ATTEMPT_DTYPE in client/planner.py
+#pragma pack(pop)
+
+typedef struct {
+  Session session;
+  PlanningJob job;    // the plans of the last request until they are taken
+  uint32_t n_demontrations;
+} Engine;
+
+extern "C" {
+
+void planner_init(int n_threads, int demo_cache_capacity) {
+  static std::once_flag initialized;
+  std::call_once(initialized, init_solver);
+  N_THREADS = n_threads > 0 ? n_threads : std::thread::hardware_concurrency();
+  N_THREADS = N_THREADS > 0 ? N_THREADS : 1;
+  worker_pool.start(N_THREADS);
+  if (demo_cache_capacity > 0) DEMO_CACHE_CAPACITY = demo_cache_capacity;
+}
+
+Engine *planner_engine_new() {
+  Engine *engine = new Engine();
+  engine->session.n_requests = 0;
+  engine->job.plans = NULL;
+  engine->job.n_task_instances = 0;
+  return engine;
+}
+
+void planner_engine_free(Engine *engine) {
+  if (engine->job.plans) free_plans(engine->job);
+  delete engine;
+}
 
-  int n_task_instances_per_thread = n_task_instances / n_threads;
-  for (int t = 0; t < n_threads; t++) {
-    args[t].demontrations = demontrations;
-    args[t].task_instances = task_instances;
-    args[t].init_jnt_val = &(init_jnt_val);
-    args[t].n_demontrations = n_demontrations;
-    args[t].n_task_instances = n_task_instances;
-    args[t].plans = plans;
-    args[t].start_index = t * n_task_instances_per_thread;
-    args[t].end_index = t == n_threads - 1 ? n_task_instances - 1 : (t + 1) * n_task_instances_per_thread - 1;    
-    pthread_create(&(threads[t]), NULL, planner_thread, (void *) &(args[t]));
+// returns the handle of the demonstration
+int64_t planner_engine_register(Engine *engine, const char *recorded_demo_file, const char *object_poses_file, double roi, double score) {
+  try {
+    Demontration demontration;
+    demontration.recorded_demo_file = recorded_demo_file;
+    demontration.object_poses_file = object_poses_file;
+    demontration.roi = roi;
+    demontration.score = score;
+    demontration.demo = demo_cache.get(demontration.recorded_demo_file, demontration.object_poses_file, roi, engine->session.stats);
+    engine->session.demontrations.push_back(demontration);
+    return engine->session.demontrations.size() - 1;
+  } catch (const std::exception &error) {
+    std::cerr << "Failed to register " << recorded_demo_file << ": " << error.what() << "\n";
+    return -1;
   }
+}
 
-  for (int t = 0; t < n_threads; t++)
-    pthread_join(threads[t], NULL);
+// Plans `n_task_instances` task instances of `n_objects` row-major 4x4 poses each with the
+// demonstrations `handles`, like a PLAN_REQUEST with `keep_plans` (one flag per task instance)
+// as its plan selection, and with FLAG_DECIMATE if `decimate`. Fills `n_attempts` (one per task
+// instance) and `attempts` (room for n_task_instances * n_handles, the attempts of a task instance
+// after each other), and returns the number of attempts, -1 for an unknown handle and -2 for an
+// invalid decimation. Their joint angles are copied out by planner_engine_take_plans.
+int64_t planner_engine_plan(Engine *engine, const uint32_t *handles, uint32_t n_handles, const double *poses, uint32_t n_task_instances, uint32_t n_objects,
+                            const double *init_joint_config, uint32_t n_joints, const uint8_t *keep_plans, int successful_plans_only,
+                            int decimate, uint32_t decimation_mode, double decimation_tolerance, uint32_t decimation_stride,
+                            uint32_t *n_attempts, AttemptRecord *attempts, uint64_t *n_steps_total) {
+  Clock::time_point request_start = Clock::now();
+  Session &session = engine->session;
+  if (engine->job.plans) free_plans(engine->job);
+
+  Decimation decimation = {decimation_mode, decimation_tolerance, decimation_stride};
+  if (decimate && !is_valid(decimation)) return -2;
+
+  std::vector<Demontration *> demontrations(n_handles);
+  for (uint32_t j = 0; j < n_handles; j++) {
+    if (handles[j] >= session.demontrations.size()) return -1;
+    demontrations[j] = &session.demontrations[handles[j]];
+  }
 
-  for (int i = 0; i < n_task_instances; i++) {
-    for (int j = 0; j < n_demontrations; j++) {
-      send_int(client_socket_fd, plans[i][j].plan_length);
-      send_plan(client_socket_fd, plans[i][j].joint_angles);
-      send_bool(client_socket_fd, plans[i][j].is_successful);
-      if (plans[i][j].is_successful) break;
-      send_int(client_socket_fd, plans[i][j].failed_screw_segment);
-      send_int(client_socket_fd, plans[i][j].failed_joint_id);
-    }    
+  std::vector<kinlib::TaskInstance> task_instances(n_task_instances);
+  for (uint32_t i = 0; i < n_task_instances; i++) {
+    for (uint32_t k = 0; k < n_objects; k++) {
+      Eigen::Matrix4d object_pose;
+      for (int l = 0; l < 16; l++) object_pose(l) = poses[(i * n_objects + k) * 16 + l];
+      task_instances[i].object_poses.push_back(object_pose.transpose());
+    }
   }
 
-  close(client_socket_fd);
+  Eigen::VectorXd init_jnt_val(n_joints);
+  for (uint32_t k = 0; k < n_joints; k++) init_jnt_val(k) = init_joint_config[k];
+  std::vector<char> keep(keep_plans, keep_plans + n_task_instances);
+  session.stats.decode_ns += elapsed_ns(request_start);
+
+  engine->n_demontrations = n_handles;
+  start_planning(engine->job, demontrations, task_instances, init_jnt_val, keep, successful_plans_only, decimate ? &decimation : NULL, NULL);
+  finish_planning(engine->job, session.stats);
+  session.n_requests++;
+
+  Clock::time_point encode_start = Clock::now();
+  int64_t n_attempts_total = 0;
+  *n_steps_total = 0;
+  for (uint32_t i = 0; i < n_task_instances; i++) {
+    n_attempts[i] = n_handles;
+    for (uint32_t j = 0; j < n_handles; j++) {
+      PlanInfo &plan = engine->job.plans[i][j];
+      AttemptRecord &attempt = attempts[n_attempts_total++];
+      attempt.n_screw_segments = plan.plan_length;
+      attempt.is_successful = plan.is_successful;
+      attempt.failed_screw_segment = plan.is_successful ? 0 : plan.failed_screw_segment;
+      attempt.failed_joint_angle = plan.is_successful ? 0 : plan.failed_joint_id;
+      attempt.n_steps = plan.joint_angles.size();
+      *n_steps_total += plan.joint_angles.size();
+      if (plan.is_successful) {
+        n_attempts[i] = j + 1;
+        break;
+      }
+    }
+  }
+  session.stats.encode_ns += elapsed_ns(encode_start);
+  session.stats.wall_ns += elapsed_ns(request_start);
+  return n_attempts_total;
+}
 
-  free(demontrations);
-  free(task_instances);
-  free(threads);
-  free(args);
-  for (int i = 0; i < n_task_instances; i++)
-    free(plans[i]);
-  free(plans);
+// copies the joint angles of the attempts of the last request (n_steps_total x n_joints) and frees them
+int planner_engine_take_plans(Engine *engine, double *joint_angles) {
+  if (!engine->job.plans) return -1;
+  for (int i = 0; i < engine->job.n_task_instances; i++) {
+    for (uint32_t j = 0; j < engine->n_demontrations; j++) {
+      for (auto &step : engine->job.plans[i][j].joint_angles) {
+        Eigen::Map<Eigen::VectorXd>(joint_angles, step.size()) = step;
+        joint_angles += step.size();
+      }
+      if (engine->job.plans[i][j].is_successful) break;
+    }
+  }
+  free_plans(engine->job);
+  return 0;
+}
+
+// writes the engine's PlanStats as a PLAN_STATS payload and starts over, returns its size,
+// or the size needed if `size` is too small (in which case nothing is written)
+int64_t planner_engine_stats(Engine *engine, char *buffer, uint64_t size) {
+  PayloadWriter writer;
+  engine->session.stats.write(writer);
+  if (writer.data.size() > size) return writer.data.size();
+  memcpy(buffer, writer.data.data(), writer.data.size());
+  engine->session.stats = PlanStats();
+  return writer.data.size();
+}
 
-  return NULL;
 }
 
+#else
 
+// ./server [-s socket_path | -p tcp_port] [-t n_threads] [-c demo_cache_capacity] [-m max_in_flight] [-w max_waiting]
 int main(int argc, char *argv[]) {
 
-  // int port = 8888;
-  // int socket_fd = socket(AF_INET, SOCK_STREAM, 0);
-  // struct sockaddr_in socket_info;
-  // memset(&socket_info, 0, sizeof(socket_info));
-  // socket_info.sin_family = AF_INET;
-  // socket_info.sin_port = htons(port);
-  // socket_info.sin_addr.s_addr = INADDR_ANY;
+  const char *socket_path = "./socket_file";
+  int port = 0;
 
-  const char *port = "./socket_file";
-  remove(port);
-  int socket_fd = socket(AF_UNIX, SOCK_STREAM, 0);
-  struct sockaddr_un socket_info;
-  memset(&socket_info, 0, sizeof(socket_info));
-  socket_info.sun_family = AF_UNIX;
-  strcpy(socket_info.sun_path, port);
+  N_THREADS = std::thread::hardware_concurrency();
 
+  int option;
+  while ((option = getopt(argc, argv, "s:p:t:c:m:w:")) != -1) {
+    switch (option) {
+      case 's': socket_path = optarg; break;
+      case 'p': port = atoi(optarg); break;
+      case 't': N_THREADS = atoi(optarg); break;
+      case 'c': DEMO_CACHE_CAPACITY = atoi(optarg); break;
+      case 'm': MAX_IN_FLIGHT = atoi(optarg); break;
+      case 'w': MAX_WAITING = atoi(optarg); break;
+      default:
+        std::cerr << "Usage: " << argv[0] << " [-s socket_path | -p tcp_port] [-t n_threads] [-c demo_cache_capacity] [-m max_in_flight] [-w max_waiting]\n";
+        return 1;
+    }
+  }
 
-  bind(socket_fd, (struct sockaddr *) &socket_info, sizeof(socket_info));
+  N_THREADS = N_THREADS > 0 ? N_THREADS : 1;
 
-  listen(socket_fd, 10);
+  int socket_fd = open_listening_socket(socket_path, port);
+  if (socket_fd < 0) {
+    perror("Failed to open the listening socket");
+    return 1;
+  }
+
+  if (port > 0) std::cout << "Listening on port " << port << "\n";
+  else std::cout << "Listening on " << socket_path << "\n";
 
   int thread_count = 0;
   pthread_t thread;
@@ -356,13 +1481,14 @@ int main(int argc, char *argv[]) {
   pthread_attr_setdetachstate(&attr, PTHREAD_CREATE_DETACHED);
 
   init_solver();
-
-  N_THREADS = std::thread::hardware_concurrency();
-  N_THREADS = N_THREADS > 0 ? N_THREADS : 1;
+  worker_pool.start(N_THREADS);
 
   while (true) {
     int client_socket_fd = accept(socket_fd, NULL, NULL);
-    int args[2] = { client_socket_fd, thread_count++ };
+    if (client_socket_fd < 0) continue;
+    int *args = (int *) malloc(2 * sizeof(int));
+    args[0] = client_socket_fd;
+    args[1] = thread_count++;
     pthread_create(&thread, &attr, handle_request, (void *)args);
   }
 
@@ -370,4 +1496,6 @@ int main(int argc, char *argv[]) {
 
   close(socket_fd);
   return 0;
-}
\ No newline at end of file
+}
+
+#endif
@@ -1,5 +1,5 @@
-from client import *
 import numpy as np
+from client import trials
 
 epsilon = 0.02
 delta = 0.05
@@ -7,7 +7,7 @@ beta = 0.95
 
 N_RUNS_PER_K = 1000
 
-LOG_FILE = f'demonstrations/scooping_{epsilon}_{delta}_{beta}.json'
+LOG_FILE = f'demonstrations/scooping_{epsilon}_{delta}_{beta}.jsonl'  # written by simulate.py
 
 K = [
   {'x': 1, 'y': 2}, # K = 2
@@ -28,11 +28,7 @@ K = [
 
 
 
-data = {}
-if os.path.exists(LOG_FILE):
-  f = open(LOG_FILE, 'r')
-  data = json.loads(f.read())
-  f.close()
+data = trials.load_results(LOG_FILE)
 
 
 
@@ -0,0 +1,59 @@
+import math
+import numpy as np
+
+from client import bandit
+
+
+# compares the planner calls of naive_pac and successive_elimination_pac on synthetic arms,
+# each arm is a Bernoulli failure probability standing in for the planner
+
+epsilon = 0.02
+delta = 0.05
+
+N_RUNS = 200
+SEED = 0
+
+SCENARIOS = {
+  'one bad arm': lambda k, rng: np.r_[0.4, np.full(k - 1, 0.02)],
+  'spread': lambda k, rng: rng.uniform(0.0, 0.5, k),
+  'all good': lambda k, rng: np.full(k, 0.01),
+  'two close worst arms': lambda k, rng: np.r_[0.3, 0.3 - epsilon / 2, np.full(k - 2, 0.1)],
+}
+
+K = [2, 4, 8, 16]
+
+
+
+def naive_planner_calls(n_arms):
+  return n_arms * math.floor(math.log(2 * n_arms / delta) / (2 * epsilon**2))
+
+
+def run(probabilities, rng):
+  arm_ids = list(range(len(probabilities)))
+  n_calls = 0
+
+  def sample_arms(arm_ids, n):
+    nonlocal n_calls
+    n_calls += n * len(arm_ids)
+    return {arm_id: rng.binomial(n, probabilities[arm_id]) for arm_id in arm_ids}
+
+  remaining_arms, n_failures, n_samples = bandit.successive_elimination(arm_ids, sample_arms, epsilon, delta)
+  estimates = {arm_id: n_failures[arm_id] / n_samples[arm_id] for arm_id in remaining_arms}
+  worst_arm = max(estimates, key=estimates.get)
+  correct = (
+    probabilities[worst_arm] >= np.max(probabilities) - 2 * epsilon
+    and abs(estimates[worst_arm] - probabilities[worst_arm]) <= epsilon
+  )
+  return n_calls, correct
+
+
+
+rng = np.random.default_rng(SEED)
+print(f'ε={epsilon} δ={delta}, {N_RUNS} runs per row')
+print(f'{"scenario":>22} {"K":>3} {"naive":>8} {"adaptive":>10} {"ratio":>6} {"correct":>8}')
+for name, scenario in SCENARIOS.items():
+  for k in K:
+    results = [run(scenario(k, rng), rng) for _ in range(N_RUNS)]
+    n_calls, correct = zip(*results)
+    naive = naive_planner_calls(k)
+    print(f'{name:>22} {k:3d} {naive:8d} {np.mean(n_calls):10.0f} {np.mean(n_calls) / naive:6.2f} {np.mean(correct):8.3f}')
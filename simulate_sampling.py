@@ -0,0 +1,76 @@
+import math
+import numpy as np
+
+from client import sampling
+
+
+# compares the task instance samplers of client/sampling.py on a synthetic arm: a made-up failure
+# region stands in for the planner, the failure probability of the arm is estimated from n task
+# instances as in evaluate_arms, and each sampler is scored by its root mean squared error over
+# N_RUNS runs and by the planner calls it needs to be as accurate as the uniform sampler with
+# naive_pac's number of task instances per arm
+
+epsilon = 0.05
+delta = 0.05
+K = 16
+
+N_RUNS = 200
+SEED = 0
+
+# (x, y, θ) of a single object within an arm
+SEGMENT = [(0.7, 0.8), (0.3, 0.55), (-np.pi, np.pi)]
+
+FAILURE_REGIONS = {
+  'out of reach': lambda x, y, θ: np.hypot(x, y) > 0.9,             # a curved border across the arm
+  'corner': lambda x, y, θ: (x > 0.77) & (y < 0.34),                # a small region at the arm's border
+  'orientation': lambda x, y, θ: np.abs(θ - 0.5 * y) > 2.6,         # mostly along θ
+  'scattered': lambda x, y, θ: np.sin(60 * x) * np.sin(40 * y) > 0.8,  # many small islands
+}
+
+SAMPLERS = ['uniform', 'halton', 'sobol', 'lhs', 'stratified']
+
+
+
+def failures(task_instances):
+  x, y, θ = np.moveaxis(task_instances.reshape(len(task_instances), 3), 1, 0)
+  return {name: region(x, y, θ) for name, region in FAILURE_REGIONS.items()}
+
+
+# planner calls for the error `target`, interpolated between the sample sizes `n` on a log-log scale
+def calls_for_error(n, errors, target):
+  below = np.flatnonzero(errors <= target)
+  if len(below) == 0:
+    return math.inf
+  k = below[0]
+  if k == 0:
+    return n[0]
+  slope = np.log(errors[k] / errors[k - 1]) / np.log(n[k] / n[k - 1])
+  return n[k - 1] * (target / errors[k - 1]) ** (1 / slope)
+
+
+
+n_per_arm = math.floor(math.log(2 * K / delta) / (2 * epsilon**2))
+N = np.unique(np.r_[np.round(np.geomspace(16, 2 * n_per_arm, 16)).astype(int), n_per_arm])
+
+np.random.seed(SEED)
+truth = {name: np.mean(failed) for name, failed in failures(sampling.sample_task_instances(SEGMENT, 1, 3, 2**22, 'halton')).items()}
+
+errors = {name: {sampler: np.zeros(len(N)) for sampler in SAMPLERS} for name in FAILURE_REGIONS}
+for sampler in SAMPLERS:
+  for k, n in enumerate(N):
+    squared_errors = {name: 0.0 for name in FAILURE_REGIONS}
+    for _ in range(N_RUNS):
+      for name, failed in failures(sampling.sample_task_instances(SEGMENT, 1, 3, n, sampler)).items():
+        squared_errors[name] += (np.mean(failed) - truth[name]) ** 2
+    for name in FAILURE_REGIONS:
+      errors[name][sampler][k] = math.sqrt(squared_errors[name] / N_RUNS)
+
+k_per_arm = np.flatnonzero(N == n_per_arm)[0]
+print(f'ε={epsilon} δ={delta} K={K}: {n_per_arm} task instances per arm, {N_RUNS} runs per sample size')
+print(f'{"failure region":>14} {"p":>6} {"":>10}' + ''.join(f'{sampler:>12}' for sampler in SAMPLERS))
+for name in FAILURE_REGIONS:
+  target = errors[name]['uniform'][k_per_arm]
+  calls = [calls_for_error(N, errors[name][sampler], target) for sampler in SAMPLERS]
+  print(f'{name:>14} {truth[name]:6.3f} {"RMSE":>10}' + ''.join(f'{errors[name][sampler][k_per_arm]:12.4f}' for sampler in SAMPLERS))
+  print(f'{"":>14} {"":>6} {"calls":>10}' + ''.join(f'{c:12.0f}' for c in calls))
+  print(f'{"":>14} {"":>6} {"vs uniform":>10}' + ''.join(f'{c / calls[0]:12.2f}' for c in calls))